@@ -0,0 +1,149 @@
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+import pygame
+
+import main as game
+
+# スプライトシート (アトラス) の作成ツール
+# 爆発のコマ・パワーアップ・機体・ミサイルなどの小さな画像を数枚のシートにまとめ、
+# 各画像の位置を索引 (atlas.json) に書き出す。ゲームは索引に載っている画像をシートの部分Surfaceとして読む
+# 元の画像を差し替えたら、このツールを実行し直すこと (--checkで索引が古くなっていないか確かめられる)
+#
+# 例: python atlas.py          (シートと索引を作り直す)
+#     python atlas.py --check  (元の画像と索引が合っているか確かめる。合っていなければ終了コード1)
+
+# シートにまとめる画像 (起動時に読む共通の画像。背景は大きく、ステージごとに読み捨てるので入れない)
+ATLAS_SOURCES = game.SPRITE_IMAGES
+# シートはPNGにする (BMPは展開が速いが約17倍の大きさになり、ダウンロードの時間が効くブラウザ版では起動が遅くなるため)
+SHEET_NAME = "sprites{}.png" # 1枚目はsprites0.png
+MAX_SHEET_SIZE = 512 # シート1枚の最大の幅・高さ
+PADDING = 1 # 画像の間の隙間
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# RGBAのピクセル (高さ x 幅 x 4) として読む
+# blitを使うと透明部分が合成されてしまうので、ピクセルをそのまま取り出す
+def load_pixels(path):
+    surface = pygame.image.load(path)
+    width, height = surface.get_size()
+    data = pygame.image.tobytes(surface, "RGBA")
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 4)
+
+# 棚詰め (高い画像から順に左から並べ、幅が足りなくなったら次の段、高さが足りなくなったら次のシートへ)
+# 戻り値は ファイル名 -> (シート番号, x, y) と、シートごとの使った大きさ
+def pack(sizes, max_size, padding):
+    placements = {}
+    sheets = []
+    x = y = shelf_height = 0
+    for filename in sorted(sizes, key=lambda name: (-sizes[name][1], -sizes[name][0], name)):
+        width, height = sizes[filename]
+        if width > max_size or height > max_size:
+            raise ValueError("{} ({}x{}) does not fit in a {}px sheet".format(filename, width, height, max_size))
+        if x + width > max_size:
+            x = 0
+            y += shelf_height + padding
+            shelf_height = 0
+        if not sheets or y + height > max_size:
+            sheets.append([0, 0])
+            x = y = shelf_height = 0
+        placements[filename] = (len(sheets) - 1, x, y)
+        used = sheets[-1]
+        used[0] = max(used[0], x + width)
+        used[1] = max(used[1], y + height)
+        x += width + padding
+        shelf_height = max(shelf_height, height)
+    return placements, sheets
+
+def build(img_dir, sources, max_size=MAX_SHEET_SIZE, padding=PADDING):
+    pixels = {filename: load_pixels(os.path.join(img_dir, filename)) for filename in sources}
+    sizes = {filename: (image.shape[1], image.shape[0]) for filename, image in pixels.items()}
+    placements, sheets = pack(sizes, max_size, padding)
+
+    canvases = [np.zeros((height, width, 4), dtype=np.uint8) for width, height in sheets]
+    frames = {}
+    for filename in sources:
+        sheet, x, y = placements[filename]
+        width, height = sizes[filename]
+        canvases[sheet][y:y + height, x:x + width] = pixels[filename]
+        frames[filename] = {
+            "sheet": SHEET_NAME.format(sheet),
+            "rect": [x, y, width, height],
+            "sha1": file_hash(os.path.join(img_dir, filename)),
+        }
+    names = [SHEET_NAME.format(sheet) for sheet in range(len(sheets))]
+    for name, canvas in zip(names, canvases):
+        height, width = canvas.shape[:2]
+        surface = pygame.image.frombuffer(canvas.tobytes(), (width, height), "RGBA")
+        pygame.image.save(surface, os.path.join(img_dir, name)) # 形式は拡張子で決まる
+    # 前の索引にあって今回使わないシート (枚数が減った時や形式を変えた時のもの) を消す
+    for name in read_index(img_dir).get("sheets", []):
+        if name not in names and os.path.exists(os.path.join(img_dir, name)):
+            os.remove(os.path.join(img_dir, name))
+    index = {"version": 1, "sheets": names, "sheet_sha1": {name: file_hash(os.path.join(img_dir, name)) for name in names}, "frames": frames}
+    with open(os.path.join(img_dir, game.ATLAS_INDEX), "w") as f:
+        json.dump(index, f, indent=2)
+        f.write("\n")
+    return index
+
+def read_index(img_dir):
+    path = os.path.join(img_dir, game.ATLAS_INDEX)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+# 索引が元の画像・シートと合っていなければ、問題のリストを返す
+def check(img_dir, sources):
+    index = read_index(img_dir)
+    if not index:
+        return ["{} not found".format(game.ATLAS_INDEX)]
+    frames = index["frames"]
+    problems = []
+    for name in index["sheets"]:
+        path = os.path.join(img_dir, name)
+        if not os.path.exists(path):
+            problems.append("{} not found".format(name))
+        elif index.get("sheet_sha1", {}).get(name) != file_hash(path):
+            problems.append("{} does not match the atlas".format(name))
+    for filename in sources:
+        if filename not in frames:
+            problems.append("{} is not in the atlas".format(filename))
+        elif frames[filename]["sha1"] != file_hash(os.path.join(img_dir, filename)):
+            problems.append("{} changed since the atlas was built".format(filename))
+    for filename in frames:
+        if filename not in sources:
+            problems.append("{} is no longer an atlas source".format(filename))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="小さな画像をスプライトシートにまとめる")
+    parser.add_argument("--check", action="store_true", help="作り直さず、索引が元の画像と合っているか確かめる")
+    parser.add_argument("--max-size", type=int, default=MAX_SHEET_SIZE, help="シート1枚の最大の幅・高さ")
+    args = parser.parse_args()
+
+    if args.check:
+        problems = check(game.img_dir, ATLAS_SOURCES)
+        for problem in problems:
+            print(problem)
+        if problems:
+            print("run python atlas.py to rebuild")
+            return 1
+        print("atlas is up to date")
+        return 0
+
+    index = build(game.img_dir, ATLAS_SOURCES, args.max_size)
+    for sheet in index["sheets"]:
+        count = sum(1 for frame in index["frames"].values() if frame["sheet"] == sheet)
+        print("{}: {} images".format(sheet, count))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+import main as game
+
+# ステージ設定の自動調整用ツール
+# STAGE_SETTINGSの値を振りながら、自動操縦のボットにヘッドレスで何度もプレイさせ、
+# ステージごとのクリア率・ボス出現までの時間・被弾数・スコアを集計する
+#
+# 例: python balance.py --stages 3,4 --max-enemies 4,6,8 --boss-health 100,140 --runs 50
+
+# 振ることのできる設定 (コマンドライン引数名, STAGE_SETTINGSのキー)
+SWEEP_PARAMETERS = [
+    ("max_enemies", "max_enemies_on_screen"),
+    ("bullet_speed", "enemy_bullet_speed"),
+    ("shoot_delay_min", "enemy_shoot_delay_min"),
+    ("shoot_delay_max", "enemy_shoot_delay_max"),
+    ("boss_health", "boss_health"),
+]
+
+# 自動操縦のボット
+# 自機の上から迫ってくる敵弾と敵を横に避け、それ以外の時はボス (いなければ一番下の敵) の真下に付いて撃ち続ける
+class ScriptedBot:
+    def __init__(self, dodge_range=140, dodge_margin=20):
+        self.dodge_range = dodge_range # この距離まで近づいた敵弾を避ける
+        self.dodge_margin = dodge_margin # 自機の左右にこれだけ余裕を見て避ける
+
+    def inputs(self, world):
+        player = world.player
+        if not player.alive():
+            return game.FrameInput()
+        rect = player.rect
+        left = rect.left - self.dodge_margin
+        right = rect.right + self.dodge_margin
+        top = rect.top - self.dodge_range
+
+        # 自機の上にいる敵弾と敵を探す
+        threats = []
+        engine = world.enemy_projectiles
+        n = engine.count
+        if n:
+            x, y, w, h = engine.x[:n], engine.y[:n], engine.w[:n], engine.h[:n]
+            near = (x < right) & (x + w > left) & (y + h > top) & (y < rect.bottom) & ~engine.dead[:n]
+            threats.extend((x[near] + w[near] / 2).tolist())
+        enemy_rects = [enemy_rect for enemy, enemy_rect in world.enemies.rects()]
+        for enemy_rect in enemy_rects:
+            if enemy_rect.right > left and enemy_rect.left < right and enemy_rect.bottom > top:
+                threats.append(enemy_rect.centerx)
+
+        move = 0
+        if threats:
+            # 脅威の平均位置から離れる (真上なら画面の広い方へ)
+            away = rect.centerx - sum(threats) / len(threats)
+            if away == 0:
+                away = 1 if rect.centerx < game.SCREEN_WIDTH // 2 else -1
+            move = 1 if away > 0 else -1
+            if (move < 0 and rect.left <= 0) or (move > 0 and rect.right >= game.SCREEN_WIDTH):
+                move = -move # 画面端に追い詰められたら反対へ抜ける
+        else:
+            target = world.current_boss.rect if world.current_boss is not None else None
+            if target is None and enemy_rects:
+                target = max(enemy_rects, key=lambda enemy_rect: enemy_rect.bottom)
+            if target is not None:
+                dx = target.centerx - rect.centerx
+                if abs(dx) > 4:
+                    move = 1 if dx > 0 else -1
+
+        return game.FrameInput(
+            left=move < 0,
+            right=move > 0,
+            down=rect.bottom < game.SCREEN_HEIGHT - 10, # 画面下端付近に留まる
+            fire=world.game_state == "playing",
+        )
+
+# 1回分のプレイ。ステージをクリアするか、やられるか、max_ticksを過ぎるまで進める
+def run_trial(task):
+    stage, overrides, seed, max_ticks = task
+    stage_settings = {number: dict(settings) for number, settings in game.STAGE_SETTINGS.items()}
+    stage_settings[stage].update(overrides)
+    world = game.GameWorld(persist_best_score=False, seed=seed, stage_settings=stage_settings, start_stage=stage)
+    bot = ScriptedBot()
+    while world.clock.ticks < max_ticks and world.game_state == "playing":
+        world.step(bot.inputs(world))
+    return {
+        "stage": stage,
+        "overrides": overrides,
+        "seed": seed,
+        "cleared": world.game_state == "score_counting",
+        "ticks_to_boss": world.boss_spawn_tick,
+        "damage_taken": world.damage_taken,
+        "score": world.score,
+        "ticks": world.clock.ticks,
+    }
+
+def init_worker():
+    game.init_pygame(headless=True)
+
+# 設定の組み合わせごとの集計
+class Summary:
+    def __init__(self, stage, overrides):
+        self.stage = stage
+        self.overrides = overrides
+        self.runs = 0
+        self.cleared = 0
+        self.boss_runs = 0
+        self.ticks_to_boss = 0
+        self.damage_taken = 0
+        self.score = 0
+
+    def add(self, result):
+        self.runs += 1
+        self.cleared += result["cleared"]
+        if result["ticks_to_boss"] is not None:
+            self.boss_runs += 1
+            self.ticks_to_boss += result["ticks_to_boss"]
+        self.damage_taken += result["damage_taken"]
+        self.score += result["score"]
+
+    def row(self):
+        return {
+            "stage": self.stage,
+            **self.overrides,
+            "runs": self.runs,
+            "clear_rate": self.cleared / self.runs,
+            "time_to_boss": self.ticks_to_boss / self.boss_runs / game.FPS if self.boss_runs else None,
+            "damage_taken": self.damage_taken / self.runs,
+            "score": self.score / self.runs,
+        }
+
+def format_row(row, columns):
+    cells = []
+    for column in columns:
+        value = row.get(column)
+        if value is None:
+            cells.append("-")
+        elif isinstance(value, str):
+            cells.append(value)
+        elif column == "clear_rate":
+            cells.append("{:.0%}".format(value))
+        elif isinstance(value, float):
+            cells.append("{:.1f}".format(value))
+        else:
+            cells.append(str(value))
+    return "  ".join(cell.rjust(max(len(column), 8)) for cell, column in zip(cells, columns))
+
+def parse_values(text):
+    return [int(value) for value in text.split(",")] if text else None
+
+def main():
+    parser = argparse.ArgumentParser(description="ステージ設定をボットのプレイで評価する")
+    parser.add_argument("--stages", default=",".join(str(stage) for stage in game.STAGE_SETTINGS), help="評価するステージ (カンマ区切り)")
+    for option, key in SWEEP_PARAMETERS:
+        parser.add_argument("--" + option.replace("_", "-"), dest=option, help="{}の候補 (カンマ区切り、省略時はステージの値)".format(key))
+    parser.add_argument("--runs", type=int, default=20, help="組み合わせごとのプレイ回数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="並列に動かすプロセス数")
+    parser.add_argument("--max-seconds", type=int, default=120, help="1回のプレイの最大時間（ゲーム内の秒）")
+    parser.add_argument("--seed", type=int, default=0, help="最初のシード (n回目のプレイはseed+n、組み合わせ間で同じシードを使う)")
+    parser.add_argument("--csv", metavar="FILE", help="集計結果をCSVに書き出す")
+    args = parser.parse_args()
+
+    stages = parse_values(args.stages)
+    swept = [(key, parse_values(getattr(args, option))) for option, key in SWEEP_PARAMETERS]
+    swept = [(key, values) for key, values in swept if values]
+    combinations = [dict(zip([key for key, _ in swept], values)) for values in itertools.product(*[values for _, values in swept])]
+    max_ticks = args.max_seconds * game.FPS
+    tasks = [(stage, overrides, args.seed + run, max_ticks) for stage in stages for overrides in combinations for run in range(args.runs)]
+
+    summaries = {}
+    for stage in stages:
+        for overrides in combinations:
+            summaries[(stage, tuple(overrides.items()))] = Summary(stage, overrides)
+    columns = ["stage"] + [key for key, _ in swept] + ["runs", "clear_rate", "time_to_boss", "damage_taken", "score"]
+
+    print("{} trials ({} stages x {} settings x {} runs) on {} workers".format(len(tasks), len(stages), len(combinations), args.runs, args.workers), file=sys.stderr)
+    print(format_row({column: column for column in columns}, columns))
+    start = time.perf_counter()
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker)
+        results = pool.imap_unordered(run_trial, tasks)
+    else:
+        pool = None
+        init_worker()
+        results = map(run_trial, tasks)
+
+    # 組み合わせごとにプレイが揃った時点で1行ずつ出力する
+    for result in results:
+        summary = summaries[(result["stage"], tuple(result["overrides"].items()))]
+        summary.add(result)
+        if summary.runs == args.runs:
+            print(format_row(summary.row(), columns), flush=True)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+    print("done in {:.1f}s".format(elapsed), file=sys.stderr)
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for summary in summaries.values():
+                writer.writerow(summary.row())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import main as game
+
+# 性能ベンチマーク
+# シード固定のシナリオをヘッドレスで動かし、1秒あたりのティック数とフェーズごとの時間を測る
+# 各シナリオを--repeat回ずつ、シナリオを順番に回しながら動かし (一時的に遅くなった時間が1つのシナリオに偏らないように)、
+# ティック/秒が中央値の回を結果にする。結果はbench_baseline.jsonと比べ、しきい値を超えて遅くなっていれば終了コード1で終わる
+# 基準も同じやり方で、他に重い処理が動いていない時に取ること
+#
+# 例: python bench.py                    (基準と比較する)
+#     python bench.py --update-baseline  (今の結果を基準として保存する)
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+
+# 基準と比べる時の許容範囲 (基準ファイルに保存され、そちらが優先される)
+DEFAULT_THRESHOLDS = {
+    "min_ticks_per_sec_ratio": 0.7, # ティック/秒 (繰り返しの中央値) が基準のこの割合を下回ったら失敗 (同じマシンでも一時的に2-3割遅くなることがある)
+    "max_p95_ratio": 1.5, # フェーズごとのp95が基準のこの倍率を超えたら失敗
+    "p95_slack_ms": 0.05, # ごく短いフェーズの揺れは無視する
+}
+
+# シナリオ
+# stage_settingsの上書き、開始ステージ、ワールドの準備 (setup)、毎ティックの操作 (tick) と入力を決める
+class Scenario:
+    def __init__(self, name, description, stage, overrides=None, setup=None, tick=None, inputs=None):
+        self.name = name
+        self.description = description
+        self.stage = stage
+        self.overrides = overrides or {}
+        self.setup = setup
+        self.tick = tick
+        self.inputs = inputs or game.FrameInput()
+
+    def create_world(self, seed):
+        stage_settings = {number: dict(settings) for number, settings in game.STAGE_SETTINGS.items()}
+        stage_settings[self.stage].update(self.overrides)
+        world = game.GameWorld(persist_best_score=False, seed=seed, stage_settings=stage_settings, start_stage=self.stage)
+        if self.setup is not None:
+            self.setup(world)
+        return world
+
+# プレイヤーを無敵のままにする (当たり判定自体は行われる)
+def keep_player_alive(world):
+    player = world.player
+    player.invincible = True
+    player.invincible_timer = world.now()
+
+# ボスを出さずに敵を最大数まで補充し続ける
+def fill_enemies(world):
+    keep_player_alive(world)
+    world.boss_spawn_timer = world.now()
+    while len(world.enemies) < world.current_stage_settings["max_enemies_on_screen"]:
+        world.spawn_enemy()
+
+def spawn_boss_now(world):
+    world.boss_spawn_timer = world.now() - game.BOSS_SPAWN_TIME * 1000
+
+# ボスを誘導弾モードのままにする
+def boss_homing(world):
+    keep_player_alive(world)
+    boss = world.current_boss
+    if boss is not None:
+        boss.homing_attack_active = True
+        boss.homing_attack_start_time = world.now()
+
+# 全パワーアップを有効にし、シールドを張る
+def give_all_powerups(world):
+    player = world.player
+    player.rapid_fire_active = True
+    player.spread_shot_active = True
+    player.triple_shot_active = True
+    player.homing_missile_active = True
+    player.activate_shield()
+
+# 全パワーアップを有効にしたまま撃ち続ける
+def keep_powerups(world):
+    fill_enemies(world)
+    player = world.player
+    player.rapid_fire_active = True
+    player.spread_shot_active = True
+    player.triple_shot_active = True
+    player.homing_missile_active = True
+    player.shield_start_time = world.now()
+
+# 毎ティック敵を1体倒し、その場所に爆発を出す (パワーアップも毎回ドロップする)
+def defeat_enemies(world):
+    fill_enemies(world)
+    for enemy in world.enemies.entities()[:1]:
+        center = world.enemies.center(enemy)
+        world.enemies.kill(enemy)
+        world.handle_enemy_defeat(center)
+        world.explosions.spawn(center, world.now())
+
+SCENARIOS = [
+    Scenario("stage4_full", "ステージ4で敵を最大数出し続ける", 4, tick=fill_enemies),
+    Scenario("boss_radial", "ボスが誘導弾モードのまま短い間隔で全方位弾を撃ち続ける", 4,
+             overrides={"boss_health": 10 ** 9, "boss_radial_attack_interval": 250}, setup=spawn_boss_now, tick=boss_homing),
+    Scenario("boss_barrage", "ボスが時間差の弾幕 (全方位弾・回転弾・狙い撃ち) を短い間隔で撃ち続ける", 4,
+             overrides={"boss_health": 10 ** 9, "boss_radial_attack_interval": 250, "boss_radial_pattern": "boss_barrage"}, setup=spawn_boss_now, tick=keep_player_alive),
+    Scenario("powerup_swarm", "全パワーアップを持って撃ち続け、追尾ミサイルを大量に飛ばす", 4,
+             setup=give_all_powerups, tick=keep_powerups, inputs=game.FrameInput(fire=True)),
+    Scenario("explosions", "敵の撃破処理と爆発を毎ティック起こす", 4, tick=defeat_enemies),
+]
+
+# シナリオを1回動かして測る
+def run_scenario(scenario, ticks, seed, renderer=None):
+    world = scenario.create_world(seed)
+    profiler = world.profiler = game.FrameProfiler(ticks)
+    start = time.perf_counter()
+    for i in range(ticks):
+        if scenario.tick is not None:
+            scenario.tick(world)
+        profiler.begin_frame()
+        world.step(scenario.inputs)
+        if renderer is not None:
+            renderer.render(world)
+            profiler.mark("render")
+        profiler.end_frame(world)
+    elapsed = time.perf_counter() - start
+    peak = profiler.counts[:ticks].max(axis=0).tolist()
+    percentiles = profiler.percentiles()
+    phases = ["update", "collision", "total"] + (["render"] if renderer is not None else [])
+    return {
+        "ticks": ticks,
+        "seconds": elapsed,
+        "ticks_per_sec": ticks / elapsed if elapsed > 0 else 0,
+        "phases": {phase: dict(zip(("p50_ms", "p95_ms", "p99_ms"), percentiles[phase])) for phase in phases},
+        "peak_counts": dict(zip(game.PROFILE_COUNTS[1:], peak[1:])),
+        "digest": world.digest(),
+    }
+
+# 基準と比べて、問題のあった項目のリストを返す
+def compare(name, result, baseline, thresholds):
+    problems = []
+    if baseline.get("digest") != result["digest"]:
+        problems.append("workload changed (digest differs), re-run with --update-baseline if intended")
+    ratio = result["ticks_per_sec"] / baseline["ticks_per_sec"]
+    if ratio < thresholds["min_ticks_per_sec_ratio"]:
+        problems.append("ticks/s {:.0f} -> {:.0f} ({:.0%})".format(baseline["ticks_per_sec"], result["ticks_per_sec"], ratio))
+    for phase, values in result["phases"].items():
+        base = baseline["phases"].get(phase)
+        if base is None:
+            continue
+        limit = base["p95_ms"] * thresholds["max_p95_ratio"] + thresholds["p95_slack_ms"]
+        if values["p95_ms"] > limit:
+            problems.append("{} p95 {:.3f}ms -> {:.3f}ms (limit {:.3f}ms)".format(phase, base["p95_ms"], values["p95_ms"], limit))
+    return problems
+
+def machine_info():
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "pygame": game.pygame.version.ver,
+        "numpy": game.np.__version__,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="ヘッドレスで性能を測り、基準と比べる")
+    parser.add_argument("--scenarios", default=",".join(scenario.name for scenario in SCENARIOS), help="動かすシナリオ (カンマ区切り)")
+    parser.add_argument("--ticks", type=int, default=1800, help="シナリオごとのティック数")
+    parser.add_argument("--repeat", type=int, default=5, help="繰り返す回数 (ティック/秒が中央値の回を使う)")
+    parser.add_argument("--seed", type=int, default=1, help="乱数のシード")
+    parser.add_argument("--no-render", action="store_true", help="描画をしない (シミュレーションだけ測る)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="基準ファイル")
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果を基準ファイルに保存する")
+    parser.add_argument("--output", metavar="FILE", help="今回の結果をJSONで書き出す")
+    args = parser.parse_args()
+
+    names = args.scenarios.split(",")
+    scenarios = {scenario.name: scenario for scenario in SCENARIOS}
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        parser.error("unknown scenario: {}".format(", ".join(unknown)))
+
+    screen = game.init_pygame(headless=True)
+    runs = {name: [] for name in names}
+    for i in range(args.repeat):
+        for name in names:
+            renderer = None if args.no_render else game.Renderer(screen)
+            runs[name].append(run_scenario(scenarios[name], args.ticks, args.seed, renderer))
+    results = {}
+    for name in names:
+        ordered = sorted(runs[name], key=lambda result: result["ticks_per_sec"])
+        result = results[name] = ordered[len(ordered) // 2]
+        result["ticks_per_sec_runs"] = [run["ticks_per_sec"] for run in runs[name]] # ばらつきの確認用
+        phases = "  ".join("{} p50={p50_ms:.3f} p95={p95_ms:.3f}".format(phase, **values) for phase, values in result["phases"].items())
+        print("{:<14} {:>8.0f} ticks/s (min {:.0f} max {:.0f})  {}".format(name, result["ticks_per_sec"], ordered[0]["ticks_per_sec"], ordered[-1]["ticks_per_sec"], phases), flush=True)
+
+    report = {
+        "machine": machine_info(),
+        "settings": {"ticks": args.ticks, "seed": args.seed, "render": not args.no_render, "repeat": args.repeat},
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        report["thresholds"] = DEFAULT_THRESHOLDS
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                old = json.load(f)
+            report["thresholds"] = old.get("thresholds", DEFAULT_THRESHOLDS)
+            # 同じ条件で測った基準なら、今回動かさなかったシナリオはそのまま残す
+            if old.get("settings") == report["settings"]:
+                report["scenarios"] = dict(old["scenarios"], **results)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print("baseline written to {}".format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline at {} (run with --update-baseline)".format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["settings"] != report["settings"]:
+        print("warning: baseline was measured with {}".format(baseline["settings"]))
+    thresholds = dict(DEFAULT_THRESHOLDS, **baseline.get("thresholds", {}))
+    failed = False
+    for name, result in results.items():
+        if name not in baseline["scenarios"]:
+            print("{:<14} no baseline".format(name))
+            continue
+        problems = compare(name, result, baseline["scenarios"][name], thresholds)
+        print("{:<14} {}".format(name, "ok" if not problems else "REGRESSION: " + "; ".join(problems)))
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
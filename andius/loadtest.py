@@ -0,0 +1,221 @@
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import main as game
+import server as net
+
+# サーバーの負荷試験
+# サーバーを別プロセスで起動し (--connectで動いているサーバーも使える)、ルームごとにボットのクライアントをつないで一定時間動かす
+# ルームの数を段階的に増やし、サーバーのCPU時間から1コアで動かせるルームの数、ボットが送受信したバイト数から1クライアントあたりの帯域を求める
+# ボットは受け取ったスナップショットを全部復元し、CRCで差分の復元が合っているか確かめる
+#
+# 例: python loadtest.py                                  (1, 4, 16ルームを2人ずつで試す)
+#     python loadtest.py --rooms 8 --mode versus --seconds 20
+#     python loadtest.py --connect 127.0.0.1:7777 --output load.json
+SERVER_SCRIPT = os.path.join(os.path.dirname(__file__), "server.py")
+
+# ボットのクライアント
+# 左右の移動を時々切り替え、一定の間隔でSPACEを押す入力を送り、スナップショットを受け取って復元する
+class Bot:
+    def __init__(self, room, mode, number, seed):
+        self.room = room
+        self.mode = mode
+        self.name = "bot{}".format(number)
+        self.rng = random.Random(seed)
+        self.running = True
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.snapshots = 0
+        self.full_snapshots = 0
+        self.full_bytes = 0 # 全体を送ったスナップショットのバイト数の合計
+        self.raw_bytes = 0 # 圧縮しなかった場合のバイト数の合計
+        self.errors = 0 # 復元に失敗したスナップショット
+        self.meta = None # 最後に受け取ったHUDやスコア
+        self.last_error = None
+
+    def counters(self):
+        return {"received": self.bytes_received, "sent": self.bytes_sent, "snapshots": self.snapshots,
+                "full_snapshots": self.full_snapshots, "full_bytes": self.full_bytes, "raw_bytes": self.raw_bytes, "errors": self.errors}
+
+    async def run(self, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(net.json_message(net.HELLO, {"room": self.room, "mode": self.mode, "name": self.name}))
+        kind, body = await net.read_message(reader)
+        if kind != net.WELCOME:
+            writer.close()
+            raise RuntimeError("{} could not join {}: {}".format(self.name, self.room, body.decode()))
+        sender = asyncio.ensure_future(self._send_inputs(writer))
+        try:
+            await self._receive(reader)
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def _send_inputs(self, writer):
+        direction = game.INPUT_LEFT
+        tick = 0
+        while self.running:
+            if self.rng.random() < 1 / 90:
+                direction = game.INPUT_RIGHT if direction == game.INPUT_LEFT else game.INPUT_LEFT
+            bits = direction | (game.INPUT_FIRE if tick % 8 == 0 else 0)
+            data = net.message(net.INPUT, bytes([bits]))
+            writer.write(data)
+            self.bytes_sent += len(data)
+            tick += 1
+            await asyncio.sleep(1 / game.FPS)
+
+    async def _receive(self, reader):
+        baseline = None
+        while self.running:
+            kind, body = await net.read_message(reader)
+            self.bytes_received += net.MESSAGE_HEADER.size + len(body)
+            if kind != net.SNAPSHOT:
+                continue
+            try:
+                tick, state, meta = net.decode_snapshot(body, baseline)
+            except ValueError as e:
+                self.errors += 1
+                self.last_error = str(e)
+                baseline = None
+                continue
+            baseline = (tick, state, meta)
+            self.meta = json.loads(meta)
+            self.snapshots += 1
+            self.raw_bytes += state.nbytes + len(meta)
+            if net.SNAPSHOT_HEADER.unpack_from(body)[1] == net.NO_BASELINE:
+                self.full_snapshots += 1
+                self.full_bytes += net.MESSAGE_HEADER.size + len(body)
+
+# サーバーの統計を取る接続
+class StatsClient:
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    async def get(self):
+        self.writer.write(net.message(net.STATS))
+        kind, body = await net.read_message(self.reader)
+        return json.loads(body)
+
+    def close(self):
+        self.writer.close()
+
+async def start_server(seed):
+    process = await asyncio.create_subprocess_exec(sys.executable, SERVER_SCRIPT, "--port", "0", "--seed", str(seed), stdout=asyncio.subprocess.PIPE)
+    # pygameの起動メッセージの後に "listening on host:port" が出る
+    while True:
+        line = await process.stdout.readline()
+        if not line:
+            raise RuntimeError("server exited before listening")
+        if line.startswith(b"listening on "):
+            host, port = line.decode().split()[-1].rsplit(":", 1)
+            return process, host, int(port)
+
+def totals(bots):
+    result = {}
+    for bot in bots:
+        for key, value in bot.counters().items():
+            result[key] = result.get(key, 0) + value
+    return result
+
+# ルームをrooms個作ってseconds秒動かし、結果を返す
+async def run_step(host, port, stats, step, rooms, clients_per_room, mode, seconds, warmup, seed):
+    bots = [Bot("load{}-{}".format(step, room), mode, room * clients_per_room + i, seed + room * clients_per_room + i)
+            for room in range(rooms) for i in range(clients_per_room)]
+    tasks = [asyncio.ensure_future(bot.run(host, port)) for bot in bots]
+    await asyncio.sleep(warmup) # 接続と最初の全体スナップショットが落ち着くまで待つ
+    start_stats, start_totals, start = await stats.get(), totals(bots), time.perf_counter()
+    await asyncio.sleep(seconds)
+    end_stats, end_totals, end = await stats.get(), totals(bots), time.perf_counter()
+    for bot in bots:
+        bot.running = False
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    failed = [task.exception() for task in tasks if not task.cancelled() and task.exception() is not None]
+    if failed:
+        raise failed[0]
+
+    clients = len(bots)
+    elapsed = end - start
+    delta = {key: end_totals[key] - start_totals[key] for key in end_totals}
+    ticks = end_stats["ticks"] - start_stats["ticks"]
+    cpu = end_stats["cpu_seconds"] - start_stats["cpu_seconds"]
+    wall = end_stats["wall_seconds"] - start_stats["wall_seconds"]
+    utilization = cpu / wall if wall > 0 else 0
+    snapshots = max(delta["snapshots"], 1)
+    return {
+        "rooms": rooms,
+        "clients": clients,
+        "server_rooms": end_stats["rooms"],
+        "ticks_per_sec": ticks / wall if wall > 0 else 0,
+        "late_ticks": end_stats["late_ticks"] - start_stats["late_ticks"],
+        "tick_ms_p50": end_stats["tick_ms_p50"],
+        "tick_ms_p95": end_stats["tick_ms_p95"],
+        "cpu_utilization": utilization,
+        "rooms_per_core": rooms / utilization if utilization > 0 else 0, # CPU 1コアを使い切った時に動かせるルームの数の見積もり
+        "down_kb_per_sec_per_client": delta["received"] / elapsed / clients / 1024,
+        "up_bytes_per_sec_per_client": delta["sent"] / elapsed / clients,
+        "snapshot_bytes": delta["received"] / snapshots,
+        "full_snapshot_bytes": end_totals["full_bytes"] / end_totals["full_snapshots"] if end_totals["full_snapshots"] else None, # 接続直後のものを含める
+        "compression_ratio": delta["raw_bytes"] / delta["received"] if delta["received"] else 0,
+        "snapshots_per_sec_per_client": delta["snapshots"] / elapsed / clients,
+        "dropped_snapshots": end_stats["dropped_snapshots"] - start_stats["dropped_snapshots"],
+        "decode_errors": delta["errors"],
+        "last_error": next((bot.last_error for bot in bots if bot.last_error), None),
+    }
+
+async def run(args):
+    process = None
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        port = int(port)
+    else:
+        process, host, port = await start_server(args.seed)
+    stats = StatsClient()
+    await stats.connect(host, port)
+    results = []
+    try:
+        for step, rooms in enumerate(args.rooms):
+            result = await run_step(host, port, stats, step, rooms, args.clients_per_room, args.mode, args.seconds, args.warmup, args.seed)
+            results.append(result)
+            print("{rooms:>4} rooms {clients:>4} clients  {ticks_per_sec:5.1f} ticks/s  late {late_ticks:>4}  tick p95 {tick_ms_p95:6.2f}ms  "
+                  "cpu {cpu_utilization:4.0%}  {rooms_per_core:6.1f} rooms/core  down {down_kb_per_sec_per_client:6.1f} kB/s  "
+                  "up {up_bytes_per_sec_per_client:5.0f} B/s  snapshot {snapshot_bytes:6.0f} B  errors {decode_errors}".format(**result), flush=True)
+            await asyncio.sleep(0.5) # ボットの切断でルームが片付くのを待つ
+    finally:
+        stats.close()
+        if process is not None:
+            process.terminate()
+            await process.wait()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="ボットをつないでサーバーの負荷と帯域を測る")
+    parser.add_argument("--rooms", default="1,4,16", help="試すルームの数 (カンマ区切り)")
+    parser.add_argument("--clients-per-room", type=int, default=2, help="1ルームあたりのボットの数")
+    parser.add_argument("--mode", choices=net.MODES, default="coop", help="ルームのモード")
+    parser.add_argument("--seconds", type=float, default=10, help="1段階あたりの測る時間")
+    parser.add_argument("--warmup", type=float, default=1, help="測り始める前に待つ時間")
+    parser.add_argument("--seed", type=int, default=1, help="サーバーのルームとボットの乱数のシード")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="起動せずにこのサーバーを使う")
+    parser.add_argument("--output", metavar="FILE", help="結果をJSONで書き出す")
+    args = parser.parse_args()
+    args.rooms = [int(rooms) for rooms in args.rooms.split(",")]
+    if args.clients_per_room > net.MAX_PLAYERS:
+        parser.error("--clients-per-room must be at most {}".format(net.MAX_PLAYERS))
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"machine": {"cpus": os.cpu_count()}, "settings": {"clients_per_room": args.clients_per_room, "mode": args.mode, "seconds": args.seconds},
+                       "results": results}, f, indent=2)
+    return 1 if any(result["decode_errors"] for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
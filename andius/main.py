@@ -4,32 +4,52 @@ import sys
 import random
 import math
 import os
+import time
+import argparse
+import asyncio
+import bisect
+import hashlib
 import json # jsonモジュールを追加
-
-# ベストスコアファイルパス
-best_score_file = os.path.join(os.path.dirname(__file__), "assets", "data", "best_score.json")
-
-def load_best_score():
-    if os.path.exists(best_score_file):
-        with open(best_score_file, "r") as f:
-            return json.load(f)
-    return 0
-
-def save_best_score(score):
-    # assets/data ディレクトリが存在しない場合は作成
-    data_dir = os.path.dirname(best_score_file)
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
-    with open(best_score_file, "w") as f:
-        json.dump(score, f)
+import collections
+import concurrent.futures
+import csv
+import threading
+import numpy as np
+from replay import Replay, ReplayWriter
+from scores import ScoreStore
 
 # ゲームの定数
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 FPS = 60
+MAX_TICKS_PER_FRAME = 5 # 描画1回あたりに進めるティックの上限
 BOSS_SPAWN_COUNT = 10
 BOSS_SPAWN_TIME = 20
 BOSS_ACTIVE_HEIGHT = SCREEN_HEIGHT // 3
+SHIP_SPACING = 60 # 複数の機体で遊ぶ時に、機体を左右に並べる間隔
+COLLISION_CELL_SIZE = 64 # 当たり判定用グリッドのセルの大きさ
+GRID_MIN_PROJECTILES = 64 # 弾がこれ以下ならグリッドを使わずに全部調べる
+GRID_MIN_SPRITES = 32 # HashedGroupのスプライトがこれ以下ならグリッドを使わずに全部調べる
+DEBUG_STATS = os.environ.get("ANDIUS_DEBUG_STATS") == "1" # 終了時に統計を表示する
+WEB = sys.platform == "emscripten" # pygbagでブラウザ上で動いている
+MAX_DIRTY_RECTS = 128 # 書き換えた矩形がこれより多ければ画面全体を更新する
+if not WEB:
+    # --splitでだけ使う (ブラウザのPythonには共有メモリのモジュール (_posixshmem) がない)
+    import multiprocessing
+    import multiprocessing.shared_memory
+    import pickle
+
+# ベストスコアとプレイの記録の保存先 (ブラウザではスレッドが使えないので、run_window_asyncがフレームの合間に書く)
+score_store = ScoreStore(os.path.join(os.path.dirname(__file__), "assets", "data"), threaded=not WEB)
+
+def load_best_score():
+    return score_store.best_score() # 2回目からはファイルを読まない
+
+# 描画レイヤー (番号の小さい順に描く)
+LAYER_SPRITES = 0
+LAYER_PROJECTILES = 1
+LAYER_HUD = 2
+LAYER_COUNT = 3
 
 # 色の定義
 WHITE = (255, 255, 255)
@@ -49,6 +69,9 @@ BASE_BOSS_HEALTH = 200
 BASE_BOSS_RADIAL_ATTACK_INTERVAL = 5000
 
 # ステージごとの設定
+# "background_scroll_speed"を0にすると背景が止まり、変化した部分だけを描き直すようになる (省略時は1)
+# "background_layers"に[{"images": [...], "speed": 1, "alpha": False}, ...]を奥から順に書くと多重スクロールになる
+# (省略時はbackground_imgsとbackground_scroll_speedの1枚のレイヤー)
 STAGE_SETTINGS = {
     1: {
         "max_enemies_on_screen": int(BASE_MAX_ENEMIES_ON_SCREEN * 0.2),
@@ -92,17 +115,362 @@ STAGE_SETTINGS = {
 assets_dir = os.path.join(os.path.dirname(__file__), "assets")
 img_dir = os.path.join(assets_dir, "img")
 sound_dir = os.path.join(assets_dir, "sound")
+ATLAS_INDEX = "atlas.json" # atlas.pyが作るスプライトシートの索引 (img_dirに置く)
+
+# アセットレジストリ
+# 画像は一度だけデコード・変換・拡大縮小し、以降は共有のSurfaceを返す
+# (返されたSurfaceは共有物なので、呼び出し側で書き換えないこと)
+# 索引 (atlas.json) に載っている画像は、個別のファイルではなくスプライトシートの部分Surfaceを返す
+class AssetRegistry:
+    def __init__(self, base_dir, atlas_index=None):
+        self.base_dir = base_dir
+        self._atlas = self._load_atlas_index(atlas_index) # ファイル名 -> (シートのファイル名, 矩形)
+        self._sheets = {} # (シートのファイル名, alpha) -> 変換済みのシート (alphaがNoneのものは変換前)
+        self._decoded = {} # ファイル名 -> 起動時の読み込みでデコードしておいたSurface (変換前)
+        self._raw_images = {} # (ファイル名, alpha) -> デコード済みSurface
+        self._images = {} # (ファイル名, scale, size, colorkey, alpha) -> 加工済みSurface
+        self._lock = threading.Lock() # 先読みのスレッドがデコードした画像の受け渡し用
+        self.load_count = 0 # ディスクから読み込んだ回数
+        self.hit_count = 0 # キャッシュから返した回数
+        self.evict_count = 0 # 捨てた画像の数
+        self.blocking_load_time = 0.0 # メインスレッドが読み込みで止まった時間の累計 (秒)
+
+    def _load_atlas_index(self, atlas_index):
+        # 索引がなければ (atlas.pyを実行していなければ) 全部個別のファイルから読む
+        if atlas_index is None or not os.path.exists(os.path.join(self.base_dir, atlas_index)):
+            return {}
+        with open(os.path.join(self.base_dir, atlas_index)) as f:
+            index = json.load(f)
+        return {filename: (frame["sheet"], pygame.Rect(frame["rect"])) for filename, frame in index["frames"].items()}
+
+    # filenameを読むために実際にデコードするファイル (シートにまとめられていればシート)
+    def source(self, filename):
+        frame = self._atlas.get(filename)
+        return frame[0] if frame is not None else filename
+
+    # ファイルをデコードするだけで、変換もキャッシュもしない (別スレッドから呼んでよい)
+    def decode(self, filename):
+        return pygame.image.load(os.path.join(self.base_dir, filename))
+
+    # 別スレッドでdecode()したSurfaceを預かり、次にそのファイルが必要になった時に使う
+    def add_decoded(self, filename, surface):
+        with self._lock:
+            self._decoded[filename] = surface
+            self.load_count += 1
+
+    def _decode(self, filename):
+        surface = self._decoded.pop(filename, None)
+        if surface is None:
+            surface = self.decode(filename)
+            self.load_count += 1
+        return surface
+
+    def _sheet(self, sheet_name, alpha):
+        # 同じシートはalphaの有無に関わらず一度だけデコードし、変換だけ別々に行う
+        sheet = self._sheets.get((sheet_name, alpha))
+        if sheet is None:
+            decoded = self._sheets.get((sheet_name, None))
+            if decoded is None:
+                decoded = self._sheets[(sheet_name, None)] = self._decode(sheet_name)
+            sheet = self._sheets[(sheet_name, alpha)] = decoded.convert_alpha() if alpha else decoded.convert()
+        return sheet
+
+    def _load_raw(self, filename, alpha):
+        key = (filename, alpha)
+        surface = self._raw_images.get(key)
+        if surface is None:
+            frame = self._atlas.get(filename)
+            if frame is None:
+                surface = self._decode(filename)
+                surface = surface.convert_alpha() if alpha else surface.convert()
+            else:
+                # 各画像はシートの部分Surface (シートとピクセルを共有する) にする
+                sheet_name, rect = frame
+                surface = self._sheet(sheet_name, alpha).subsurface(rect)
+            self._raw_images[key] = surface
+        return surface
+
+    def image(self, filename, scale=None, size=None, colorkey=None, alpha=False):
+        key = (filename, scale, size, colorkey, alpha)
+        surface = self._images.get(key)
+        if surface is not None:
+            self.hit_count += 1
+            return surface
+
+        start = time.perf_counter()
+        with self._lock:
+            surface = self._images.get(key)
+            if surface is None:
+                surface = self._load_raw(filename, alpha)
+                if size is not None:
+                    surface = pygame.transform.scale(surface, size)
+                elif scale is not None:
+                    surface = pygame.transform.scale(surface, (int(surface.get_width() * scale), int(surface.get_height() * scale)))
+                elif colorkey is not None:
+                    surface = surface.copy() # 元画像のカラーキーを汚さないようにコピー
+                if colorkey is not None:
+                    surface.set_colorkey(colorkey)
+                self._images[key] = surface
+        if threading.current_thread() is threading.main_thread():
+            self.blocking_load_time += time.perf_counter() - start
+        return surface
+
+    def solid(self, size, color):
+        # 単色で塗りつぶしたSurface (弾など、同じ見た目を共有するもの用)
+        key = ("solid", size, color)
+        surface = self._images.get(key)
+        if surface is None:
+            surface = pygame.Surface(size)
+            surface.fill(color)
+            self._images[key] = surface
+        else:
+            self.hit_count += 1
+        return surface
+
+    def blank(self, size):
+        # 透明なSurface (点滅中の自機など)
+        key = ("blank", size)
+        surface = self._images.get(key)
+        if surface is None:
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            self._images[key] = surface
+        else:
+            self.hit_count += 1
+        return surface
+
+    # ファイル名で指定した画像を (加工済みのものも含めて) キャッシュから捨てる
+    def evict(self, filenames):
+        filenames = set(filenames)
+        with self._lock:
+            for cache in (self._images, self._raw_images):
+                for key in [key for key in cache if key[0] in filenames]:
+                    del cache[key]
+                    self.evict_count += 1
+            for filename in filenames & self._decoded.keys():
+                del self._decoded[filename]
+
+    def stats(self):
+        return {
+            "images": len(self._images),
+            "loads": self.load_count,
+            "sheets": sum(1 for _, alpha in self._sheets if alpha is None),
+            "hits": self.hit_count,
+            "evicted": self.evict_count,
+            "blocking_ms": self.blocking_load_time * 1000,
+        }
+
+assets = AssetRegistry(img_dir, ATLAS_INDEX)
+
+# パワーアップの種類と画像ファイルの対応
+POWERUP_IMAGES = {
+    "rapid_fire": "powerup_rapid.png",
+    "spread_shot": "powerup_spread.png",
+    "shield": "powerup_shield.png",
+    "health": "powerup_health.png",
+    "triple_shot": "powerup_triple.png",
+    "homing_missile": "powerup_homing.png",
+}
+
+# 爆発アニメーションのコマ
+EXPLOSION_IMAGES = ["regularExplosion0{}.png".format(i) for i in range(9)]
+
+# preload_images()で起動時に読む共通の画像 (atlas.pyがシートにまとめるのもこれ)
+SPRITE_IMAGES = EXPLOSION_IMAGES + list(POWERUP_IMAGES.values()) + [
+    "player.png",
+    "enemy.png",
+    "boss.png",
+    "player_homing_missile.png",
+    "shield_effect.png",
+]
+
+def player_image():
+    return assets.image("player.png", scale=0.3, colorkey=BLACK)
+
+def enemy_image():
+    return assets.image("enemy.png", scale=0.5, colorkey=BLACK)
+
+def boss_image():
+    return assets.image("boss.png", colorkey=BLACK)
+
+def powerup_image(type):
+    return assets.image(POWERUP_IMAGES[type], colorkey=BLACK)
+
+def homing_missile_image():
+    return assets.image("player_homing_missile.png", size=(5, 20), alpha=True) # サイズ調整
+
+def background_image(filename, alpha=False):
+    return assets.image(filename, size=(SCREEN_WIDTH, SCREEN_HEIGHT), alpha=alpha)
+
+# ステージの背景レイヤー (奥から順に、(画像ファイル名のタプル, スクロール速度, 透過するか))
+# 共通の画像はpreload_images()で起動時に読み、背景はそのステージに入る時 (か直前の先読み) に読む
+def stage_background_layers(settings):
+    layers = settings.get("background_layers")
+    if layers is None:
+        layers = [{"images": settings["background_imgs"], "speed": settings.get("background_scroll_speed", 1)}]
+    return [(tuple(layer["images"]), layer.get("speed", 1), layer.get("alpha", False)) for layer in layers]
+
+def shield_effect_image():
+    # プレイヤー画像 (縮小前) と同じサイズに調整、透明度を保持
+    return assets.image("shield_effect.png", size=assets.image("player.png").get_size(), alpha=True)
+
+def health_icon_image():
+    # プレイヤー体力ゲージ用アイコン
+    return assets.image("player.png", scale=0.25)
+
+def explosion_images():
+    return [assets.image(filename, scale=0.5, colorkey=BLACK) for filename in EXPLOSION_IMAGES]
+
+# フレームループ中にディスクアクセスしないよう、スプライト画像を全て先読みする
+def preload_images():
+    player_image()
+    enemy_image()
+    boss_image()
+    homing_missile_image()
+    for powerup_type in POWERUP_IMAGES:
+        powerup_image(powerup_type)
+    shield_effect_image()
+    health_icon_image()
+    explosion_images()
+
+# スプライトのオブジェクトプール
+# kill()されたスプライトを捨てずに保管し、次の生成時にspawn()で再初期化して使い回す
+class SpritePool:
+    def __init__(self, sprite_class, max_free=2048):
+        self.sprite_class = sprite_class
+        self.max_free = max_free # 保管しておく最大数
+        self.free = []
+        self.created = 0 # 新規生成した数
+        self.hits = 0 # 再利用できた回数
+        self.misses = 0 # 空きがなく新規生成した回数
+
+    def acquire(self, *args, **kwargs):
+        if self.free:
+            sprite = self.free.pop()
+            sprite.spawn(*args, **kwargs)
+            self.hits += 1
+        else:
+            sprite = self.sprite_class(*args, **kwargs)
+            self.created += 1
+            self.misses += 1
+        return sprite
+
+    def release(self, sprite):
+        if len(self.free) < self.max_free:
+            self.free.append(sprite)
+
+    def stats(self):
+        return {
+            "name": self.sprite_class.__name__,
+            "created": self.created,
+            "free": len(self.free),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+# 当たり判定用の一様グリッド (空間ハッシュ)
+# スプライトを矩形が重なるセルすべてに登録し、問い合わせでは同じセルにいるものだけを候補として返す
+class SpatialHash:
+    def __init__(self, cell_size=COLLISION_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {} # (列, 行) -> スプライトのリスト
+        self.order = {} # スプライト -> 登録順 (グループ内の順番を保つため)
+
+    def clear(self):
+        self.cells.clear()
+        self.order.clear()
+
+    def _cell_range(self, rect):
+        cs = self.cell_size
+        return rect.left // cs, max(rect.left, rect.right - 1) // cs, rect.top // cs, max(rect.top, rect.bottom - 1) // cs
+
+    def insert(self, sprite):
+        self.order[sprite] = len(self.order)
+        col0, col1, row0, row1 = self._cell_range(sprite.rect)
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                self.cells.setdefault((col, row), []).append(sprite)
+
+    def query(self, rect):
+        col0, col1, row0, row1 = self._cell_range(rect)
+        found = set() # 同じスプライトが複数のセル(抜けて再追加された場合は古い位置にも)いることがあるので重複を除く
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                found.update(self.cells.get((col, row), ()))
+        return sorted(found, key=self.order.__getitem__)
+
+# 空間ハッシュを持つスプライトグループ
+# 当たり判定の前に1フレーム1回rebuild_grid()する
+# グリッドを作るのはその後で最初に問い合わせた時で、スプライトが追加されたら次の問い合わせで作り直す
+# (当たり判定の間はスプライトが動かないので結果は同じ。問い合わせのないグループ (シールドがない時など) や
+#  ティックの合間に追加されたスプライト (撃った追尾ミサイルなど) のためにグリッドを作らずに済む)
+# スプライトが少ないうちはグリッドを作るより全部調べた方が速い。どちらでも結果はグループに追加した順になる
+class HashedGroup(pygame.sprite.Group):
+    def __init__(self, *sprites):
+        self.grid = SpatialHash()
+        self._grid_stale = True
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self._grid_stale = True
+
+    def rebuild_grid(self):
+        self._grid_stale = True
+
+    def query(self, rect):
+        # rectと重なるグループ内のスプライト (グループから外れたものは除く)
+        if len(self.spritedict) <= GRID_MIN_SPRITES:
+            return [sprite for sprite in self.spritedict if rect.colliderect(sprite.rect)]
+        if self._grid_stale:
+            self.grid.clear()
+            for sprite in self.spritedict:
+                self.grid.insert(sprite)
+            self._grid_stale = False
+        spritedict = self.spritedict
+        return [sprite for sprite in self.grid.query(rect) if sprite in spritedict and rect.colliderect(sprite.rect)]
+
+# pygame.sprite.spritecollide / groupcollide / spritecollideany と同じ結果を空間ハッシュ経由で返す
+def grid_spritecollide(sprite, group, dokill):
+    hits = group.query(sprite.rect)
+    if dokill:
+        for hit in hits:
+            hit.kill()
+    return hits
+
+def grid_groupcollide(groupa, groupb, dokilla, dokillb):
+    crashed = {}
+    for sprite in groupa.sprites():
+        hits = grid_spritecollide(sprite, groupb, dokillb)
+        if hits:
+            crashed[sprite] = hits
+            if dokilla:
+                sprite.kill()
+    return crashed
+
+# スプライトを持たない矩形と重なるスプライト
+def grid_rectcollide(rect, group, dokill):
+    hits = group.query(rect)
+    if dokill:
+        for hit in hits:
+            hit.kill()
+    return hits
+
+def grid_spritecollideany(sprite, group):
+    hits = group.query(sprite.rect)
+    return hits[0] if hits else None
 
 # プレイヤーのクラス
 class Player(pygame.sprite.Sprite):
-    def __init__(self):
+    def __init__(self, world, slot=0):
         super().__init__()
-        self.original_image = pygame.image.load(os.path.join(img_dir, "player.png")).convert()
-        self.original_image = pygame.transform.scale(self.original_image, (int(self.original_image.get_width() * 0.3), int(self.original_image.get_height() * 0.3)))
-        self.original_image.set_colorkey(BLACK)
-        self.image = self.original_image.copy()
+        self.world = world
+        self.slot = slot # 機体の番号 (1人なら0)
+        self.inputs = FrameInput() # このティックの入力 (GameWorld.stepが入れる)
+        self.emitter = PatternEmitter(world.player_projectiles, PLAYER_BULLET)
+        self.original_image = player_image()
+        self.image = self.original_image
         self.rect = self.image.get_rect()
-        self.rect.centerx = SCREEN_WIDTH // 2
+        self.rect.centerx = SCREEN_WIDTH // 2 + SHIP_SPACING * ((slot + 1) // 2) * (-1 if slot % 2 else 1) # 0は中央、1は左、2は右...
         self.rect.bottom = SCREEN_HEIGHT - 10
         self.speed_x = 0
         self.speed_y = 0
@@ -117,7 +485,7 @@ class Player(pygame.sprite.Sprite):
         self.blink_interval = 100 # 点滅間隔
         self.total_blinks = 6 # 3回点滅 (表示/非表示で2回1セット)
         self.shoot_delay = 250 # プレイヤーの初期連射間隔（ミリ秒）
-        self.last_shot_time = pygame.time.get_ticks()
+        self.last_shot_time = self.world.now()
         self.rapid_fire_active = False
         self.rapid_fire_delay = 100 # 連射強化時の連射間隔
         self.spread_shot_active = False
@@ -130,14 +498,14 @@ class Player(pygame.sprite.Sprite):
     def update(self):
         self.speed_x = 0
         self.speed_y = 0
-        keystate = pygame.key.get_pressed()
-        if keystate[pygame.K_LEFT]:
+        inputs = self.inputs
+        if inputs.left:
             self.speed_x = -5
-        if keystate[pygame.K_RIGHT]:
+        if inputs.right:
             self.speed_x = 5
-        if keystate[pygame.K_UP]:
+        if inputs.up:
             self.speed_y = -5
-        if keystate[pygame.K_DOWN]:
+        if inputs.down:
             self.speed_y = 5
 
         self.rect.x += self.speed_x
@@ -154,95 +522,81 @@ class Player(pygame.sprite.Sprite):
 
         # 点滅処理
         if self.blinking:
-            now = pygame.time.get_ticks()
+            now = self.world.now()
             if now - self.blink_timer > self.blink_interval:
                 self.blink_timer = now
                 self.blink_count += 1
                 if self.blink_count % 2 == 0:
-                    self.image = self.original_image.copy()
+                    self.image = self.original_image
                 else:
-                    self.image = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+                    self.image = assets.blank(self.rect.size)
 
                 if self.blink_count >= self.total_blinks:
                     self.blinking = False
                     self.blink_count = 0
-                    self.image = self.original_image.copy()
+                    self.image = self.original_image
 
         # 無敵時間処理
         if self.invincible:
-            now = pygame.time.get_ticks()
+            now = self.world.now()
             if now - self.invincible_timer > self.invincible_duration:
                 self.invincible = False
 
         # 連射強化時間処理
         # if self.rapid_fire_active:
-        #     now = pygame.time.get_ticks()
+        #     now = self.world.now()
         #     if now - self.rapid_fire_start_time > self.rapid_fire_duration:
         #         self.rapid_fire_active = False
 
         # 拡散ショット時間処理
         # if self.spread_shot_active:
-        #     now = pygame.time.get_ticks()
+        #     now = self.world.now()
         #     if now - self.spread_shot_start_time > self.spread_shot_duration:
         #         self.spread_shot_active = False
 
         # シールド時間処理
         if self.shield_active:
-            now = pygame.time.get_ticks()
+            now = self.world.now()
             if now - self.shield_start_time > self.shield_duration:
                 self.shield_active = False
 
     def shoot(self):
-        now = pygame.time.get_ticks()
+        now = self.world.now()
         current_shoot_delay = self.rapid_fire_delay if self.rapid_fire_active else self.shoot_delay
         if now - self.last_shot_time > current_shoot_delay:
-            bullets_to_add = []
             bullet_speed = 10 # プレイヤー弾の共通速度
+            bullet_y = self.rect.top - PLAYER_BULLET.size[1] # 弾の下端を機体の上端に合わせる
 
             # 基本の弾（常に発射されるか、他のパワーアップで上書きされる）
             # 拡散ショットが有効な場合は、3発の直進弾
             if self.spread_shot_active:
-                bullets_to_add.append(PlayerBullet(self.rect.centerx - 15, self.rect.top, speed_x=0, speed_y=-bullet_speed))
-                bullets_to_add.append(PlayerBullet(self.rect.centerx, self.rect.top, speed_x=0, speed_y=-bullet_speed))
-                bullets_to_add.append(PlayerBullet(self.rect.centerx + 15, self.rect.top, speed_x=0, speed_y=-bullet_speed))
+                self.emitter.fire("player_spread", self.rect.centerx, bullet_y, now)
             else: # 拡散ショットが有効でない場合、単発弾が基本
-                bullets_to_add.append(PlayerBullet(self.rect.centerx, self.rect.top, speed_x=0, speed_y=-bullet_speed))
+                self.world.player_projectiles.spawn(PLAYER_BULLET, self.rect.centerx, bullet_y, 0, -bullet_speed, now)
 
-            # 三方向攻撃弾が有効な場合、斜め弾を追加
+            # 三方向攻撃弾が有効な場合、左右45度の斜め弾を追加
             if self.triple_shot_active:
-                # 左斜め45度の弾
-                angle_left = math.radians(-45) # -45度
-                speed_x_left = bullet_speed * math.sin(angle_left)
-                speed_y_left = -bullet_speed * math.cos(angle_left)
-                bullets_to_add.append(PlayerBullet(self.rect.centerx - 15, self.rect.top, speed_x=speed_x_left, speed_y=speed_y_left))
-                # 右斜め45度の弾
-                angle_right = math.radians(45) # 45度
-                speed_x_right = bullet_speed * math.sin(angle_right)
-                speed_y_right = -bullet_speed * math.cos(angle_right)
-                bullets_to_add.append(PlayerBullet(self.rect.centerx + 15, self.rect.top, speed_x=speed_x_right, speed_y=speed_y_right))
-
-            # 収集した弾をスプライトグループに追加
-            for bullet in bullets_to_add:
-                all_sprites.add(bullet)
-                player_bullets.add(bullet)
+                self.emitter.fire("player_triple", self.rect.centerx, bullet_y, now)
 
             # 追尾ミサイル（通常弾とは独立して発射）
             if self.homing_missile_active:
-                missile = PlayerHomingMissile(self.rect.centerx, self.rect.top, enemies, bosses) # 敵グループとボスグループをターゲット
-                all_sprites.add(missile)
-                player_bullets.add(missile) # プレイヤーの弾グループに追加
+                world = self.world
+                missile = world.missile_pool.acquire(world, self.rect.centerx, self.rect.top) # ターゲットはworld.homing_targetsが決める
+                world.all_sprites.add(missile)
+                world.player_bullets.add(missile) # プレイヤーの弾グループに追加
 
-            shoot_sound.play()
+            self.world.audio.play("shoot")
             self.last_shot_time = now
 
     def hit(self):
         if not self.invincible:
             self.health -= 1
+            self.world.damage_taken += 1
             self.blinking = True
-            self.blink_timer = pygame.time.get_ticks()
+            self.blink_timer = self.world.now()
             self.blink_count = 0
             self.invincible = True
-            self.invincible_timer = pygame.time.get_ticks()
+            self.invincible_timer = self.world.now()
             self.rapid_fire_active = False # 被弾で連射強化解除
             self.spread_shot_active = False # 被弾で拡散ショット解除
             self.triple_shot_active = False # 被弾で三方向攻撃解除
@@ -250,144 +604,738 @@ class Player(pygame.sprite.Sprite):
 
     def activate_shield(self):
         self.shield_active = True
-        self.shield_start_time = pygame.time.get_ticks()
+        self.shield_start_time = self.world.now()
         shield_sprite = Shield(self)
-        all_sprites.add(shield_sprite)
-        shields.add(shield_sprite)
-
-# プレイヤーの弾のクラス
-class PlayerBullet(pygame.sprite.Sprite):
-    def __init__(self, x, y, speed_x=0, speed_y=-10):
-        super().__init__()
-        self.image = pygame.Surface([5, 10])
-        self.image.fill(YELLOW)
-        self.rect = self.image.get_rect()
-        self.rect.centerx = x
-        self.rect.bottom = y
-        self.speed_x = speed_x
-        self.speed_y = speed_y
-
-    def update(self):
-        self.rect.x += self.speed_x
-        self.rect.y += self.speed_y
-        if self.rect.bottom < 0 or self.rect.top > SCREEN_HEIGHT or self.rect.left > SCREEN_WIDTH or self.rect.right < 0:
-            self.kill()
-
-# 敵の弾のクラス
-class EnemyBullet(pygame.sprite.Sprite):
-    def __init__(self, x, y, speed_x=0, speed_y=5):
-        super().__init__()
-        self.image = pygame.Surface([4, 8])
-        self.image.fill(GREEN)
-        self.rect = self.image.get_rect()
-        self.rect.centerx = x
-        self.rect.top = y
-        self.speed_x = speed_x
-        self.speed_y = speed_y
-        self.out_of_bounds_time = None # 画面外に出た時刻
-        self.lifetime_after_out_of_bounds = 1000 # 画面外に出てから消えるまでの時間（ミリ秒）
-
-    def update(self):
-        self.rect.x += self.speed_x
-        self.rect.y += self.speed_y
-
-        if self.rect.top > SCREEN_HEIGHT or self.rect.bottom < 0 or self.rect.left > SCREEN_WIDTH or self.rect.right < 0:
-            if self.out_of_bounds_time is None:
-                self.out_of_bounds_time = pygame.time.get_ticks()
-            elif pygame.time.get_ticks() - self.out_of_bounds_time > self.lifetime_after_out_of_bounds:
-                self.kill()
-
-# 誘導弾のクラス
-class HomingBullet(pygame.sprite.Sprite):
-    def __init__(self, x, y, target_sprite, speed=5, turn_speed=0.05, homing_duration=1000):
-        super().__init__()
-        self.image = pygame.Surface([6, 12]) # 少し大きめの誘導弾
-        self.image.fill(PURPLE) # 誘導弾の色
-        self.rect = self.image.get_rect()
-        self.rect.centerx = x
-        self.rect.top = y
-        self.speed = speed
-        self.turn_speed = turn_speed
-        self.target_sprite = target_sprite
-        self.velocity = pygame.math.Vector2(0, self.speed) # 初期速度は下向き
+        self.world.all_sprites.add(shield_sprite)
+        self.world.shields.add(shield_sprite)
+
+# 弾の種類 (見た目と寿命、誘導の設定)
+class ProjectileKind:
+    def __init__(self, size, color, lifetime_after_out_of_bounds=None, homing_duration=0, turn_speed=0.0):
+        self.size = size
+        self.color = color
+        # 画面外に出てから消えるまでの時間（ミリ秒）。Noneなら画面外に出た時点で即消滅
+        self.lifetime_after_out_of_bounds = -1 if lifetime_after_out_of_bounds is None else lifetime_after_out_of_bounds
         self.homing_duration = homing_duration # 誘導時間（ミリ秒）
-        self.spawn_time = pygame.time.get_ticks()
-        self.out_of_bounds_time = None # 画面外に出た時刻
-        self.lifetime_after_out_of_bounds = 1000 # 画面外に出てから消えるまでの時間（ミリ秒）
-
-    def update(self):
-        current_time = pygame.time.get_ticks()
-        if current_time - self.spawn_time < self.homing_duration and self.target_sprite.alive(): # 誘導時間内かつターゲットが存在する場合のみ追尾
-            target_vector = pygame.math.Vector2(self.target_sprite.rect.center)
-            bullet_vector = pygame.math.Vector2(self.rect.center)
-            direction_to_target = (target_vector - bullet_vector).normalize()
-
-            # 緩やかに方向転換
-            self.velocity = self.velocity.lerp(direction_to_target * self.speed, self.turn_speed)
-            self.velocity.normalize_ip() # 速度を一定に保つ
-            self.velocity *= self.speed
-
-        self.rect.x += self.velocity.x
-        self.rect.y += self.velocity.y
-
-        if self.rect.top > SCREEN_HEIGHT or self.rect.bottom < 0 or self.rect.left > SCREEN_WIDTH or self.rect.right < 0:
-            if self.out_of_bounds_time is None:
-                self.out_of_bounds_time = pygame.time.get_ticks()
-            elif pygame.time.get_ticks() - self.out_of_bounds_time > self.lifetime_after_out_of_bounds:
-                self.kill()
-
-# 敵のクラス
-class Enemy(pygame.sprite.Sprite):
-    def __init__(self, initial_speed_y, initial_speed_x, bullet_speed, shoot_delay_min, shoot_delay_max):
-        super().__init__()
-        original_image = pygame.image.load(os.path.join(img_dir, "enemy.png")).convert()
-        self.image = pygame.transform.scale(original_image, (original_image.get_width() // 2, original_image.get_height() // 2))
-        self.image.set_colorkey(BLACK)
-        self.rect = self.image.get_rect()
-        self.initial_speed_y = initial_speed_y
-        self.initial_speed_x = initial_speed_x
-        self.bullet_speed = bullet_speed
-        self.shoot_delay_min = shoot_delay_min
-        self.shoot_delay_max = shoot_delay_max
-        self.reset()
-        self.last_shot_time = pygame.time.get_ticks()
-        self.shoot_delay = random.randrange(self.shoot_delay_min, self.shoot_delay_max + 1)
-
-    def update(self):
-        self.rect.x += self.speed_x
-        self.rect.y += self.speed_y
-
-        if self.rect.left < 0 or self.rect.right > SCREEN_WIDTH:
-            self.speed_x *= -1
-
-        current_time = pygame.time.get_ticks()
-        if current_time - self.last_shot_time > self.shoot_delay:
-            self.shoot()
-            self.last_shot_time = current_time
-            self.shoot_delay = random.randrange(self.shoot_delay_min, self.shoot_delay_max + 1)
-
-        if self.rect.top > SCREEN_HEIGHT + 10:
-            self.reset()
+        self.turn_speed = turn_speed # 0なら直進弾
+
+    @property
+    def image(self):
+        return assets.solid(self.size, self.color)
+
+PLAYER_BULLET = ProjectileKind((5, 10), YELLOW) # プレイヤーの弾
+ENEMY_BULLET = ProjectileKind((4, 8), GREEN, lifetime_after_out_of_bounds=1000) # 敵の弾
+HOMING_BULLET = ProjectileKind((6, 12), PURPLE, lifetime_after_out_of_bounds=1000, homing_duration=1000, turn_speed=0.05) # 誘導弾（少し大きめ）
+
+# 弾をまとめて管理するクラス
+# 1発ごとにSpriteを作らず、位置・速度・生成時刻・画面外タイマーを事前確保したNumPy配列に持ち、
+# 移動・誘導・画面外判定・消滅・当たり判定を配列演算でまとめて処理する
+class ProjectileEngine:
+    def __init__(self, kinds, capacity=1024, cell_size=COLLISION_CELL_SIZE):
+        self.kinds = list(kinds)
+        self._kind_index = {kind: i for i, kind in enumerate(self.kinds)}
+        self._kind_life = np.array([kind.lifetime_after_out_of_bounds for kind in self.kinds], dtype=np.float64)
+        self._kind_homing_duration = np.array([kind.homing_duration for kind in self.kinds], dtype=np.float64)
+        self._kind_turn_speed = np.array([kind.turn_speed for kind in self.kinds], dtype=np.float64)
+        # 当たり判定用のグリッド (弾は左上のセルにだけ登録するので、セルは弾より大きくなければならない)
+        assert all(max(kind.size) <= cell_size for kind in self.kinds)
+        self.cell_size = cell_size
+        self._grid_cols = -(-SCREEN_WIDTH // cell_size)
+        self._grid_rows = -(-SCREEN_HEIGHT // cell_size)
+        self._grid = None # (セル番号順の弾の添字, ソート済みセル番号)。弾の追加・削除で作り直す
+        self.count = 0 # 配列の先頭count個が有効 (当たって消えた弾は次のupdateまでdeadで残る)
+        self._has_dead = False # deadの弾があるか (なければupdateで配列を調べない)
+        self._homing_spawn_times = {} # 誘導弾の種類の番号 -> 最後に生成した時刻 (誘導時間を過ぎていれば誘導の計算を省く)
+        self.peak = 0 # 同時に存在した弾の最大数
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        old = getattr(self, "_arrays", None)
+        self.capacity = capacity
+        self.x = np.zeros(capacity, dtype=np.float64) # 左端
+        self.y = np.zeros(capacity, dtype=np.float64) # 上端
+        self.vx = np.zeros(capacity, dtype=np.float64)
+        self.vy = np.zeros(capacity, dtype=np.float64)
+        self.speed = np.zeros(capacity, dtype=np.float64) # 誘導弾の速さ
+        self.w = np.zeros(capacity, dtype=np.float64)
+        self.h = np.zeros(capacity, dtype=np.float64)
+        self.kind = np.zeros(capacity, dtype=np.int16)
+        self.spawn_time = np.zeros(capacity, dtype=np.float64) # 生成時刻
+        self.out_of_bounds_time = np.zeros(capacity, dtype=np.float64) # 画面外に出た時刻 (-1なら画面内)
+        self.dead = np.zeros(capacity, dtype=bool) # 当たり判定で消えた弾
+        self._arrays = (self.x, self.y, self.vx, self.vy, self.speed, self.w, self.h, self.kind, self.spawn_time, self.out_of_bounds_time, self.dead)
+        if old is not None:
+            for new_array, old_array in zip(self._arrays, old):
+                new_array[:self.count] = old_array[:self.count]
+
+    def _reserve(self, n):
+        needed = self.count + n
+        if needed > self.capacity:
+            capacity = self.capacity
+            while capacity < needed:
+                capacity *= 2
+            self._allocate(capacity)
+
+    def spawn(self, kind, x, y, speed_x, speed_y, now):
+        # x は弾の中心、y は弾の上端
+        self.spawn_many(kind, (x,), (y,), (speed_x,), (speed_y,), now)
+
+    def spawn_many(self, kind, xs, ys, speeds_x, speeds_y, now):
+        n = len(xs)
+        if n == 0:
+            return
+        self._reserve(n)
+        i, j = self.count, self.count + n
+        w, h = kind.size
+        self.x[i:j] = np.asarray(xs, dtype=np.float64) - w // 2
+        self.y[i:j] = ys
+        self.vx[i:j] = speeds_x
+        self.vy[i:j] = speeds_y
+        self.speed[i:j] = np.hypot(self.vx[i:j], self.vy[i:j])
+        self.w[i:j] = w
+        self.h[i:j] = h
+        self.kind[i:j] = self._kind_index[kind]
+        self.spawn_time[i:j] = now
+        self.out_of_bounds_time[i:j] = -1
+        self.dead[i:j] = False
+        self.count = j
+        self.peak = max(self.peak, j)
+        self._grid = None
+        if kind.turn_speed > 0:
+            self._homing_spawn_times[self._kind_index[kind]] = now
+
+    # コンパイル済みのパターンの1斉射 (Volley) を、(x, y) を基準にまとめて生成する
+    # 速度と位置のずれは表をそのまま写すだけで、三角関数も一時配列も使わない
+    def spawn_volley(self, kind, volley, x, y, now):
+        n = volley.count
+        self._reserve(n)
+        i, j = self.count, self.count + n
+        w, h = kind.size
+        np.add(volley.offset_x, x - w // 2, out=self.x[i:j])
+        np.add(volley.offset_y, y, out=self.y[i:j])
+        self.vx[i:j] = volley.vx
+        self.vy[i:j] = volley.vy
+        self.speed[i:j] = volley.speed
+        self.w[i:j] = w
+        self.h[i:j] = h
+        self.kind[i:j] = self._kind_index[kind]
+        self.spawn_time[i:j] = now
+        self.out_of_bounds_time[i:j] = -1
+        self.dead[i:j] = False
+        self.count = j
+        self.peak = max(self.peak, j)
+        self._grid = None
+        if kind.turn_speed > 0:
+            self._homing_spawn_times[self._kind_index[kind]] = now
+
+    def clear(self):
+        self.count = 0
+        self._has_dead = False
+        self._grid = None
+
+    def live_count(self):
+        return self.count - int(np.count_nonzero(self.dead[:self.count]))
+
+    def _remove(self, dead):
+        # 生存している弾だけを配列の先頭に詰め直す
+        if not dead.any():
+            return
+        keep = ~dead
+        n = self.count
+        m = int(np.count_nonzero(keep))
+        if m == n:
+            return
+        for array in self._arrays:
+            array[:m] = array[:n][keep]
+        self.count = m
+        self._grid = None
+
+    # 最後に生成した誘導弾がまだ誘導時間内か (それより前の弾も誘導時間を過ぎている)
+    def _homing_active(self, now):
+        for kind, spawn_time in self._homing_spawn_times.items():
+            if now - spawn_time < self._kind_homing_duration[kind]:
+                return True
+        return False
+
+    def update(self, now, target=None):
+        # 前のフレームで当たった弾をここでまとめて取り除く
+        if self._has_dead:
+            self._remove(self.dead[:self.count])
+            self._has_dead = False
+        n = self.count
+        if n == 0:
+            return
+        x, y, vx, vy = self.x[:n], self.y[:n], self.vx[:n], self.vy[:n]
+        w, h, kind = self.w[:n], self.h[:n], self.kind[:n]
+
+        # 誘導時間内の誘導弾をターゲットに向けて緩やかに方向転換
+        if target is not None and self._homing_active(now):
+            homing = (self._kind_turn_speed[kind] > 0) & (now - self.spawn_time[:n] < self._kind_homing_duration[kind])
+            if homing.any():
+                idx = np.flatnonzero(homing)
+                dx = target[0] - (x[idx] + w[idx] / 2)
+                dy = target[1] - (y[idx] + h[idx] / 2)
+                dist = np.hypot(dx, dy)
+                ok = dist > 0
+                idx, dx, dy, dist = idx[ok], dx[ok], dy[ok], dist[ok]
+                speed = self.speed[idx]
+                turn_speed = self._kind_turn_speed[kind[idx]]
+                new_vx = vx[idx] + (dx / dist * speed - vx[idx]) * turn_speed
+                new_vy = vy[idx] + (dy / dist * speed - vy[idx]) * turn_speed
+                norm = np.hypot(new_vx, new_vy)
+                norm[norm == 0] = 1 # 速度を一定に保つ
+                vx[idx] = new_vx / norm * speed
+                vy[idx] = new_vy / norm * speed
+
+        x += vx
+        y += vy
+        self._grid = None
+
+        # 画面外に出た弾は一定時間後に消滅
+        out_of_bounds = (y > SCREEN_HEIGHT) | (y + h < 0) | (x > SCREEN_WIDTH) | (x + w < 0)
+        if not out_of_bounds.any():
+            return
+        out_of_bounds_time = self.out_of_bounds_time[:n]
+        out_of_bounds_time[out_of_bounds & (out_of_bounds_time < 0)] = now
+        expired = out_of_bounds & (now - out_of_bounds_time > self._kind_life[kind])
+        self._remove(expired)
+
+    def _cell_coords(self, values, limit):
+        # 画面外のセルは端の外側の1列(行)にまとめる
+        return np.clip(np.floor_divide(values, self.cell_size).astype(np.int64), -1, limit) + 1
+
+    def _build_grid(self):
+        n = self.count
+        cols = self._cell_coords(self.x[:n], self._grid_cols)
+        rows = self._cell_coords(self.y[:n], self._grid_rows)
+        keys = rows * (self._grid_cols + 2) + cols
+        order = np.argsort(keys, kind="stable")
+        self._grid = (order, keys[order])
+
+    def _cell_coord(self, value, limit):
+        # _cell_coordsの1値版 (問い合わせの度にNumPy配列を作らないように)
+        return min(max(value // self.cell_size, -1), limit) + 1
+
+    def _candidates(self, rect):
+        # rectと重なりうる弾の添字。弾は左上のセルに登録されているので、1セル左上に広げて探す
+        if self.count <= GRID_MIN_PROJECTILES:
+            return np.arange(self.count) # 弾が少ないうちはグリッドを作るより全部調べた方が速い
+        if self._grid is None:
+            self._build_grid()
+        order, keys = self._grid
+        stride = self._grid_cols + 2
+        col0 = self._cell_coord(rect.left - self.cell_size, self._grid_cols)
+        col1 = self._cell_coord(rect.right - 1, self._grid_cols)
+        row0 = self._cell_coord(rect.top - self.cell_size, self._grid_rows)
+        row1 = self._cell_coord(rect.bottom - 1, self._grid_rows)
+        rows = range(row0 * stride, (row1 + 1) * stride, stride)
+        starts = keys.searchsorted([row + col0 for row in rows], side="left").tolist()
+        ends = keys.searchsorted([row + col1 for row in rows], side="right").tolist()
+        slices = [order[start:end] for start, end in zip(starts, ends) if end > start]
+        if not slices:
+            return None
+        if len(slices) == 1:
+            return np.sort(slices[0])
+        return np.sort(np.concatenate(slices))
+
+    def _hits(self, rect):
+        # rectに当たった (まだ消えていない) 弾の添字
+        if self.count == 0 or rect.width <= 0 or rect.height <= 0:
+            return None
+        idx = self._candidates(rect)
+        if idx is None:
+            return None
+        x, y = self.x[idx], self.y[idx]
+        hit = (x < rect.right) & (x + self.w[idx] > rect.left) & (y < rect.bottom) & (y + self.h[idx] > rect.top) & ~self.dead[idx]
+        idx = idx[hit]
+        return idx if len(idx) else None
+
+    def collide_sprite(self, sprite, dokill):
+        # spritecollideと同様の判定。当たった弾の数を返す
+        return self.collide_rect(sprite.rect, dokill)
+
+    def collide_rect(self, rect, dokill):
+        # スプライトを持たないもの (EnemyStoreの敵など) の矩形との判定
+        idx = self._hits(rect)
+        if idx is None:
+            return 0
+        if dokill:
+            self.dead[idx] = True
+            self._has_dead = True
+        return len(idx)
+
+    def collide_group(self, group, dokill_sprites, dokill_projectiles):
+        # groupcollideと同様の判定。弾に当たったスプライトのリストを返す
+        # (dokill_projectilesの場合、1発の弾はグループ内で最初に当たったスプライトにだけ当たる)
+        if self.count == 0:
+            return []
+        hit_sprites = []
+        for sprite in group.sprites():
+            idx = self._hits(sprite.rect)
+            if idx is not None:
+                hit_sprites.append(sprite)
+                if dokill_projectiles:
+                    self.dead[idx] = True
+                    self._has_dead = True
+        if dokill_sprites:
+            for sprite in hit_sprites:
+                sprite.kill()
+        return hit_sprites
+
+    # 消えていない弾の矩形 (left, top, right, bottom の行の配列)
+    def boxes(self):
+        n = self.count
+        if not self._has_dead:
+            x, y = self.x[:n], self.y[:n]
+            return np.column_stack((x, y, x + self.w[:n], y + self.h[:n]))
+        alive = ~self.dead[:n]
+        x, y = self.x[:n][alive], self.y[:n][alive]
+        return np.column_stack((x, y, x + self.w[:n][alive], y + self.h[:n][alive]))
+
+    # 描画用の配列 (画像のリスト, 各弾の画像の番号, x, y, 直前のティックで動いた量 dx, dy)。area (画面) の外にある弾は含めない
+    def draw_arrays(self, area):
+        n = self.count
+        images = [kind.image for kind in self.kinds]
+        x, y = self.x[:n], self.y[:n]
+        visible = ~self.dead[:n] & (x + self.w[:n] > area.left) & (x < area.right) & (y + self.h[:n] > area.top) & (y < area.bottom)
+        return images, self.kind[:n][visible], x[visible].astype(np.int32), y[visible].astype(np.int32), self.vx[:n][visible], self.vy[:n][visible]
+
+    # 描画用の(画像, 位置)のリスト
+    def blit_list(self, area):
+        return blit_list(*self.draw_arrays(area))
+
+    def stats(self):
+        return {
+            "count": self.live_count(),
+            "peak": self.peak,
+            "capacity": self.capacity,
+        }
+
+# 弾幕のパターン
+# 角度は度で、0が右、90が下 (画面の座標と同じ向き)。leadは出現位置を速度のlead倍だけ進めておく量 (整数に切り捨てる)
+#   ring: 全方位に等間隔 (count, speed, angle, lead)
+#   fan: directionの向きを中心にspreadの角度に広げ、横にspacingずつずらして並べる (count, speed, spread, spacing, direction, lead)
+#   spiral: 撃つたびにturn度ずつ回るring (count, speed, turn, lead)
+#   aimed: 標的 (プレイヤー) の向きを中心にspreadの角度に広げる。標的がなければ真下 (count, speed, spread, lead)
+#   sequence: stepsに (撃ち始めてからの時間 (ミリ秒), パターン名) を並べた時間差の連射
+BULLET_PATTERNS = {
+    "boss_ring": {"type": "ring", "count": 12, "speed": 5, "lead": 10}, # ボスの全方位弾
+    "player_spread": {"type": "fan", "count": 3, "speed": 10, "spread": 0, "spacing": 15, "direction": (0, -1)}, # 拡散ショット (3発の直進弾)
+    "player_triple": {"type": "fan", "count": 2, "speed": 10, "spread": 90, "spacing": 30, "direction": (0, -1)}, # 三方向攻撃の斜め弾
+    "boss_spiral": {"type": "spiral", "count": 6, "speed": 4, "turn": 12, "lead": 10},
+    "boss_aimed": {"type": "aimed", "count": 5, "speed": 6, "spread": 40, "lead": 10},
+    # 後半のステージ用の濃い弾幕 (STAGE_SETTINGSの"boss_radial_pattern"で指定する)
+    "boss_barrage": {"type": "sequence", "steps": [(0, "boss_ring"), (100, "boss_spiral"), (200, "boss_spiral"), (300, "boss_spiral"), (400, "boss_aimed"), (600, "boss_aimed")]},
+}
 
-    def reset(self):
-        self.rect.x = random.randrange(SCREEN_WIDTH - self.rect.width)
-        self.rect.y = random.randrange(-200, -100)
-        self.speed_y = self.initial_speed_y
-        self.speed_x = self.initial_speed_x
-        self.last_shot_time = pygame.time.get_ticks()
-        self.shoot_delay = random.randrange(self.shoot_delay_min, self.shoot_delay_max + 1)
+# 1斉射分の表 (弾ごとの速度と、基準位置からのずれ)
+class Volley:
+    def __init__(self, vx, vy, lead, offset_x=0.0, offset_y=0.0, speed=None):
+        self.vx = np.array(vx, dtype=np.float64)
+        self.vy = np.array(vy, dtype=np.float64)
+        self.count = len(self.vx)
+        self.offset_x = offset_x + np.trunc(self.vx * lead)
+        self.offset_y = offset_y + np.trunc(self.vy * lead)
+        self.speed = np.hypot(self.vx, self.vy) if speed is None else np.full(self.count, speed, dtype=np.float64)
+
+# パターンは最初に使う時に1度だけコンパイルし、以降は表を使い回す
+# volley(shot, x, y, target)は、shot回目に撃つ時の表を返す
+class RingPattern:
+    def __init__(self, count, speed, angle=0, lead=0):
+        self.table = Volley(*self.velocities(count, speed, angle), lead)
+        self.steps = [(0, self)]
+
+    @staticmethod
+    def velocities(count, speed, angle):
+        angles = 2 * np.pi * np.arange(count) / count + np.radians(angle)
+        return speed * np.cos(angles), speed * np.sin(angles)
+
+    def volley(self, shot, x, y, target):
+        return self.table
+
+class SpiralPattern:
+    def __init__(self, count, speed, turn, lead=0):
+        # 一周して同じ向きに戻るまでの分を全部作っておく
+        period = 360 // math.gcd(360, int(turn)) if turn else 1
+        self.tables = [Volley(*RingPattern.velocities(count, speed, turn * i), lead) for i in range(period)]
+        self.steps = [(0, self)]
+
+    def volley(self, shot, x, y, target):
+        return self.tables[shot % len(self.tables)]
+
+class FanPattern:
+    def __init__(self, count, speed, spread, spacing=0, direction=(0, 1), lead=0):
+        # 中心の向きdと、それを90度回した向きpで、角度aの弾の速度は speed * (cos(a) * d + sin(a) * p)
+        dx, dy = direction
+        px, py = -dy, dx
+        angles = np.radians(np.linspace(-spread / 2, spread / 2, count)) if count > 1 else np.zeros(1)
+        cos, sin = np.cos(angles), np.sin(angles)
+        shifts = (np.arange(count) - (count - 1) / 2) * spacing # 横に並べる量
+        self.table = Volley(speed * (cos * dx + sin * px), speed * (cos * dy + sin * py), lead, shifts * px, shifts * py)
+        self.steps = [(0, self)]
+
+    def volley(self, shot, x, y, target):
+        return self.table
+
+class AimedPattern:
+    def __init__(self, count, speed, spread, lead=0):
+        angles = np.radians(np.linspace(-spread / 2, spread / 2, count)) if count > 1 else np.zeros(1)
+        self.cos = speed * np.cos(angles)
+        self.sin = speed * np.sin(angles)
+        self.lead = lead
+        # 撃つたびに中身を書き換えて使い回す表
+        self.table = Volley(self.cos, self.sin, 0, speed=speed)
+        self._scratch = np.zeros(count, dtype=np.float64)
+        self.steps = [(0, self)]
+
+    def volley(self, shot, x, y, target):
+        dx, dy = (target[0] - x, target[1] - y) if target is not None else (0, 1)
+        dist = math.hypot(dx, dy)
+        ux, uy = (dx / dist, dy / dist) if dist > 0 else (0, 1)
+        table, scratch = self.table, self._scratch
+        # 標的の向き (ux, uy) を中心に、表の角度だけ回す
+        np.multiply(self.cos, ux, out=table.vx)
+        np.multiply(self.sin, uy, out=scratch)
+        np.subtract(table.vx, scratch, out=table.vx)
+        np.multiply(self.cos, uy, out=table.vy)
+        np.multiply(self.sin, ux, out=scratch)
+        np.add(table.vy, scratch, out=table.vy)
+        np.multiply(table.vx, self.lead, out=table.offset_x)
+        np.trunc(table.offset_x, out=table.offset_x)
+        np.multiply(table.vy, self.lead, out=table.offset_y)
+        np.trunc(table.offset_y, out=table.offset_y)
+        return table
+
+class SequencePattern:
+    def __init__(self, steps):
+        self.steps = [(delay, bullet_pattern(name)) for delay, name in steps]
+
+PATTERN_TYPES = {
+    "ring": RingPattern,
+    "spiral": SpiralPattern,
+    "fan": FanPattern,
+    "aimed": AimedPattern,
+    "sequence": SequencePattern,
+}
 
-    def shoot(self):
-        enemy_bullet = EnemyBullet(self.rect.centerx, self.rect.bottom, speed_y=self.bullet_speed)
-        all_sprites.add(enemy_bullet)
-        enemy_bullets.add(enemy_bullet)
+_compiled_patterns = {}
+
+def bullet_pattern(name):
+    pattern = _compiled_patterns.get(name)
+    if pattern is None:
+        settings = dict(BULLET_PATTERNS[name])
+        pattern = _compiled_patterns[name] = PATTERN_TYPES[settings.pop("type")](**settings)
+    return pattern
+
+# パターンを撃つ
+# fire()で撃ち始め、sequenceの時間差の弾はupdate()で撃つ時刻になったものから撃つ (位置はその時の発射元)
+# spiralは同じエミッターで撃った回数だけ回る
+class PatternEmitter:
+    def __init__(self, engine, kind):
+        self.engine = engine
+        self.kind = kind
+        self.pending = [] # (撃つ時刻, パターン)
+        self.shots = collections.Counter() # パターン -> 撃った回数
+
+    def fire(self, name, x, y, now, target=None):
+        for delay, pattern in bullet_pattern(name).steps:
+            if delay > 0:
+                self.pending.append((now + delay, pattern))
+            else:
+                self._spawn(pattern, x, y, now, target)
+
+    def update(self, x, y, now, target=None):
+        if not self.pending:
+            return
+        due = [item for item in self.pending if item[0] <= now]
+        if not due:
+            return
+        self.pending = [item for item in self.pending if item[0] > now]
+        for fire_time, pattern in due:
+            self._spawn(pattern, x, y, now, target)
+
+    def _spawn(self, pattern, x, y, now, target):
+        volley = pattern.volley(self.shots[pattern], x, y, target)
+        self.shots[pattern] += 1
+        self.engine.spawn_volley(self.kind, volley, x, y, now)
+
+    def clear(self):
+        self.pending = []
+
+# draw_arrays()の結果を描画用の(画像, 位置)のリストにする
+def blit_list(images, which, x, y, dx, dy):
+    return [(images[k], position) for k, position in zip(which.tolist(), zip(x.tolist(), y.tolist()))]
+
+# 配列で持つエンティティ
+# 数の多いもの (敵・爆発) は1体ごとにSpriteを作らず、成分 (位置・速度・タイマーなど) ごとに事前確保したNumPy配列に持ち、
+# 移動・射撃・寿命・アニメーションのシステムが配列をまとめて処理する (弾のProjectileEngineと同じ考え方)
+# エンティティは生成順の通し番号 (entity) で指す。配列の中は生成順に並び、消えたものはcompact()で詰めるので、entityの列は常に昇順になる
+class EntityStore:
+    def __init__(self, components, capacity=64):
+        self.components = [("entity", np.int64), ("dead", bool)] + list(components) # (成分名, 型)
+        self.count = 0 # 配列の先頭count個を使っている (消えたものは次のcompact()までdeadで残る)
+        self.live = 0 # 生きているエンティティの数
+        self.next_entity = 0
+        self.peak = 0 # 同時に存在した最大数
+        self.capacity = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        for name, dtype in self.components:
+            array = np.zeros(capacity, dtype=dtype)
+            if self.capacity:
+                array[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    # 1体分の場所を確保して、その添字を返す (成分の値は呼び出し側で入れる)
+    def _add(self):
+        if self.count == self.capacity:
+            self._allocate(self.capacity * 2)
+        i = self.count
+        self.entity[i] = self.next_entity
+        self.dead[i] = False
+        self.next_entity += 1
+        self.count += 1
+        self.live += 1
+        self.peak = max(self.peak, self.live)
+        return i
+
+    def __len__(self):
+        return self.live
+
+    # entityの今の添字 (消えていればNone)
+    # (1つの値を探すだけなので、np.searchsortedより呼び出しの軽いbisectで探す)
+    def index(self, entity):
+        n = self.count
+        i = bisect.bisect_left(self.entity, entity, 0, n)
+        if i < n and self.entity[i] == entity and not self.dead[i]:
+            return i
+        return None
+
+    def kill(self, entity):
+        i = self.index(entity)
+        if i is not None:
+            self._kill_indices([i])
+
+    def _kill_indices(self, indices):
+        self.dead[indices] = True
+        self.live = self.count - int(np.count_nonzero(self.dead[:self.count]))
+
+    # 生きているものの添字 (生成順)
+    def alive_indices(self):
+        return np.flatnonzero(~self.dead[:self.count])
+
+    def entities(self):
+        return self.entity[:self.count][~self.dead[:self.count]].tolist()
+
+    def compact(self):
+        # 生きているものだけを配列の先頭に詰め直す
+        n = self.count
+        if self.live == n:
+            return
+        keep = ~self.dead[:n]
+        for name, dtype in self.components:
+            array = getattr(self, name)
+            array[:self.live] = array[:n][keep]
+        self.count = self.live
+
+    def clear(self):
+        self.count = 0
+        self.live = 0
+
+    def stats(self):
+        return {"count": self.live, "peak": self.peak, "capacity": self.capacity}
+
+# 敵
+# 位置はpygame.Rectと同じく左上の整数座標。画像が同じなので幅と高さは全員共通
+ENEMY_COMPONENTS = [
+    ("x", np.int64), ("y", np.int64), # 位置
+    ("speed_x", np.int64), ("speed_y", np.int64), # 速度
+    ("initial_speed_x", np.int64), ("initial_speed_y", np.int64), # 画面下から戻る時の速度
+    ("bullet_speed", np.int64), ("shoot_delay_min", np.int64), ("shoot_delay_max", np.int64), # 射撃の設定
+    ("last_shot_time", np.float64), ("shoot_delay", np.int64), # 射撃のタイマー
+]
+
+class EnemyStore(EntityStore):
+    def __init__(self, world, capacity=64):
+        super().__init__(ENEMY_COMPONENTS, capacity)
+        self.world = world
+        self.random = world.rng.stream("enemy")
+        self.image = enemy_image()
+        self.width, self.height = self.image.get_size()
+
+    def spawn(self, initial_speed_y, initial_speed_x, bullet_speed, shoot_delay_min, shoot_delay_max):
+        i = self._add()
+        self.initial_speed_y[i] = initial_speed_y
+        self.initial_speed_x[i] = initial_speed_x
+        self.bullet_speed[i] = bullet_speed
+        self.shoot_delay_min[i] = shoot_delay_min
+        self.shoot_delay_max[i] = shoot_delay_max
+        now = self.world.now()
+        self._reset(i, now)
+        self.last_shot_time[i] = now
+        self.shoot_delay[i] = self._next_shoot_delay(i)
+        return int(self.entity[i])
+
+    def _next_shoot_delay(self, i):
+        return self.random.randrange(int(self.shoot_delay_min[i]), int(self.shoot_delay_max[i]) + 1)
+
+    # 画面の上に戻す
+    def _reset(self, i, now):
+        self.x[i] = self.random.randrange(SCREEN_WIDTH - self.width)
+        self.y[i] = self.random.randrange(-200, -100)
+        self.speed_y[i] = self.initial_speed_y[i]
+        self.speed_x[i] = self.initial_speed_x[i]
+        self.last_shot_time[i] = now
+        self.shoot_delay[i] = self._next_shoot_delay(i)
+
+    # 移動・射撃・画面下から戻すシステム
+    def update(self, now):
+        self.compact()
+        n = self.count
+        if n == 0:
+            return
+        x, y, speed_x = self.x[:n], self.y[:n], self.speed_x[:n]
+        x += speed_x
+        y += self.speed_y[:n]
+        speed_x[(x < 0) | (x + self.width > SCREEN_WIDTH)] *= -1 # 画面の左右で跳ね返る
+
+        shooting = now - self.last_shot_time[:n] > self.shoot_delay[:n]
+        leaving = y > SCREEN_HEIGHT + 10
+        # 乱数を使うのは撃った敵と戻る敵だけなので、その分だけ生成順に1体ずつ処理する (乱数を引く順番を保つ)
+        events = np.flatnonzero(shooting | leaving)
+        if len(events) == 0:
+            return
+        xs = []
+        ys = []
+        speeds = []
+        for i in events.tolist():
+            if shooting[i]:
+                xs.append(int(x[i]) + self.width // 2)
+                ys.append(int(y[i]) + self.height)
+                speeds.append(int(self.bullet_speed[i]))
+                self.last_shot_time[i] = now
+                self.shoot_delay[i] = self._next_shoot_delay(i)
+            if leaving[i]:
+                self._reset(i, now)
+        if xs:
+            self.world.enemy_projectiles.spawn_many(ENEMY_BULLET, xs, ys, [0] * len(xs), speeds, now)
+
+    def rect(self, i):
+        return pygame.Rect(int(self.x[i]), int(self.y[i]), self.width, self.height)
+
+    # 生きている敵の (entity, rect) のリスト (生成順)。indicesを渡すとその添字の敵だけ
+    def rects(self, indices=None):
+        if indices is None:
+            indices = self.alive_indices()
+        return [(int(self.entity[i]), self.rect(i)) for i in indices.tolist()]
+
+    # 矩形 (left, top, right, bottom の行の配列) のどれかに重なる敵の添字 (生成順)
+    # 当たり判定の前の絞り込みに使う。敵 x 矩形の表を作るので、表が大きくなりすぎないよう矩形を分けて調べる
+    def touching(self, boxes, chunk=256):
+        n = self.count
+        touched = np.zeros(n, dtype=bool)
+        if n == 0 or len(boxes) == 0:
+            return np.flatnonzero(touched)
+        x, y = self.x[:n, None], self.y[:n, None]
+        for start in range(0, len(boxes), chunk):
+            left, top, right, bottom = boxes[start:start + chunk].T
+            touched |= ((x < right) & (x + self.width > left) & (y < bottom) & (y + self.height > top)).any(axis=1)
+        return np.flatnonzero(touched & ~self.dead[:n])
+
+    # entityの中心 (消えていればNone)
+    def center(self, entity):
+        i = self.index(entity)
+        if i is None:
+            return None
+        return (int(self.x[i]) + self.width // 2, int(self.y[i]) + self.height // 2)
+
+    def centers(self):
+        idx = self.alive_indices()
+        return np.column_stack((self.x[idx] + self.width // 2, self.y[idx] + self.height // 2)).astype(np.float64)
+
+    def _overlapping(self, left, top, right, bottom):
+        n = self.count
+        x, y = self.x[:n], self.y[:n]
+        return np.flatnonzero((x < right) & (x + self.width > left) & (y < bottom) & (y + self.height > top) & ~self.dead[:n])
+
+    # rectに重なる敵の数を返す (dokillなら消す)
+    def collide_rect(self, rect, dokill):
+        idx = self._overlapping(rect.left, rect.top, rect.right, rect.bottom)
+        if dokill and len(idx):
+            self._kill_indices(idx)
+        return len(idx)
+
+    def draw_arrays(self, area):
+        idx = self._overlapping(area.left, area.top, area.right, area.bottom)
+        return [self.image], np.zeros(len(idx), dtype=np.int64), self.x[idx], self.y[idx], self.speed_x[idx], self.speed_y[idx]
+
+    def blit_list(self, area):
+        return blit_list(*self.draw_arrays(area))
+
+# 爆発
+# 中心の位置とアニメーションのコマを持ち、frame_rateミリ秒ごとに次のコマへ進め、最後のコマを過ぎたら消す
+EXPLOSION_COMPONENTS = [
+    ("center_x", np.int64), ("center_y", np.int64),
+    ("frame", np.int64), ("last_update", np.float64),
+]
+
+class ExplosionStore(EntityStore):
+    def __init__(self, frame_rate=50, capacity=64):
+        super().__init__(EXPLOSION_COMPONENTS, capacity)
+        self.frame_rate = frame_rate
+        self.frames = explosion_images()
+        sizes = np.array([image.get_size() for image in self.frames], dtype=np.int64)
+        self.frame_width, self.frame_height = sizes[:, 0], sizes[:, 1]
+
+    def spawn(self, center, now):
+        i = self._add()
+        self.center_x[i], self.center_y[i] = center
+        self.frame[i] = 0
+        self.last_update[i] = now
+        return int(self.entity[i])
+
+    # アニメーションと寿命のシステム
+    def update(self, now):
+        self.compact()
+        n = self.count
+        if n == 0:
+            return
+        frame, last_update = self.frame[:n], self.last_update[:n]
+        advancing = now - last_update > self.frame_rate
+        last_update[advancing] = now
+        frame[advancing] += 1
+        finished = np.flatnonzero(frame == len(self.frames))
+        if len(finished):
+            self._kill_indices(finished)
+
+    # frame_stepコマごとに同じ画像を続けて描き (コマ数を減らす)、limitを指定すると新しい順にその数だけ描く
+    def draw_arrays(self, area, frame_step=1, limit=None):
+        idx = self.alive_indices() # 最後のコマを過ぎて消えたものは除く
+        if limit is not None:
+            idx = idx[max(0, len(idx) - limit):]
+        frame = self.frame[idx]
+        if frame_step > 1:
+            frame = frame - frame % frame_step
+        width, height = self.frame_width[frame], self.frame_height[frame]
+        # コマの画像の中心を爆発の中心に合わせる (Rect.centerと同じ丸め方)
+        x = self.center_x[idx] - width // 2
+        y = self.center_y[idx] - height // 2
+        visible = (x < area.right) & (x + width > area.left) & (y < area.bottom) & (y + height > area.top)
+        still = np.zeros(np.count_nonzero(visible))
+        return self.frames, frame[visible], x[visible], y[visible], still, still
+
+    def blit_list(self, area, frame_step=1, limit=None):
+        return blit_list(*self.draw_arrays(area, frame_step, limit))
 
 # ボスのクラス
 class Boss(pygame.sprite.Sprite):
-    def __init__(self, initial_health, radial_attack_interval):
+    def __init__(self, world, initial_health, radial_attack_interval, radial_pattern="boss_ring"):
         super().__init__()
-        self.image = pygame.image.load(os.path.join(img_dir, "boss.png")).convert()
-        self.image.set_colorkey(BLACK)
+        self.world = world
+        self.random = world.rng.stream("boss")
+        self.image = boss_image()
         temp_rect = self.image.get_rect() # まず画像と同じサイズのrectを取得
         
         # 当たり判定のサイズを画像より小さくする (例: 幅を80%、高さを80%に)
@@ -402,11 +1350,13 @@ class Boss(pygame.sprite.Sprite):
         self.speed_y = 1
         self.speed_x = 0
         self.health = initial_health
-        self.last_shot_time = pygame.time.get_ticks()
+        self.last_shot_time = self.world.now()
         self.shoot_interval = 500
         self.active_y_pos = 50
         self.radial_attack_interval = radial_attack_interval
-        self.last_radial_attack_time = pygame.time.get_ticks()
+        self.radial_pattern = radial_pattern # 一定間隔で撃つ弾幕 (BULLET_PATTERNSの名前)
+        self.emitter = PatternEmitter(world.enemy_projectiles, ENEMY_BULLET)
+        self.last_radial_attack_time = self.world.now()
         self.homing_attack_active = False
         self.homing_attack_start_time = 0
         self.homing_attack_duration = 2000 # 2秒間誘導弾を発射
@@ -420,11 +1370,11 @@ class Boss(pygame.sprite.Sprite):
             # ボスの体力が半分以下になったら誘導弾モードをアクティブにする
             if self.health <= BASE_BOSS_HEALTH // 2 and not self.homing_attack_active:
                 self.homing_attack_active = True
-                self.homing_attack_start_time = pygame.time.get_ticks()
+                self.homing_attack_start_time = self.world.now()
 
             # 誘導弾モード中の処理
             if self.homing_attack_active:
-                current_time = pygame.time.get_ticks()
+                current_time = self.world.now()
                 if current_time - self.homing_attack_start_time < self.homing_attack_duration:
                     if current_time - self.last_homing_bullet_time > self.homing_bullet_interval:
                         self.shoot_homing_bullet()
@@ -449,84 +1399,42 @@ class Boss(pygame.sprite.Sprite):
                 self.rect.bottom = self.active_y_pos + BOSS_ACTIVE_HEIGHT
                 self.speed_y = -abs(self.speed_y) # 必ず上に動くようにする
 
-            if random.random() < 0.005:
-                self.speed_x = random.choice([-1, 1]) * random.randrange(1, 3)
-                self.speed_y = random.choice([-1, 1]) * random.randrange(1, 3)
+            if self.random.random() < 0.005:
+                self.speed_x = self.random.choice([-1, 1]) * self.random.randrange(1, 3)
+                self.speed_y = self.random.choice([-1, 1]) * self.random.randrange(1, 3)
 
-            current_time = pygame.time.get_ticks()
+            current_time = self.world.now()
             if current_time - self.last_shot_time > self.shoot_interval:
                 self.shoot()
                 self.last_shot_time = current_time
-                self.shoot_interval = random.randrange(250, 1000)
+                self.shoot_interval = self.random.randrange(250, 1000)
 
             if current_time - self.last_radial_attack_time > self.radial_attack_interval:
                 self.shoot_radial()
                 self.last_radial_attack_time = current_time
+            if self.emitter.pending:
+                self.emitter.update(self.rect.centerx, self.rect.centery, current_time, self.target()) # 時間差の弾
 
     def shoot(self):
-        enemy_bullet = EnemyBullet(self.rect.centerx, self.rect.bottom)
-        all_sprites.add(enemy_bullet)
-        enemy_bullets.add(enemy_bullet)
+        self.world.enemy_projectiles.spawn(ENEMY_BULLET, self.rect.centerx, self.rect.bottom, 0, 5, self.world.now())
 
     def shoot_radial(self):
-        num_bullets = 12
-        bullet_speed = 5
-        for i in range(num_bullets):
-            angle = 2 * math.pi * i / num_bullets
-            speed_x = bullet_speed * math.cos(angle)
-            speed_y = bullet_speed * math.sin(angle)
-            bullet = EnemyBullet(self.rect.centerx + int(speed_x * 10), self.rect.centery + int(speed_y * 10), speed_x, speed_y)
-            all_sprites.add(bullet)
-            enemy_bullets.add(bullet)
-
-    def shoot_homing_bullet(self):
-        homing_bullet = HomingBullet(self.rect.centerx, self.rect.bottom, player) # プレイヤーをターゲット
-        all_sprites.add(homing_bullet)
-        enemy_bullets.add(homing_bullet)
+        self.emitter.fire(self.radial_pattern, self.rect.centerx, self.rect.centery, self.world.now(), self.target())
 
-# 爆発のクラス
-class Explosion(pygame.sprite.Sprite):
-    def __init__(self, center):
-        super().__init__()
-        self.image = explosion_anim[0]
-        self.rect = self.image.get_rect()
-        self.rect.center = center
-        self.frame = 0
-        self.last_update = pygame.time.get_ticks()
-        self.frame_rate = 50
+    # 狙う弾の標的 (プレイヤーがいなければNone)
+    def target(self):
+        return self.world.target()
 
-    def update(self):
-        now = pygame.time.get_ticks()
-        if now - self.last_update > self.frame_rate:
-            self.last_update = now
-            self.frame += 1
-            if self.frame == len(explosion_anim):
-                self.kill()
-            else:
-                center = self.rect.center
-                self.image = explosion_anim[self.frame]
-                self.rect = self.image.get_rect()
-                self.rect.center = center
+    def shoot_homing_bullet(self):
+        # プレイヤーをターゲットにする誘導弾 (ターゲット位置はenemy_projectiles.updateで渡す)
+        self.world.enemy_projectiles.spawn(HOMING_BULLET, self.rect.centerx, self.rect.bottom, 0, 5, self.world.now())
 
 # パワーアップアイテムのクラス
 class PowerUp(pygame.sprite.Sprite):
     def __init__(self, center, type):
         super().__init__()
         self.type = type
-        if self.type == "rapid_fire":
-            self.image = pygame.image.load(os.path.join(img_dir, "powerup_rapid.png")).convert()
-        elif self.type == "spread_shot":
-            self.image = pygame.image.load(os.path.join(img_dir, "powerup_spread.png")).convert()
-        elif self.type == "shield":
-            self.image = pygame.image.load(os.path.join(img_dir, "powerup_shield.png")).convert()
-        elif self.type == "health":
-            self.image = pygame.image.load(os.path.join(img_dir, "powerup_health.png")).convert()
-        elif self.type == "triple_shot":
-            self.image = pygame.image.load(os.path.join(img_dir, "powerup_triple.png")).convert()
-        elif self.type == "homing_missile":
-            self.image = pygame.image.load(os.path.join(img_dir, "powerup_homing.png")).convert()
-        
-        self.image.set_colorkey(BLACK)
+        self.image = powerup_image(self.type)
         self.rect = self.image.get_rect()
         self.rect.center = center
         self.speed_y = 2 # アイテムの落下速度
@@ -538,50 +1446,53 @@ class PowerUp(pygame.sprite.Sprite):
 
 # プレイヤー追尾ミサイルのクラス
 class PlayerHomingMissile(pygame.sprite.Sprite):
-    def __init__(self, x, y, enemies_group, bosses_group, speed=7, turn_speed=0.1, homing_duration=1000):
+    def __init__(self, world, x, y, speed=7, turn_speed=0.1, homing_duration=1000):
         super().__init__()
-        self.original_image = pygame.image.load(os.path.join(img_dir, "player_homing_missile.png")).convert_alpha()
-        self.image = pygame.transform.scale(self.original_image, (5, 20)) # サイズ調整
+        self.image = homing_missile_image()
         self.rect = self.image.get_rect()
+        self.velocity = pygame.math.Vector2()
+        self.spawn(world, x, y, speed, turn_speed, homing_duration)
+
+    def spawn(self, world, x, y, speed=7, turn_speed=0.1, homing_duration=1000):
+        self.world = world
         self.rect.centerx = x
         self.rect.bottom = y
         self.speed = speed
         self.turn_speed = turn_speed
-        self.enemies_group = enemies_group # 敵グループ
-        self.bosses_group = bosses_group # ボスグループ
-        self.target = None
-        self.velocity = pygame.math.Vector2(0, -self.speed) # 初期速度は上向き
+        self.target = None # ターゲット (ボスのスプライトか敵のentity)。world.homing_targetsがまとめて決める
+        self.velocity.update(0, -self.speed) # 初期速度は上向き
         self.homing_duration = homing_duration # 追尾時間（ミリ秒）
-        self.spawn_time = pygame.time.get_ticks() # 生成時刻
+        self.spawn_time = self.world.now() # 生成時刻
+
+    def kill(self):
+        # プールに戻す (二重に戻さないよう、グループに属している時のみ)
+        if self.alive():
+            super().kill()
+            self.target = None # プール内でターゲットを保持し続けないように
+            self.world.missile_pool.release(self)
+
+    # ターゲットを探している最中か (追尾時間内でまだターゲットがない)
+    def seeking(self, now):
+        return self.target is None and now - self.spawn_time < self.homing_duration
+
+    # ターゲットの中心 (ターゲットがないか、消えていればNone)
+    def target_center(self):
+        target = self.target
+        if target is None:
+            return None
+        if isinstance(target, pygame.sprite.Sprite):
+            return target.rect.center if target.alive() else None
+        return self.world.enemies.center(target)
 
     def update(self):
-        current_time = pygame.time.get_ticks()
+        current_time = self.world.now()
 
         # 追尾時間内かつターゲットが存在する場合のみ追尾
-        if current_time - self.spawn_time < self.homing_duration and (self.target is None or self.target.alive()):
-            # 最も近いターゲット（ボス優先）を探す
-            if self.target is None or not self.target.alive():
-                self.target = None # ターゲットをリセット
-                
-                # ボスが存在すればボスをターゲットにする
-                if self.bosses_group:
-                    for boss in self.bosses_group:
-                        self.target = boss
-                        break # ボスは通常1体なので最初に見つけたボスをターゲット
-
-                # ボスがいない場合、またはボスがターゲットにならなかった場合、通常の敵をターゲットにする
-                if self.target is None:
-                    min_dist = float('inf')
-                    closest_enemy = None
-                    for enemy in self.enemies_group:
-                        dist = pygame.math.Vector2(self.rect.center).distance_to(enemy.rect.center)
-                        if dist < min_dist:
-                            min_dist = dist
-                            closest_enemy = enemy
-                    self.target = closest_enemy
-
-            if self.target:
-                target_vector = pygame.math.Vector2(self.target.rect.center)
+        homing = current_time - self.spawn_time < self.homing_duration
+        target_center = self.target_center() if homing else None # 追尾時間を過ぎていればターゲットを探さない
+        if homing and (self.target is None or target_center is not None):
+            if target_center is not None:
+                target_vector = pygame.math.Vector2(target_center)
                 missile_vector = pygame.math.Vector2(self.rect.center)
                 direction_to_target = (target_vector - missile_vector).normalize()
 
@@ -600,39 +1511,233 @@ class PlayerHomingMissile(pygame.sprite.Sprite):
         if self.rect.bottom < 0 or self.rect.top > SCREEN_HEIGHT or self.rect.right < 0 or self.rect.left > SCREEN_WIDTH:
             self.kill()
 
-# 背景スクロールのクラス
+# 追尾ミサイルのターゲット割り当て
+# ターゲットを探しているミサイルを1ティックにつき1回まとめて処理する
+# ボスがいればボス (通常1体なので最初のボス)、いなければpolicyに従って敵を割り当てる
+#   nearest: 一番近い敵
+#   spread: 近さに加えて、同じティックに割り当てた数の多い敵を避ける (ミサイルを敵に散らす)
+SPREAD_PENALTY = 200 # spreadで、割り当て済みのミサイル1発を何ピクセルの距離と見なすか
+
+class TargetIndex:
+    def __init__(self, policy="nearest"):
+        self.policies = {"nearest": self._nearest, "spread": self._spread}
+        self.policy = policy
+        self.queries = 0 # 割り当てたミサイル数の累計
+        self.builds = 0 # 敵の位置の表を作った回数
+
+    def assign(self, missiles, bosses, enemies, now):
+        seekers = [missile for missile in missiles if missile.seeking(now)]
+        if not seekers:
+            return
+        self.queries += len(seekers)
+        boss = next(iter(bosses), None)
+        if boss is not None:
+            for missile in seekers:
+                missile.target = boss
+            return
+        targets = enemies.entities()
+        if not targets:
+            return
+        self.builds += 1
+        enemy_centers = enemies.centers()
+        missile_centers = np.array([missile.rect.center for missile in seekers], dtype=np.float64)
+        # ミサイル x 敵の距離の表
+        distances = np.hypot(missile_centers[:, 0:1] - enemy_centers[:, 0], missile_centers[:, 1:2] - enemy_centers[:, 1])
+        for missile, index in zip(seekers, self.policies[self.policy](distances)):
+            missile.target = targets[index]
+
+    def _nearest(self, distances):
+        return distances.argmin(axis=1).tolist() # 同じ距離なら先に見つかった敵
+
+    def _spread(self, distances):
+        load = np.zeros(distances.shape[1])
+        choices = []
+        for row in distances:
+            index = int((row + load * SPREAD_PENALTY).argmin())
+            load[index] += 1
+            choices.append(index)
+        return choices
+
+# 背景の帯のキャッシュ
+# レイヤーの画像を画面サイズに拡大縮小して縦に並べた1枚のSurface (帯) にし、ステージをまたいで持っておく
+# 帯を作る (変換・blit) のは常にメインスレッドで、先読みのスレッドは画像のデコードだけを行う
+class BackgroundCache:
+    def __init__(self):
+        self._strips = {} # (ファイル名のタプル, alpha) -> 帯
+        self._ready = collections.deque() # 先読みの予定 (デコードが済んだものから、pump()で1つずつ帯にする)
+        self._wanted = set() # 最後のprefetch()で頼まれた帯 (ステージが変わって要らなくなったものは作らない)
+        self.builds = 0 # 帯を作った回数
+        self.hits = 0 # キャッシュから返した回数
+        self.prefetched = 0 # 先読みで作った帯の数
+
+    def strip(self, filenames, alpha=False):
+        key = (tuple(filenames), alpha)
+        strip = self._strips.get(key)
+        if strip is not None:
+            self.hits += 1
+            return strip
+        strip = self._strips[key] = self._build(*key)
+        self.builds += 1
+        return strip
+
+    def _build(self, filenames, alpha):
+        # 1枚目が最初に画面に映り、2枚目以降はその上に続く (帯の下から上へ並べる)
+        strip = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT * len(filenames)), pygame.SRCALPHA if alpha else 0)
+        strip = strip.convert_alpha() if alpha else strip.convert()
+        for i, filename in enumerate(filenames):
+            y = (len(filenames) - 1 - i) * SCREEN_HEIGHT
+            strip.blit(background_image(filename, alpha), (0, y), special_flags=pygame.BLEND_RGBA_MAX if alpha else 0) # 透明な帯に画素をそのまま写す
+        assets.evict(filenames) # 画素は帯に写したので、元の画像は要らない
+        return strip
+
+    # レイヤーの画像を裏でデコードしておく (ブラウザではスレッドがないので、デコードもpump()で行う)
+    def prefetch(self, layers):
+        keys = [(filenames, alpha) for filenames, speed, alpha in layers if (filenames, alpha) not in self._strips]
+        self._wanted = set(keys)
+        if not keys:
+            return
+        if WEB:
+            self._ready.extend(keys)
+            return
+        threading.Thread(target=self._decode, args=(keys,), name="background-prefetch", daemon=True).start()
+
+    # スレッドで動く
+    def _decode(self, keys):
+        for key in keys:
+            for filename in key[0]:
+                assets.add_decoded(filename, assets.decode(filename))
+            self._ready.append(key)
+
+    # 先読みした帯を1つ作る (ステージクリアの演出中に毎ティック呼ぶ)
+    def pump(self):
+        if not self._ready:
+            return
+        key = self._ready.popleft()
+        if key in self._strips or key not in self._wanted:
+            assets.evict(key[0]) # 先読みが間に合わずに作った後、またはステージが変わった後でデコードされたもの
+            return
+        self._wanted.discard(key)
+        self.strip(*key)
+        self.prefetched += 1
+
+    # layersに含まれない帯を捨てる
+    # 先読みの予定も捨てる (まだデコード中のものはpump()が捨てる)
+    def evict(self, layers):
+        keep = {(filenames, alpha) for filenames, speed, alpha in layers}
+        for key in [key for key in self._strips if key not in keep]:
+            del self._strips[key]
+        self._wanted.clear()
+        while self._ready:
+            key = self._ready.popleft()
+            if key not in self._strips:
+                assets.evict(key[0])
+
+    # layersの帯が使っているメモリ (作っていないものは0)
+    def memory(self, layers):
+        total = 0
+        for filenames, speed, alpha in layers:
+            strip = self._strips.get((filenames, alpha))
+            if strip is not None:
+                total += strip.get_pitch() * strip.get_height()
+        return total
+
+    def print_stats(self, stage_settings):
+        print("backgrounds: strips={} builds={} hits={} prefetched={}".format(len(self._strips), self.builds, self.hits, self.prefetched))
+        for number, settings in stage_settings.items():
+            layers = stage_background_layers(settings)
+            print("  stage {}: {} layers, {:.1f}MB loaded".format(number, len(layers), self.memory(layers) / (1024 * 1024)))
+
+background_cache = BackgroundCache()
+
+# 背景の1レイヤー
+# offsetは帯が画面に対して下に流れた量。画面に見えている部分 (帯の端をまたぐ時は2つ) だけを描く
+# 透過するレイヤーは、画像ごとに中身のある (透明でない) 範囲だけを描く
+class BackgroundLayer:
+    def __init__(self, strip, speed, alpha=False):
+        self.strip = strip
+        self.speed = speed
+        self.height = strip.get_height()
+        self.offset = 0
+        if alpha:
+            self.bounds = []
+            for top in range(0, self.height, SCREEN_HEIGHT):
+                bounds = strip.subsurface((0, top, SCREEN_WIDTH, SCREEN_HEIGHT)).get_bounding_rect()
+                if bounds.width and bounds.height:
+                    self.bounds.append(bounds.move(0, top))
+        else:
+            self.bounds = [strip.get_rect()]
+
+    def update(self):
+        self.offset = (self.offset + self.speed) % self.height
+
+    # 画面のyからh行分に対応する帯の範囲 (帯の行, 画面のy, 行数) のリスト (offsetを省略すると今の位置)
+    def slices(self, y, h, offset=None):
+        if offset is None:
+            offset = self.offset
+        row = (self.height - SCREEN_HEIGHT - offset + y) % self.height
+        first = min(h, self.height - row)
+        if first == h:
+            return [(row, y, h)]
+        return [(row, y, first), (0, y + first, h - first)]
+
+    # 画面のrectに映る帯の部分 (帯の範囲, 画面の位置) のリスト
+    def parts(self, rect, offset=None):
+        result = []
+        for row, y, h in self.slices(rect.y, rect.height, offset):
+            area = pygame.Rect(rect.x, row, rect.width, h)
+            for bounds in self.bounds:
+                clipped = area.clip(bounds)
+                if clipped.width and clipped.height:
+                    result.append((clipped, (clipped.x, y + clipped.y - row)))
+        return result
+
+# 背景スクロールのクラス (レイヤーを奥から順に重ねる)
 class Background:
-    def __init__(self, image_paths, scroll_speed=1):
-        self.images = [pygame.image.load(os.path.join(img_dir, path)).convert() for path in image_paths]
-        self.images = [pygame.transform.scale(img, (SCREEN_WIDTH, SCREEN_HEIGHT)) for img in self.images]
-        
-        self.rect1 = self.images[0].get_rect()
-        self.rect2 = self.images[1].get_rect()
-        
-        self.rect1.top = 0
-        self.rect2.top = -SCREEN_HEIGHT
-        
-        self.scroll_speed = scroll_speed
+    def __init__(self, layers):
+        self.layers = [BackgroundLayer(background_cache.strip(filenames, alpha), speed, alpha) for filenames, speed, alpha in layers]
+        self.area = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
 
     def update(self):
-        self.rect1.y += self.scroll_speed
-        self.rect2.y += self.scroll_speed
-        
-        if self.rect1.top >= SCREEN_HEIGHT:
-            self.rect1.top = self.rect2.top - SCREEN_HEIGHT
-        if self.rect2.top >= SCREEN_HEIGHT:
-            self.rect2.top = self.rect1.top - SCREEN_HEIGHT
+        for layer in self.layers:
+            layer.update()
+
+    def draw(self, surface, position=None):
+        self.draw_area(surface, [self.area], position)
+
+    # 画面のrectの範囲だけを描き直す (前のフレームのスプライトを消す用)
+    # positionにposition()の値を渡すと、今ではなくその時の位置で描く
+    def draw_area(self, surface, rects, position=None):
+        if position is None:
+            position = self.position()
+        blits = []
+        for layer, offset in zip(self.layers, position):
+            for rect in rects:
+                blits.extend((layer.strip, screen_position, area) for area, screen_position in layer.parts(rect, offset))
+        surface.blits(blits, False)
+
+    def position(self):
+        return tuple(layer.offset for layer in self.layers)
+
+# 描画しない時の背景 (リプレイの早送りなど)
+# 帯を作らずにBackgroundと同じようにスクロールの位置だけを進める (帯の高さは画像の枚数 x 画面の高さ)
+class BackgroundScroll:
+    def __init__(self, layers):
+        self.speeds = [speed for filenames, speed, alpha in layers]
+        self.heights = [SCREEN_HEIGHT * len(filenames) for filenames, speed, alpha in layers]
+        self.offsets = [0] * len(layers)
+
+    def update(self):
+        self.offsets = [(offset + speed) % height for offset, speed, height in zip(self.offsets, self.speeds, self.heights)]
 
-    def draw(self, surface):
-        surface.blit(self.images[0], self.rect1)
-        surface.blit(self.images[1], self.rect2)
+    def position(self):
+        return tuple(self.offsets)
 
 # シールドのクラス
 class Shield(pygame.sprite.Sprite):
     def __init__(self, player):
         super().__init__()
         self.player = player
-        self.image = shield_effect_img
+        self.image = shield_effect_image()
         self.rect = self.image.get_rect(center=player.rect.center)
 
     def update(self):
@@ -642,416 +1747,1847 @@ class Shield(pygame.sprite.Sprite):
         else:
             self.kill() # プレイヤーがいない、またはシールドが切れたら消滅
 
-# ゲームの初期化
-pygame.init()
-pygame.mixer.init()
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("シューティングゲーム")
-clock = pygame.time.Clock()
-
-# フォントの準備
-font = pygame.font.Font(None, 74)
-score_font = pygame.font.Font(None, 36)
-
-# 画像の読み込み
-player_img = pygame.image.load(os.path.join(img_dir, "player.png")).convert()
-enemy_img = pygame.image.load(os.path.join(img_dir, "enemy.png")).convert()
-boss_img = pygame.image.load(os.path.join(img_dir, "boss.png")).convert()
-
-# シールドエフェクト画像
-shield_effect_img = pygame.image.load(os.path.join(img_dir, "shield_effect.png")).convert_alpha() # 透明度を保持
-shield_effect_img = pygame.transform.scale(shield_effect_img, (int(player_img.get_width() * 1.0), int(player_img.get_height() * 1.0))) # プレイヤーと同じサイズに調整
-
-# プレイヤー体力ゲージ用アイコン
-player_health_icon = pygame.transform.scale(player_img, (player_img.get_width() // 4, player_img.get_height() // 4))
-explosion_anim = []
-for i in range(9):
-    filename = 'regularExplosion0{}.png'.format(i)
-    img = pygame.image.load(os.path.join(img_dir, filename)).convert()
-    img = pygame.transform.scale(img, (img.get_width() // 2, img.get_height() // 2))
-    img.set_colorkey(BLACK)
-    explosion_anim.append(img)
-
-# サウンドの読み込み
-shoot_sound = pygame.mixer.Sound(os.path.join(sound_dir, "shoot.wav"))
-shoot_sound.set_volume(1.0) # 最大音量に設定
-expl_sound_enemy_defeat = pygame.mixer.Sound(os.path.join(sound_dir, "expl3.wav"))
-expl_sound_enemy_defeat.set_volume(0.25) # 敵撃破音の音量をさらに50%下げる
-expl_sound_boss_defeat = pygame.mixer.Sound(os.path.join(sound_dir, "expl6.wav"))
-expl_sound_boss_defeat.set_volume(1.0) # ボス撃破音の音量は最大に維持
-expl_sounds = [expl_sound_enemy_defeat, expl_sound_boss_defeat]
-score_count_sound = pygame.mixer.Sound(os.path.join(sound_dir, "score_count.wav")) # スコアカウントアップサウンドを追加
-score_count_sound.set_volume(0.5) # スコアカウントアップ音の音量
-game_over_sound = pygame.mixer.Sound(os.path.join(sound_dir, "game_over.wav")) # ゲームオーバーサウンドを追加
-game_over_sound.set_volume(1.0) # 最大音量に設定
-pygame.mixer.music.load(os.path.join(sound_dir, "tgfcoder-FrozenJam-SeamlessLoop.ogg"))
-pygame.mixer.music.set_volume(0.4)
-
-# スプライトグループ
-all_sprites = pygame.sprite.Group()
-players = pygame.sprite.Group()
-enemies = pygame.sprite.Group()
-player_bullets = pygame.sprite.Group()
-enemy_bullets = pygame.sprite.Group()
-bosses = pygame.sprite.Group()
-explosions = pygame.sprite.Group()
-powerups = pygame.sprite.Group() # パワーアップアイテムグループを追加
-shields = pygame.sprite.Group() # シールドグループを追加
-
-# 敵が倒されたときの共通処理
-def handle_enemy_defeat(enemy):
-    global enemies_defeated, score
-    enemies_defeated += 1
-    score += 10
-    expl_sounds[0].play() # 敵撃破時にexpl3.wavを再生
-    # 敵の数が最大出現数未満の場合のみ新しい敵を生成
-    if len(enemies) < current_stage_settings["max_enemies_on_screen"]:
-        new_enemy = Enemy(random.randrange(1, 4), random.choice([-1, 1]) * random.randrange(1, 3), current_stage_settings["enemy_bullet_speed"], current_stage_settings["enemy_shoot_delay_min"], current_stage_settings["enemy_shoot_delay_max"])
-        all_sprites.add(new_enemy)
-        enemies.add(new_enemy)
-    
-    # パワーアップアイテムのドロップ判定
-    if random.random() < 1.0: # 100%の確率でドロップ
-        powerup_type = random.choice(["rapid_fire", "spread_shot", "shield", "health", "triple_shot", "homing_missile"])
-        powerup = PowerUp(enemy.rect.center, powerup_type)
-        all_sprites.add(powerup)
-        powerups.add(powerup)
-
-# ゲーム変数
-enemies_defeated = 0
-current_boss = None
-score = 0
-boss_spawn_timer = pygame.time.get_ticks()
-game_state = "playing"
-current_stage = 1
-current_stage_settings = STAGE_SETTINGS[current_stage]
-game_over_sound_played = False # ゲームオーバーサウンド再生フラグ
-best_score = load_best_score() # ベストスコアを読み込み
-is_new_best_score = False
-score_to_add = 0
-current_score_display = 0
-score_counting_start_time = 0
-score_counting_duration = 0
-score_count_interval = 0
-last_score_count_sound_time = 0
-
-# 背景の作成
-background = Background(current_stage_settings["background_imgs"])
-
-# 初期敵の生成
-for i in range(current_stage_settings["max_enemies_on_screen"]):
-    enemy = Enemy(random.randrange(1, 4), random.choice([-1, 1]) * random.randrange(1, 3), current_stage_settings["enemy_bullet_speed"], current_stage_settings["enemy_shoot_delay_min"], current_stage_settings["enemy_shoot_delay_max"])
-    all_sprites.add(enemy)
-    enemies.add(enemy)
-
-# プレイヤーの作成
-player = Player()
-all_sprites.add(player)
-players.add(player)
-
-# BGMの再生
-pygame.mixer.music.play(loops=-1)
-
-# ゲームループ
-running = True
-while running:
-    clock.tick(FPS)
-
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-        if event.type == pygame.KEYDOWN:
-            if game_state == "playing":
-                if event.key == pygame.K_SPACE:
-                    player.shoot()
-            elif game_state == "stage_cleared":
-                if event.key == pygame.K_SPACE:
-                    if current_stage + 1 in STAGE_SETTINGS:
-                        current_stage += 1
-                        current_stage_settings = STAGE_SETTINGS[current_stage]
-
-                        # 背景を新しいステージ用に再作成
-                        background = Background(current_stage_settings["background_imgs"])
-
-                        # パワーアップ状態を保存
-                        was_rapid_fire_active = player.rapid_fire_active
-                        was_spread_shot_active = player.spread_shot_active
-                        was_triple_shot_active = player.triple_shot_active
-                        was_homing_missile_active = player.homing_missile_active
-
-                        all_sprites.empty()
-                        enemies.empty()
-                        player_bullets.empty()
-                        enemy_bullets.empty()
-                        bosses.empty()
-                        
-                        player = Player()
-                        # 保存したパワーアップ状態を復元
-                        player.rapid_fire_active = was_rapid_fire_active
-                        player.spread_shot_active = was_spread_shot_active
-                        player.triple_shot_active = was_triple_shot_active
-                        player.homing_missile_active = was_homing_missile_active
-
-                        all_sprites.add(player)
-                        players.add(player)
-                        for i in range(current_stage_settings["max_enemies_on_screen"]):
-                            enemy = Enemy(random.randrange(1, 4), random.choice([-1, 1]) * random.randrange(1, 3), current_stage_settings["enemy_bullet_speed"], current_stage_settings["enemy_shoot_delay_min"], current_stage_settings["enemy_shoot_delay_max"])
-                            all_sprites.add(enemy)
-                            enemies.add(enemy)
-                        enemies_defeated = 0
-                        current_boss = None
-                        boss_spawn_timer = pygame.time.get_ticks()
-                        game_state = "playing"
-                        is_new_best_score = False # 次のステージではリセット
-                    else:
-                        game_state = "game_cleared" # 全ステージクリア
-
-            elif game_state == "game_over" or game_state == "game_cleared":
-                if event.key == pygame.K_SPACE:
-                    # ゲームをステージ1からリスタート
-                    all_sprites.empty()
-                    enemies.empty()
-                    player_bullets.empty()
-                    enemy_bullets.empty()
-                    bosses.empty()
-                    explosions.empty() # 爆発スプライトもクリア
-
-                    player = Player()
-                    all_sprites.add(player)
-                    players.add(player)
-
-                    enemies_defeated = 0
-                    current_boss = None
-                    score = 0
-                    boss_spawn_timer = pygame.time.get_ticks()
-                    game_state = "playing"
-                    current_stage = 1 # ステージを1にリセット
-                    current_stage_settings = STAGE_SETTINGS[current_stage]
-                    is_new_best_score = False # リスタート時にリセット
-
-                    # 背景をステージ1用に再作成
-                    background = Background(current_stage_settings["background_imgs"])
-
-                    # 初期敵の再生成
-                    for i in range(current_stage_settings["max_enemies_on_screen"]):
-                        enemy = Enemy(random.randrange(1, 4), random.choice([-1, 1]) * random.randrange(1, 3), current_stage_settings["enemy_bullet_speed"], current_stage_settings["enemy_shoot_delay_min"], current_stage_settings["enemy_shoot_delay_max"])
-                        all_sprites.add(enemy)
-                        enemies.add(enemy)
-
-                    pygame.mixer.music.play(loops=-1) # BGMを再開
-                    game_over_sound_played = False # フラグをリセット
-                    player.rapid_fire_active = False # リスタート時に連射強化をリセット
-                    player.spread_shot_active = False # リスタート時に拡散ショットをリセット
-                    player.triple_shot_active = False # リスタート時に三方向攻撃をリセット
-                    player.homing_missile_active = False # リスタート時に追尾ミサイルをリセット
-
-    # 更新
-    if game_state == "playing" or game_state == "exploding" or game_state == "score_counting":
-        background.update()
-        all_sprites.update()
-        if game_state == "exploding" and not explosions:
-            game_state = "game_over"
-
-    if game_state == "score_counting":
-        current_time = pygame.time.get_ticks()
-        if current_time - score_counting_start_time < score_counting_duration:
+# 文字のキャッシュ
+# (フォント, 文字列, 色)ごとにレンダリング済みのSurfaceを持ち、古いものから捨てる
+class TextCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._surfaces = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self._surfaces.get(key)
+        if surface is not None:
+            self._surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+        self.misses += 1
+        surface = font.render(text, True, color)
+        self._surfaces[key] = surface
+        if len(self._surfaces) > self.max_entries:
+            self._surfaces.popitem(last=False)
+        return surface
+
+# HUD
+# 各表示は1枚のSurfaceに合成しておき、元の値 (スコアや体力) が変わった時だけ作り直す
+# スコアの数字は1桁ずつのグリフを並べて作るので、毎フレーム変わってもフォントのレンダリングは起きない
+class Hud:
+    def __init__(self, text_cache=None):
+        self.text = text_cache if text_cache is not None else TextCache()
+        self.font = pygame.font.Font(None, 74)
+        self.score_font = pygame.font.Font(None, 36)
+        self._glyphs = {} # (フォント, 色) -> 0〜9のSurface
+        self._panels = {} # 表示名 -> (元の値, (Surface, 位置))
+        self.rebuilds = 0 # 合成し直した回数
+
+    def _panel(self, name, key, build):
+        cached = self._panels.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        panel = build()
+        self._panels[name] = (key, panel)
+        self.rebuilds += 1
+        return panel
+
+    def _digits(self, font, color):
+        glyphs = self._glyphs.get((font, color))
+        if glyphs is None:
+            glyphs = [font.render(str(digit), True, color) for digit in range(10)]
+            self._glyphs[(font, color)] = glyphs
+        return glyphs
+
+    # prefixと数値を並べた1枚のSurface
+    def _number(self, font, prefix, value, color):
+        parts = [self.text.render(font, prefix, color)]
+        digits = self._digits(font, color)
+        if value < 0:
+            parts.insert(1, self.text.render(font, "-", color))
+        parts.extend(digits[int(digit)] for digit in str(abs(value)))
+        surface = pygame.Surface((sum(part.get_width() for part in parts), max(part.get_height() for part in parts)), pygame.SRCALPHA)
+        x = 0
+        for part in parts:
+            surface.blit(part, (x, 0), special_flags=pygame.BLEND_RGBA_MAX) # 透明なSurfaceに文字の画素をそのまま写す
+            x += part.get_width()
+        return surface
+
+    # (文字のSurface, 画面上の位置のrect)のリストを、それらを全部含む1枚のSurfaceに合成する
+    def _compose(self, items):
+        bounds = items[0][1].unionall([rect for _, rect in items[1:]])
+        surface = pygame.Surface(bounds.size, pygame.SRCALPHA)
+        surface.blits([(image, rect.move(-bounds.x, -bounds.y), None, pygame.BLEND_RGBA_MAX) for image, rect in items], False)
+        return (surface, bounds.topleft)
+
+    def _lines(self, lines):
+        items = []
+        for font, text, color, dy in lines:
+            image = self.text.render(font, text, color)
+            items.append((image, image.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + dy))))
+        return self._compose(items)
+
+    # プレイ中のスコア
+    def score(self, score):
+        return self._panel("score", score, lambda: (self._number(self.score_font, "Score: ", score, WHITE), (10, 10)))
+
+    # プレイヤー体力ゲージ (体力がなければNone)
+    def health(self, health, max_health):
+        if health <= 0:
+            return None
+        return self._panel("health", (health, max_health), lambda: self._health(health, max_health))
+
+    def _health(self, health, max_health):
+        player_health_icon = health_icon_image()
+        step = player_health_icon.get_width() + 5
+        health_icon_x_start = SCREEN_WIDTH - (max_health * step) - 10 # 右端からアイコンの幅+間隔で配置
+        health_icon_y = SCREEN_HEIGHT - player_health_icon.get_height() - 10 # 下端からアイコンの高さ+間隔で配置
+        count = min(health, max_health)
+        surface = pygame.Surface((count * step - 5, player_health_icon.get_height()), pygame.SRCALPHA)
+        surface.blits([(player_health_icon, (i * step, 0)) for i in range(count)], False)
+        return (surface, (health_icon_x_start, health_icon_y))
+
+    # ステージクリア・全ステージクリアの画面
+    def result(self, title, score, is_new_best_score, prompt):
+        def build():
+            lines = [(self.font, title, GREEN, -100), (self.score_font, f"FINAL SCORE: {score}", WHITE, -30)]
+            if is_new_best_score:
+                lines.append((self.score_font, "NEW BEST SCORE!", YELLOW, 10))
+            lines.append((self.score_font, prompt, WHITE, 50))
+            return self._lines(lines)
+        return self._panel("result", (title, score, is_new_best_score, prompt), build)
+
+    # ボス撃破後のスコアのカウントアップ
+    def counting_score(self, score):
+        def build():
+            surface = self._number(self.font, "SCORE: ", score, WHITE)
+            return (surface, surface.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)).topleft)
+        return self._panel("counting_score", score, build)
+
+    def game_over(self):
+        return self._panel("game_over", None, lambda: self._lines([(self.font, "GAME OVER", RED, -30), (self.score_font, "PRESS SPACE TO RETRY", WHITE, 10)]))
+
+    def stats(self):
+        return {
+            "text_hits": self.text.hits,
+            "text_misses": self.text.misses,
+            "text_cached": len(self.text._surfaces),
+            "hud_rebuilds": self.rebuilds,
+        }
+
+# 描画パイプライン
+# GameWorld.renderが積んだ描画命令をレイヤーごとに1回のSurface.blitsでまとめて描く
+# 画面外のスプライトは描かず、背景が動いていないフレームは前のフレームから変わった部分だけを描き直して画面に反映する
+class Renderer:
+    def __init__(self, surface, dirty_tracking=True, cull=True, display=True):
+        self.surface = surface
+        self.hud = Hud()
+        self.area = surface.get_rect()
+        self.dirty_tracking = dirty_tracking # Falseなら毎フレーム全体を描き直す
+        self.cull = cull # 画面外のスプライトを省くか
+        self.display = display # 描いた結果をpygame.displayに反映するか
+        self.layers = [[] for _ in range(LAYER_COUNT)]
+        self._last_layers = None # 前のフレームの描画命令
+        self._last_rects = [] # 前のフレームで描いた矩形
+        self._background = None
+        self._background_position = None
+        self.quality = QUALITY_LEVELS[0] # 描画の品質 (QualityScalerが変える)
+
+        # 統計
+        self.frames = 0
+        self.full_frames = 0 # 画面全体を描き直したフレーム数
+        self.partial_frames = 0 # 変化した部分だけを描き直したフレーム数
+        self.skipped_frames = 0 # 何も変わらず描かなかったフレーム数
+        self.culled = 0 # 画面外で省いたスプライトの数
+        self.updated_pixels = 0 # 画面に反映したピクセル数
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    # 描画命令を積む
+    def sprites(self, layer, sprites):
+        area = self.area
+        commands = self.layers[layer]
+        for sprite in sprites:
+            image = sprite.image
+            position = sprite.rect.topleft
+            # 当たり判定のrectが画像より小さいスプライトがあるので、画像の大きさで判定する
+            if self.cull and not area.colliderect(position, image.get_size()):
+                self.culled += 1
+                continue
+            commands.append((image, position))
+
+    def blit(self, layer, image, position):
+        self.layers[layer].append((image, position))
+
+    def extend(self, layer, blits):
+        self.layers[layer].extend(blits)
+
+    # draw_arrays()を持つもの (弾・敵・爆発) をまとめて積む (optionsはdraw_arrays()に渡す)
+    def store(self, layer, store, *options):
+        self.extend(layer, store.blit_list(self.area, *options))
+
+    def _draw_layers(self, doreturn):
+        rects = []
+        for commands in self.layers:
+            if not commands:
+                continue
+            drawn = self.surface.blits(commands, doreturn)
+            if doreturn:
+                rects.extend(drawn)
+        return rects
+
+    # worldを1フレーム描く。画面に反映した矩形のリストを返す (Noneは画面全体、空なら変化なし)
+    # overlayには(Surface, 位置)を渡すと一番上に重ねる
+    def render(self, world, overlay=None):
+        start = time.perf_counter()
+        self.layers = [[] for _ in range(LAYER_COUNT)]
+        world.render(self)
+        if overlay is not None:
+            self.layers[LAYER_HUD].append(overlay)
+        background = world.background
+        position = background.position()
+        if background is self._background and self.frames % self.quality["background_interval"]:
+            position = self._background_position # 品質を下げている時は、背景のスクロールを数フレームに1回だけ画面に反映する
+
+        if not self.dirty_tracking or background is not self._background or position != self._background_position:
+            # 背景が動いたので全体を描き直す
+            background.draw(self.surface, position)
+            self._last_rects = self._draw_layers(self.dirty_tracking)
+            dirty = None
+            self.full_frames += 1
+        elif self.layers == self._last_layers:
+            dirty = []
+            self.skipped_frames += 1
+        else:
+            # 前のフレームで描いた部分を背景で消してから描き直す
+            background.draw_area(self.surface, self._last_rects, position)
+            rects = self._draw_layers(True)
+            dirty = self._last_rects + rects
+            self._last_rects = rects
+            if len(dirty) > MAX_DIRTY_RECTS:
+                dirty = None
+            self.partial_frames += 1
+        self._last_layers = self.layers
+        self._background = background
+        self._background_position = position
+
+        if self.display:
+            if dirty is None:
+                pygame.display.flip()
+            elif dirty:
+                pygame.display.update(dirty)
+        if dirty is None:
+            self.updated_pixels += self.area.width * self.area.height
+        else:
+            self.updated_pixels += sum(rect.width * rect.height for rect in dirty)
+
+        elapsed = time.perf_counter() - start
+        self.frames += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return dirty
+
+    def stats(self):
+        frames = max(self.frames, 1)
+        return {
+            "frames": self.frames,
+            "avg_ms": self.total_time / frames * 1000,
+            "max_ms": self.max_time * 1000,
+            "full": self.full_frames,
+            "partial": self.partial_frames,
+            "skipped": self.skipped_frames,
+            "culled": self.culled,
+            "pixels": self.updated_pixels // frames,
+        }
+
+    def print_stats(self):
+        print("render: frames={frames} avg={avg_ms:.2f}ms max={max_ms:.2f}ms full={full} partial={partial} skipped={skipped} culled={culled} pixels/frame={pixels}".format(**self.stats()))
+        print("hud: text hits={text_hits} misses={text_misses} cached={text_cached} rebuilds={hud_rebuilds}".format(**self.hud.stats()))
+
+# フレームごとの計測
+# フェーズごとの時間とグループごとのエンティティ数を、直近sizeフレーム分だけリングバッファに残す
+# フェーズの時間は、直前のmark()からの経過時間をそのフェーズに足していく
+PROFILE_PHASES = ("wait", "events", "update", "collision", "render")
+PROFILE_COUNTS = ("ticks", "sprites", "enemies", "explosions", "powerups", "missiles", "player_projectiles", "enemy_projectiles", "quality")
+
+class FrameProfiler:
+    def __init__(self, size=3600):
+        self.size = size
+        self.times = np.zeros((size, len(PROFILE_PHASES))) # 秒
+        self.counts = np.zeros((size, len(PROFILE_COUNTS)), dtype=np.int32)
+        self.frames = 0 # 記録したフレーム数の累計
+        self.overlay_visible = False
+        self._phase_index = {phase: i for i, phase in enumerate(PROFILE_PHASES)}
+        self._row = np.zeros(len(PROFILE_PHASES))
+        self._last = time.perf_counter()
+        self._overlay = None
+        self._font = None
+
+    def begin_frame(self):
+        self._row[:] = 0
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self._row[self._phase_index[phase]] += now - self._last
+        self._last = now
+
+    def end_frame(self, world, ticks=1, quality=0):
+        slot = self.frames % self.size
+        self.times[slot] = self._row
+        self.counts[slot] = (
+            ticks,
+            len(world.all_sprites),
+            len(world.enemies),
+            len(world.explosions),
+            len(world.powerups),
+            len(world.player_bullets),
+            world.player_projectiles.live_count(),
+            world.enemy_projectiles.live_count(),
+            quality,
+        )
+        self.frames += 1
+
+    # 古い順に並べた記録
+    def _ordered(self, array):
+        if self.frames <= self.size:
+            return array[:self.frames]
+        slot = self.frames % self.size
+        return np.concatenate((array[slot:], array[:slot]))
+
+    # フェーズごと (と合計) のp50/p95/p99 (ミリ秒)
+    def percentiles(self):
+        times = self._ordered(self.times)
+        if len(times) == 0:
+            return {}
+        times = np.column_stack((times, times.sum(axis=1))) * 1000
+        p50, p95, p99 = np.percentile(times, [50, 95, 99], axis=0)
+        return {name: (p50[i], p95[i], p99[i]) for i, name in enumerate(PROFILE_PHASES + ("total",))}
+
+    # 画面右上に出す統計 (30フレームごとに作り直す)
+    def overlay(self):
+        if not self.overlay_visible or self.frames == 0:
+            return None
+        if self._overlay is None or self.frames % 30 == 0:
+            if self._font is None:
+                self._font = pygame.font.Font(None, 20)
+            lines = ["{:<9}{:>6}{:>6}{:>6}".format("ms", "p50", "p95", "p99")]
+            for name, values in self.percentiles().items():
+                lines.append("{:<9}{:>6.2f}{:>6.2f}{:>6.2f}".format(name, *values))
+            counts = self.counts[(self.frames - 1) % self.size]
+            lines.append("enemies {} bullets {}".format(counts[2], counts[6] + counts[7]))
+            lines.append("quality {}".format(QUALITY_LEVELS[counts[8]]["name"]))
+            images = [self._font.render(line, True, WHITE) for line in lines]
+            width = max(image.get_width() for image in images) + 8
+            height = sum(image.get_height() for image in images) + 8
+            surface = pygame.Surface((width, height), pygame.SRCALPHA)
+            surface.fill((0, 0, 0, 160))
+            y = 4
+            for image in images:
+                surface.blit(image, (4, y))
+                y += image.get_height()
+            self._overlay = (surface, (SCREEN_WIDTH - width - 4, 40))
+        return self._overlay
+
+    # 記録をファイルに書き出す (拡張子が.jsonならJSON、それ以外はCSV)
+    def export(self, path):
+        times = self._ordered(self.times) * 1000
+        counts = self._ordered(self.counts)
+        first = self.frames - len(times)
+        if path.endswith(".json"):
+            data = {
+                "phases": PROFILE_PHASES,
+                "counts": PROFILE_COUNTS,
+                "percentiles": {name: dict(zip(("p50", "p95", "p99"), values)) for name, values in self.percentiles().items()},
+                "frames": [
+                    {"frame": first + i, "ms": dict(zip(PROFILE_PHASES, row)), "counts": dict(zip(PROFILE_COUNTS, count_row))}
+                    for i, (row, count_row) in enumerate(zip(times.tolist(), counts.tolist()))
+                ],
+            }
+            with open(path, "w") as f:
+                json.dump(data, f, indent=1)
+        else:
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(("frame",) + tuple(phase + "_ms" for phase in PROFILE_PHASES) + PROFILE_COUNTS)
+                for i, (row, count_row) in enumerate(zip(times.tolist(), counts.tolist())):
+                    writer.writerow([first + i] + ["{:.4f}".format(value) for value in row] + count_row)
+
+    def print_stats(self):
+        for name, (p50, p95, p99) in self.percentiles().items():
+            print("{}: p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms".format(name, p50, p95, p99))
+
+# 計測しない時の代わり (何もしない)
+class NullProfiler:
+    overlay_visible = False
+
+    def begin_frame(self):
+        pass
+
+    def mark(self, phase):
+        pass
+
+    def end_frame(self, world, ticks=1, quality=0):
+        pass
+
+    def overlay(self):
+        return None
+
+# 描画の品質の段階 (0が最高)。下げるのは見た目だけで、シミュレーションの結果は変わらない
+#   background_interval: 背景のスクロールを何フレームに1回画面に反映するか (反映しないフレームは画面全体を描き直さずに済む)
+#   explosion_frame_step: 爆発のアニメーションを何コマずつまとめて描くか
+#   max_explosions: 同時に描く爆発の数の上限 (新しいものを優先する。Noneは無制限)
+QUALITY_LEVELS = [
+    {"name": "high", "background_interval": 1, "explosion_frame_step": 1, "max_explosions": None},
+    {"name": "medium", "background_interval": 2, "explosion_frame_step": 1, "max_explosions": 32},
+    {"name": "low", "background_interval": 2, "explosion_frame_step": 2, "max_explosions": 12},
+    {"name": "lowest", "background_interval": 4, "explosion_frame_step": 3, "max_explosions": 4},
+]
+
+# 描画の品質の自動調整
+# 直近windowフレームの処理時間 (待ち時間を除く) のp90が予算のdowngrade_ratio倍を超えたら品質を1段下げ、
+# upgrade_ratio倍を下回る状態がupgrade_frames続いたら1段上げる。変えた直後のwindowフレームは様子を見る
+# fixed=Trueなら段階を変えない (--qualityで段階を指定した時)
+class QualityScaler:
+    def __init__(self, budget_ms=1000 / FPS, level=0, fixed=False, window=30, downgrade_ratio=0.9, upgrade_ratio=0.5, upgrade_frames=180):
+        self.budget_ms = budget_ms # 1フレームの予算
+        self.level = level
+        self.fixed = fixed
+        self.window = window
+        self.downgrade_ratio = downgrade_ratio
+        self.upgrade_ratio = upgrade_ratio
+        self.upgrade_frames = upgrade_frames
+        self.samples = collections.deque(maxlen=window) # 直近のフレームの処理時間 (ミリ秒)
+        self.calm_frames = 0 # 余裕のある状態が続いているフレーム数
+
+        # 統計
+        self.downgrades = 0
+        self.upgrades = 0
+        self.frames_at_level = [0] * len(QUALITY_LEVELS)
+
+    @property
+    def settings(self):
+        return QUALITY_LEVELS[self.level]
+
+    @property
+    def name(self):
+        return self.settings["name"]
+
+    # 1フレームの処理時間を記録し、必要なら段階を変える (変えたらTrue)
+    def observe(self, work_ms):
+        self.frames_at_level[self.level] += 1
+        if self.fixed:
+            return False
+        samples = self.samples
+        samples.append(work_ms)
+        if len(samples) < self.window:
+            return False
+        p90 = sorted(samples)[len(samples) * 9 // 10]
+        if p90 > self.budget_ms * self.downgrade_ratio:
+            self.calm_frames = 0
+            if self.level + 1 < len(QUALITY_LEVELS):
+                self._change(1)
+                self.downgrades += 1
+                return True
+        elif p90 < self.budget_ms * self.upgrade_ratio:
+            self.calm_frames += 1
+            if self.calm_frames >= self.upgrade_frames and self.level > 0:
+                self._change(-1)
+                self.upgrades += 1
+                return True
+        else:
+            self.calm_frames = 0
+        return False
+
+    def _change(self, step):
+        self.level += step
+        self.samples.clear()
+        self.calm_frames = 0
+
+    def apply(self, renderer):
+        renderer.quality = self.settings
+
+    def stats(self):
+        return {
+            "level": self.level,
+            "name": self.name,
+            "downgrades": self.downgrades,
+            "upgrades": self.upgrades,
+            "frames": dict(zip((level["name"] for level in QUALITY_LEVELS), self.frames_at_level)),
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        frames = " ".join("{}={}".format(name, count) for name, count in stats["frames"].items())
+        print("quality: {name} downgrades={downgrades} upgrades={upgrades} ".format(**stats) + "frames: " + frames)
+
+# --qualityの値 ("auto"か段階の名前) から作る
+def quality_scaler(quality, budget_ms=1000 / FPS):
+    if quality == "auto":
+        return QualityScaler(budget_ms)
+    names = [level["name"] for level in QUALITY_LEVELS]
+    return QualityScaler(budget_ms, names.index(quality), fixed=True)
+
+# サウンドの管理
+# 効果音はグループごとに決まったチャンネルだけを使い、空きがなければ優先度の低い音を止めて鳴らす
+# 同じ音がmin_interval以内に続いた時は新しく鳴らさずに1つにまとめる
+AUDIO_CHANNEL_GROUPS = {
+    "important": 2, # ボス撃破・ゲームオーバー (他の音に止められない)
+    "weapons": 3,
+    "effects": 4,
+    "ui": 2,
+}
+
+# 名前: (ファイル名, 音量, グループ, 優先度, 最短の間隔 (ミリ秒))
+SOUND_SETTINGS = {
+    "shoot": ("shoot.wav", 1.0, "weapons", 1, 60), # 最大音量に設定
+    "enemy_defeat": ("expl3.wav", 0.25, "effects", 2, 40), # 敵撃破音の音量をさらに50%下げる
+    "boss_defeat": ("expl6.wav", 1.0, "important", 10, 0), # ボス撃破音の音量は最大に維持
+    "score_count": ("score_count.wav", 0.5, "ui", 1, 80), # スコアカウントアップ音の音量
+    "game_over": ("game_over.wav", 1.0, "important", 10, 0), # 最大音量に設定
+}
+
+# soundsには起動時の読み込みでデコードしておいた音 (名前 -> Sound) を渡せる (足りない分はここで読む)
+class GameAudio:
+    def __init__(self, sounds=None):
+        sounds = sounds or {}
+        self.sounds = {}
+        for name, (filename, volume, group, priority, min_interval) in SOUND_SETTINGS.items():
+            sound = sounds.get(name)
+            if sound is None:
+                sound = pygame.mixer.Sound(os.path.join(sound_dir, filename))
+            sound.set_volume(volume)
+            self.sounds[name] = sound
+
+        # グループごとにチャンネルを割り当て、pygameが自動で選ぶチャンネルからは外す
+        total = sum(AUDIO_CHANNEL_GROUPS.values())
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), total))
+        pygame.mixer.set_reserved(total)
+        self.groups = {}
+        index = 0
+        for group, count in AUDIO_CHANNEL_GROUPS.items():
+            self.groups[group] = [pygame.mixer.Channel(i) for i in range(index, index + count)]
+            index += count
+        self.voices = {} # チャンネル -> (優先度, 鳴らし始めた時刻)
+        self.last_played = {} # 名前 -> 最後に鳴らした時刻 (ミリ秒)
+        self.counters = {name: {"played": 0, "merged": 0, "stolen": 0, "dropped": 0} for name in SOUND_SETTINGS}
+
+        pygame.mixer.music.load(os.path.join(sound_dir, "tgfcoder-FrozenJam-SeamlessLoop.ogg"))
+        pygame.mixer.music.set_volume(0.4)
+
+    def play(self, name):
+        filename, volume, group, priority, min_interval = SOUND_SETTINGS[name]
+        counters = self.counters[name]
+        now = time.perf_counter() * 1000
+        last = self.last_played.get(name)
+        if last is not None and now - last < min_interval:
+            counters["merged"] += 1 # 直前に鳴らした音にまとめる
+            return
+
+        channel = None
+        victim = None
+        for candidate in self.groups[group]:
+            if not candidate.get_busy():
+                channel = candidate
+                break
+            voice = self.voices.get(candidate, (0, 0))
+            if victim is None or voice < self.voices.get(victim, (0, 0)):
+                victim = candidate # 優先度が一番低く、一番古い音
+        if channel is None:
+            if self.voices.get(victim, (0, 0))[0] > priority:
+                counters["dropped"] += 1
+                return
+            victim.stop()
+            channel = victim
+            counters["stolen"] += 1
+
+        channel.play(self.sounds[name])
+        self.voices[channel] = (priority, now)
+        self.last_played[name] = now
+        counters["played"] += 1
+
+    def play_music(self):
+        pygame.mixer.music.play(loops=-1)
+
+    def stop_music(self):
+        pygame.mixer.music.stop()
+
+    def print_stats(self):
+        for name, counters in self.counters.items():
+            print("sound {}: played={played} merged={merged} stolen={stolen} dropped={dropped}".format(name, **counters))
+
+# 音を鳴らさない (ヘッドレス実行用)
+class NullAudio:
+    def play(self, name):
+        pass
+
+    def play_music(self):
+        pass
+
+    def stop_music(self):
+        pass
+
+    def print_stats(self):
+        pass
+
+# シミュレーション用の時計
+# 実時間ではなく、step()ごとに固定の時間だけ進む
+class SimClock:
+    def __init__(self, tick_ms=1000 / FPS):
+        self.tick_ms = tick_ms # 1ティックの長さ（ミリ秒）
+        self.ticks = 0
+
+    def advance(self):
+        self.ticks += 1
+
+    def now(self):
+        return self.ticks * self.tick_ms
+
+# サブシステムごとの乱数列
+# 同じシードからは常に同じ乱数列が得られ、あるサブシステムで乱数を使う回数が変わっても他に影響しない
+class RandomStreams:
+    def __init__(self, seed=None):
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self._streams = {}
+
+    def stream(self, name):
+        rng = self._streams.get(name)
+        if rng is None:
+            rng = self._streams[name] = random.Random("{}:{}".format(self.seed, name))
+        return rng
+
+# 入力のビット
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_UP = 4
+INPUT_DOWN = 8
+INPUT_FIRE = 16
+
+# 1フレーム分の入力
+class FrameInput:
+    def __init__(self, left=False, right=False, up=False, down=False, fire=False):
+        self.left = left
+        self.right = right
+        self.up = up
+        self.down = down
+        self.fire = fire # このフレームでSPACEが押されたか
+
+    @classmethod
+    def from_keys(cls, keystate, fire):
+        return cls(keystate[pygame.K_LEFT], keystate[pygame.K_RIGHT], keystate[pygame.K_UP], keystate[pygame.K_DOWN], fire)
+
+    # リプレイ用のビットマスク表現
+    def to_bits(self):
+        return (INPUT_LEFT if self.left else 0) | (INPUT_RIGHT if self.right else 0) | (INPUT_UP if self.up else 0) | (INPUT_DOWN if self.down else 0) | (INPUT_FIRE if self.fire else 0)
+
+    @classmethod
+    def from_bits(cls, bits):
+        return cls(bool(bits & INPUT_LEFT), bool(bits & INPUT_RIGHT), bool(bits & INPUT_UP), bool(bits & INPUT_DOWN), bool(bits & INPUT_FIRE))
+
+# ゲーム全体の状態
+# step(inputs)で1ティック進め、render(renderer)で描画命令を積む。ウィンドウや音がなくても動く
+# 時刻はclock、乱数はrngからだけ取るので、同じシードと入力からは常に同じ結果になる
+class GameWorld:
+    def __init__(self, audio=None, persist_best_score=True, clock=None, seed=None, stage_settings=None, start_stage=1, draw_background=True):
+        self.audio = audio if audio is not None else NullAudio()
+        self.profiler = NullProfiler() # 計測する時はFrameProfilerに差し替える
+        self.stage_settings = stage_settings if stage_settings is not None else STAGE_SETTINGS # ステージごとの設定 (調整用に差し替えられる)
+        self.clock = clock if clock is not None else SimClock()
+        self.rng = RandomStreams(seed)
+        self.persist_best_score = persist_best_score # ベストスコアをファイルに保存するか
+        self.draw_background = draw_background # Falseなら背景の帯を作らず、スクロールの位置だけを進める
+        self.frame_count = 0
+
+        # 弾の管理
+        self.player_projectiles = ProjectileEngine([PLAYER_BULLET])
+        self.enemy_projectiles = ProjectileEngine([ENEMY_BULLET, HOMING_BULLET])
+        self.missile_pool = SpritePool(PlayerHomingMissile)
+        self.homing_targets = TargetIndex()
+
+        # 配列で持つエンティティ (数の多いもの)
+        self.enemies = EnemyStore(self)
+        self.explosions = ExplosionStore()
+
+        # スプライトグループ
+        self.all_sprites = pygame.sprite.Group()
+        self.players = HashedGroup()
+        self.player_bullets = HashedGroup() # 追尾ミサイル (通常弾はplayer_projectilesで管理)
+        self.bosses = HashedGroup()
+        self.powerups = HashedGroup() # パワーアップアイテムグループを追加
+        self.shields = HashedGroup() # シールドグループを追加
+        self.collision_groups = [self.players, self.player_bullets, self.bosses, self.powerups, self.shields] # 当たり判定で空間ハッシュを使うグループ
+
+        # ゲーム変数
+        self.enemies_defeated = 0
+        self.current_boss = None
+        self.score = 0
+        self.boss_spawn_timer = self.now()
+        self.game_state = "playing"
+        self.current_stage = start_stage
+        self.current_stage_settings = self.stage_settings[self.current_stage]
+        self.damage_taken = 0 # 被弾回数の累計
+        self.boss_spawn_tick = None # 今のステージでボスが出現したティック
+        self.game_over_sound_played = False # ゲームオーバーサウンド再生フラグ
+        self.best_score = load_best_score() if persist_best_score else 0 # ベストスコアを読み込み
+        self.is_new_best_score = False
+        self.score_to_add = 0
+        self.current_score_display = 0
+        self.score_counting_start_time = 0
+        self.score_counting_duration = 0
+        self.score_count_interval = 0
+        self.last_score_count_sound_time = 0
+
+        # 背景の作成
+        self.load_stage_assets()
+
+        # 初期敵の生成
+        self.spawn_initial_enemies()
+
+        # プレイヤーの作成
+        self.ships = {} # 機体の番号 -> Player (coopでは参加者ごとに1機。self.playerは最初の機体)
+        self.spawn_ships([0])
+
+        # BGMの再生
+        self.audio.play_music()
+
+    # 今のステージの背景を作る
+    # 背景の帯は、今のステージとリスタートで戻るステージ1の分だけを残して捨てる
+    def load_stage_assets(self):
+        layers = stage_background_layers(self.current_stage_settings)
+        if not self.draw_background:
+            self.background = BackgroundScroll(layers)
+            return
+        self.background = Background(layers)
+        background_cache.evict(layers + stage_background_layers(self.stage_settings[1]))
+
+    # 次のステージの背景を裏で作っておく (ステージクリアの演出中に呼ぶ)
+    def prefetch_next_stage(self):
+        settings = self.stage_settings.get(self.current_stage + 1)
+        if settings is not None and self.draw_background:
+            background_cache.prefetch(stage_background_layers(settings))
+
+    def now(self):
+        # ゲーム内の現在時刻（ミリ秒）
+        return self.clock.now()
+
+    # slotsの番号の機体を作り直す (previousに前の機体があれば、パワーアップ状態を引き継ぐ)
+    def spawn_ships(self, slots, previous=None):
+        self.players.empty() # ステージの終わりに生きていた機体をグループに残さない
+        self.ships = {}
+        for slot in slots:
+            ship = self.ships[slot] = Player(self, slot)
+            old = previous.get(slot) if previous is not None else None
+            if old is not None:
+                ship.rapid_fire_active = old.rapid_fire_active
+                ship.spread_shot_active = old.spread_shot_active
+                ship.triple_shot_active = old.triple_shot_active
+                ship.homing_missile_active = old.homing_missile_active
+            self.all_sprites.add(ship)
+            self.players.add(ship)
+        self.player = self.ships[slots[0]]
+
+    # 機体を1機増やし、その番号を返す (coopで参加者が増えた時)
+    def add_player(self):
+        slot = 0
+        while slot in self.ships:
+            slot += 1
+        ship = self.ships[slot] = Player(self, slot)
+        self.all_sprites.add(ship)
+        self.players.add(ship)
+        return slot
+
+    # 機体を取り除く (coopで参加者が抜けた時)
+    def remove_player(self, slot):
+        ship = self.ships.pop(slot)
+        if ship.alive():
+            ship.kill()
+            if not self.players and self.game_state == "playing":
+                self.audio.stop_music()
+                self.game_state = "exploding" # 最後の機体が抜けたら、全機やられた時と同じように終わる
+        if self.ships:
+            self.player = next(iter(self.ships.values()))
+
+    # 敵が狙う位置 (生きている機体のうち最初のものの中心。いなければNone)
+    def target(self):
+        for ship in self.ships.values():
+            if ship.alive():
+                return ship.rect.center
+        return None
+
+    def spawn_enemy(self):
+        settings = self.current_stage_settings
+        spawn_random = self.rng.stream("spawn")
+        self.enemies.spawn(spawn_random.randrange(1, 4), spawn_random.choice([-1, 1]) * spawn_random.randrange(1, 3), settings["enemy_bullet_speed"], settings["enemy_shoot_delay_min"], settings["enemy_shoot_delay_max"])
+
+    def spawn_initial_enemies(self):
+        for i in range(self.current_stage_settings["max_enemies_on_screen"]):
+            self.spawn_enemy()
+
+    # 敵が倒されたときの共通処理 (centerは倒された敵の中心)
+    def handle_enemy_defeat(self, center):
+        self.enemies_defeated += 1
+        self.score += 10
+        self.audio.play("enemy_defeat") # 敵撃破時にexpl3.wavを再生
+        # 敵の数が最大出現数未満の場合のみ新しい敵を生成
+        if len(self.enemies) < self.current_stage_settings["max_enemies_on_screen"]:
+            self.spawn_enemy()
+
+        # パワーアップアイテムのドロップ判定
+        drop_random = self.rng.stream("drops")
+        if drop_random.random() < 1.0: # 100%の確率でドロップ
+            powerup_type = drop_random.choice(["rapid_fire", "spread_shot", "shield", "health", "triple_shot", "homing_missile"])
+            powerup = PowerUp(center, powerup_type)
+            self.all_sprites.add(powerup)
+            self.powerups.add(powerup)
+
+    # rectに当たったプレイヤーの弾(通常弾とミサイル)を消し、その数を返す
+    def player_shot_hits(self, rect):
+        return self.player_projectiles.collide_rect(rect, True) + len(grid_rectcollide(rect, self.player_bullets, True))
+
+    # スプライトの矩形 (left, top, right, bottom の行の配列)
+    @staticmethod
+    def sprite_boxes(sprites):
+        return np.array([(sprite.rect.left, sprite.rect.top, sprite.rect.right, sprite.rect.bottom) for sprite in sprites], dtype=np.float64).reshape(-1, 4)
+
+    # 画面上の弾を全て消す (ミサイルはkill()でプールに戻る)
+    def clear_projectiles(self):
+        self.player_projectiles.clear()
+        self.enemy_projectiles.clear()
+        for missile in self.player_bullets.sprites():
+            missile.kill()
+
+    # プレイヤーがやられた時の処理 (全機やられたらゲームオーバー。coopでは残った機体で続ける)
+    def kill_player(self, p):
+        self.explosions.spawn(p.rect.center, self.now())
+        p.kill()
+        if not self.players:
+            self.audio.stop_music()
+            self.game_state = "exploding"
+        self.audio.play("enemy_defeat") # プレイヤー撃破時にexpl3.wavを再生
+
+    # 次のステージへ進む
+    def next_stage(self):
+        self.current_stage += 1
+        self.current_stage_settings = self.stage_settings[self.current_stage]
+
+        # 背景を新しいステージ用に再作成
+        self.load_stage_assets()
+
+        self.all_sprites.empty()
+        self.enemies.clear()
+        self.clear_projectiles()
+        self.bosses.empty()
+
+        # 機体を作り直し、パワーアップ状態を引き継ぐ
+        self.spawn_ships(list(self.ships), self.ships)
+        self.spawn_initial_enemies()
+        self.enemies_defeated = 0
+        self.current_boss = None
+        self.boss_spawn_timer = self.now()
+        self.boss_spawn_tick = None
+        self.game_state = "playing"
+        self.is_new_best_score = False # 次のステージではリセット
+
+    # ゲームをステージ1からリスタート
+    def restart(self):
+        self.all_sprites.empty()
+        self.enemies.clear()
+        self.clear_projectiles()
+        self.bosses.empty()
+        self.explosions.clear() # 爆発もクリア
+
+        self.spawn_ships(list(self.ships))
+
+        self.enemies_defeated = 0
+        self.current_boss = None
+        self.score = 0
+        self.damage_taken = 0
+        self.boss_spawn_timer = self.now()
+        self.boss_spawn_tick = None
+        self.game_state = "playing"
+        self.current_stage = 1 # ステージを1にリセット
+        self.current_stage_settings = self.stage_settings[self.current_stage]
+        self.is_new_best_score = False # リスタート時にリセット
+
+        # 背景をステージ1用に再作成
+        self.load_stage_assets()
+
+        # 初期敵の再生成
+        self.spawn_initial_enemies()
+
+        self.audio.play_music() # BGMを再開
+        self.game_over_sound_played = False # フラグをリセット
+
+    # SPACEキーの処理 (shipsはSPACEを押した機体)
+    def handle_fire(self, ships):
+        if self.game_state == "playing":
+            for ship in ships:
+                if ship.alive(): # coopでやられた機体は撃てない
+                    ship.shoot()
+        elif self.game_state == "stage_cleared":
+            if self.current_stage + 1 in self.stage_settings:
+                self.next_stage()
+            else:
+                self.game_state = "game_cleared" # 全ステージクリア
+        elif self.game_state == "game_over" or self.game_state == "game_cleared":
+            self.restart()
+
+    # 1フレーム進める
+    # inputsは1人ならFrameInput、複数の機体がある時は 機体の番号 -> FrameInput の辞書 (ない番号は何も押していない)
+    def step(self, inputs):
+        if isinstance(inputs, FrameInput):
+            inputs = {self.player.slot: inputs}
+        self.clock.advance()
+        self.frame_count += 1
+        fired = [self.ships[slot] for slot, frame_input in inputs.items() if frame_input.fire and slot in self.ships]
+        if fired:
+            self.handle_fire(fired)
+        for slot, ship in self.ships.items(): # handle_fireで作り直した機体にも入れる
+            ship.inputs = inputs.get(slot) or FrameInput()
+
+        # 更新
+        if self.game_state == "playing" or self.game_state == "exploding" or self.game_state == "score_counting":
+            self.background.update()
+            if self.player_bullets:
+                self.homing_targets.assign(self.player_bullets, self.bosses, self.enemies, self.now())
+            now = self.now()
+            self.enemies.update(now)
+            self.all_sprites.update()
+            self.explosions.update(now)
+            self.player_projectiles.update(now)
+            self.enemy_projectiles.update(now, self.target()) # 誘導弾はプレイヤーを追尾
+            if self.game_state == "exploding" and not self.explosions:
+                self.game_state = "game_over"
+                if self.persist_best_score:
+                    score_store.record(self.score, self.current_stage, cleared=False)
+
+        if self.game_state == "score_counting":
+            self.update_score_counting()
+        if self.game_state == "score_counting" or self.game_state == "stage_cleared":
+            background_cache.pump() # 先読みした背景の変換 (メインスレッドで1ティックに1つ)
+        self.profiler.mark("update")
+
+        if self.game_state == "playing":
+            self.update_playing()
+        self.profiler.mark("collision")
+
+        if self.game_state == "game_over" and not self.game_over_sound_played:
+            self.audio.play("game_over")
+            self.game_over_sound_played = True
+
+    def update_score_counting(self):
+        current_time = self.now()
+        if current_time - self.score_counting_start_time < self.score_counting_duration:
             # スコアを徐々に増やす
-            progress = (current_time - score_counting_start_time) / score_counting_duration
-            score = current_score_display + int(score_to_add * progress)
+            progress = (current_time - self.score_counting_start_time) / self.score_counting_duration
+            self.score = self.current_score_display + int(self.score_to_add * progress)
 
             # 効果音を鳴らす
-            if current_time - last_score_count_sound_time > score_count_interval:
-                score_count_sound.play()
-                last_score_count_sound_time = current_time
+            if current_time - self.last_score_count_sound_time > self.score_count_interval:
+                self.audio.play("score_count")
+                self.last_score_count_sound_time = current_time
         else:
-            score = current_score_display + score_to_add # 最終的なスコアを設定
+            self.score = self.current_score_display + self.score_to_add # 最終的なスコアを設定
+            if self.persist_best_score:
+                score_store.record(self.score, self.current_stage, cleared=True) # 予約するだけで、ここでは書かない
             # ベストスコアの更新チェック
-            if score > best_score:
-                best_score = score
-                save_best_score(best_score)
-                is_new_best_score = True
+            if self.score > self.best_score:
+                self.best_score = self.score
+                self.is_new_best_score = True
             else:
-                is_new_best_score = False
-            game_state = "stage_cleared" # カウントアップ完了後、ステージクリア状態へ
-
-    if game_state == "playing":
-        current_time = pygame.time.get_ticks()
-        if current_time - boss_spawn_timer >= BOSS_SPAWN_TIME * 1000 and current_boss is None:
-            for enemy in enemies:
-                enemy.kill()
-            current_boss = Boss(current_stage_settings["boss_health"], current_stage_settings["boss_radial_attack_interval"])
-            all_sprites.add(current_boss)
-            bosses.add(current_boss)
+                self.is_new_best_score = False
+            self.game_state = "stage_cleared" # カウントアップ完了後、ステージクリア状態へ
+
+    def update_playing(self):
+        current_time = self.now()
+        if current_time - self.boss_spawn_timer >= BOSS_SPAWN_TIME * 1000 and self.current_boss is None:
+            self.enemies.clear()
+            settings = self.current_stage_settings
+            self.current_boss = Boss(self, settings["boss_health"], settings["boss_radial_attack_interval"], settings.get("boss_radial_pattern", "boss_ring"))
+            self.boss_spawn_tick = self.clock.ticks
+            self.all_sprites.add(self.current_boss)
+            self.bosses.add(self.current_boss)
+
+        # 当たり判定用の空間ハッシュを作り直す (弾の方は各ProjectileEngineが必要な時に作る)
+        for group in self.collision_groups:
+            group.rebuild_grid()
 
         # プレイヤーの弾と敵の衝突判定
-        hits = pygame.sprite.groupcollide(enemies, player_bullets, True, True)
-        for hit_enemy in hits:
-            handle_enemy_defeat(hit_enemy)
-
-        if current_boss:
-            boss_hits = pygame.sprite.spritecollide(current_boss, player_bullets, True)
+        # (弾かミサイルに重なる敵だけを、生成順に1体ずつ判定する)
+        hits = []
+        if self.enemies and (self.player_projectiles.count or self.player_bullets):
+            shots = np.concatenate((self.player_projectiles.boxes(), self.sprite_boxes(self.player_bullets)))
+            for enemy, rect in self.enemies.rects(self.enemies.touching(shots)):
+                if self.player_shot_hits(rect):
+                    self.enemies.kill(enemy)
+                    hits.append(rect.center)
+        for center in hits:
+            self.handle_enemy_defeat(center)
+
+        if self.current_boss and (self.player_projectiles.count or self.player_bullets):
+            boss_hits = self.player_shot_hits(self.current_boss.rect)
             if boss_hits:
-                current_boss.health -= len(boss_hits)
-                if current_boss.health <= 0:
-                    score += 1000
-                    current_boss.kill()
-                    current_boss = None
-                    expl_sounds[1].play() # ボス撃破時にexpl6.wavを再生
-                    game_state = "score_counting" # スコアカウントアップ状態へ遷移
-                    score_to_add = 1000 # ボス撃破ボーナス
-                    current_score_display = score - score_to_add # カウントアップ開始時のスコア
-                    score_counting_start_time = pygame.time.get_ticks()
-                    score_counting_duration = 4000 # 4秒でカウントアップ完了
-                    score_count_interval = 50 # 50msごとにカウントアップ音を鳴らす
-                    last_score_count_sound_time = pygame.time.get_ticks()
-
-        # シールドと敵弾の衝突判定 (弾のみ消滅)
-        pygame.sprite.groupcollide(shields, enemy_bullets, False, True)
-
-        # シールドと敵本体の衝突判定 (敵のみ消滅)
-        shield_enemy_hits = pygame.sprite.groupcollide(enemies, shields, True, False)
-        for hit_enemy in shield_enemy_hits:
-            handle_enemy_defeat(hit_enemy)
+                self.current_boss.health -= boss_hits
+                if self.current_boss.health <= 0:
+                    self.score += 1000
+                    self.current_boss.kill()
+                    self.current_boss = None
+                    self.audio.play("boss_defeat") # ボス撃破時にexpl6.wavを再生
+                    self.game_state = "score_counting" # スコアカウントアップ状態へ遷移
+                    self.prefetch_next_stage()
+                    self.score_to_add = 1000 # ボス撃破ボーナス
+                    self.current_score_display = self.score - self.score_to_add # カウントアップ開始時のスコア
+                    self.score_counting_start_time = self.now()
+                    self.score_counting_duration = 4000 # 4秒でカウントアップ完了
+                    self.score_count_interval = 50 # 50msごとにカウントアップ音を鳴らす
+                    self.last_score_count_sound_time = self.now()
+
+        if self.shields:
+            # シールドと敵弾の衝突判定 (弾のみ消滅)
+            self.enemy_projectiles.collide_group(self.shields, False, True)
+
+            # シールドと敵本体の衝突判定 (敵のみ消滅)
+            hits = []
+            for enemy, rect in self.enemies.rects(self.enemies.touching(self.sprite_boxes(self.shields))):
+                if self.shields.query(rect):
+                    self.enemies.kill(enemy)
+                    hits.append(rect.center)
+            for center in hits:
+                self.handle_enemy_defeat(center)
 
         # プレイヤーと敵弾の衝突判定
-        hits = pygame.sprite.groupcollide(players, enemy_bullets, False, True)
+        hits = self.enemy_projectiles.collide_group(self.players, False, True)
         if hits:
             for p in hits:
                 p.hit()
                 if p.health <= 0 and p.alive():
-                    expl = Explosion(p.rect.center)
-                    all_sprites.add(expl)
-                    explosions.add(expl)
-                    p.kill()
-                    pygame.mixer.music.stop()
-                    expl_sounds[0].play()
-                    game_state = "exploding"
-
-        hits = pygame.sprite.groupcollide(players, enemies, False, True)
-        if hits:
-            for p in players:
-                p.hit()
-                if p.health <= 0:
-                    expl = Explosion(p.rect.center)
-                    all_sprites.add(expl)
-                    explosions.add(expl)
-                    p.kill()
-                    pygame.mixer.music.stop()
-                    expl_sounds[0].play() # プレイヤー撃破時にexpl3.wavを再生
-                    game_state = "exploding"
-
-        if current_boss and pygame.sprite.spritecollideany(player, bosses):
-            for p in players:
-                p.hit()
-                if p.health <= 0:
-                    expl = Explosion(p.rect.center)
-                    all_sprites.add(expl)
-                    explosions.add(expl)
-                    p.kill()
-                    pygame.mixer.music.stop()
-                    expl_sounds[0].play() # プレイヤー撃破時にexpl3.wavを再生
-                    game_state = "exploding"
-
-        # プレイヤーとパワーアップアイテムの衝突判定
-        hits = pygame.sprite.spritecollide(player, powerups, True)
-        for hit in hits:
-            if hit.type == "rapid_fire":
-                player.rapid_fire_active = True
-                player.rapid_fire_start_time = pygame.time.get_ticks()
-            elif hit.type == "spread_shot":
-                player.spread_shot_active = True
-                player.spread_shot_start_time = pygame.time.get_ticks()
-            elif hit.type == "shield":
-                player.activate_shield()
-            elif hit.type == "health":
-                player.health = min(player.health + 1, player.max_health) # 体力を1回復（最大体力まで）
-            elif hit.type == "triple_shot":
-                player.triple_shot_active = True
-            elif hit.type == "homing_missile":
-                player.homing_missile_active = True
-
-    # 描画
-    background.draw(screen)
-    all_sprites.draw(screen)
-
-    if game_state == "playing":
-        score_text = score_font.render(f"Score: {score}", True, WHITE)
-        screen.blit(score_text, (10, 10))
-        if current_boss:
-            # ボスの体力表示は削除済み
-            pass
-
-        # プレイヤー体力ゲージの描画
-        health_icon_x_start = SCREEN_WIDTH - (player.max_health * (player_health_icon.get_width() + 5)) - 10 # 右端からアイコンの幅+間隔で配置
-        health_icon_y = SCREEN_HEIGHT - player_health_icon.get_height() - 10 # 下端からアイコンの高さ+間隔で配置
-
-        for i in range(player.max_health):
-            if i < player.health:
-                screen.blit(player_health_icon, (health_icon_x_start + i * (player_health_icon.get_width() + 5), health_icon_y))
-
-        # シールドの描画
-        if player.shield_active:
-            # pygame.draw.circle(screen, BLUE, player.rect.center, player.rect.width // 2 + 10, 3) # プレイヤーの周りに青い円を描画
-            shield_rect = shield_effect_img.get_rect(center=player.rect.center)
-            screen.blit(shield_effect_img, shield_rect)
-
-    elif game_state == "stage_cleared":
-        clear_text = font.render("STAGE CLEAR!", True, GREEN)
-        clear_rect = clear_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100))
-        screen.blit(clear_text, clear_rect)
-
-        final_score_text = score_font.render(f"FINAL SCORE: {score}", True, WHITE)
-        final_score_rect = final_score_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 30))
-        screen.blit(final_score_text, final_score_rect)
-
-        if is_new_best_score:
-            best_score_text = score_font.render("NEW BEST SCORE!", True, YELLOW)
-            best_score_rect = best_score_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 10))
-            screen.blit(best_score_text, best_score_rect)
-
-        next_stage_text = score_font.render("Press SPACE for Next Stage", True, WHITE)
-        next_stage_rect = next_stage_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 50))
-        screen.blit(next_stage_text, next_stage_rect)
+                    self.kill_player(p)
 
-    elif game_state == "game_cleared":
-        clear_text = font.render("GAME CLEARED!", True, GREEN)
-        clear_rect = clear_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100))
-        screen.blit(clear_text, clear_rect)
+        hits = [p for p in self.players.sprites() if self.enemies.collide_rect(p.rect, True)]
+        for p in hits:
+            p.hit()
+            if p.health <= 0:
+                self.kill_player(p)
 
-        final_score_text = score_font.render(f"FINAL SCORE: {score}", True, WHITE)
-        final_score_rect = final_score_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 30))
-        screen.blit(final_score_text, final_score_rect)
+        if self.current_boss:
+            for p in self.players.sprites():
+                if grid_spritecollideany(p, self.bosses):
+                    p.hit()
+                    if p.health <= 0:
+                        self.kill_player(p)
 
-        if is_new_best_score:
-            best_score_text = score_font.render("NEW BEST SCORE!", True, YELLOW)
-            best_score_rect = best_score_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 10))
-            screen.blit(best_score_text, best_score_rect)
-
-        retry_text = score_font.render("PRESS SPACE TO RETRY", True, WHITE)
-        retry_rect = retry_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 50))
-        screen.blit(retry_text, retry_rect)
-
-    elif game_state == "score_counting":
-        score_text = font.render(f"SCORE: {score}", True, WHITE)
-        text_rect = score_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
-        screen.blit(score_text, text_rect)
-
-    elif game_state == "game_over":
-        game_over_text = font.render("GAME OVER", True, RED)
-        text_rect = game_over_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 30))
-        screen.blit(game_over_text, text_rect)
-
-        retry_text = score_font.render("PRESS SPACE TO RETRY", True, WHITE)
-        retry_rect = retry_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 10))
-        screen.blit(retry_text, retry_rect)
-
-        if not game_over_sound_played:
-            game_over_sound.play()
-            game_over_sound_played = True
+        # プレイヤーとパワーアップアイテムの衝突判定
+        for player in self.players.sprites():
+            for hit in grid_spritecollide(player, self.powerups, True):
+                self.collect_powerup(player, hit.type)
+
+    # playerがパワーアップアイテムを取った時の処理
+    def collect_powerup(self, player, powerup_type):
+        if powerup_type == "rapid_fire":
+            player.rapid_fire_active = True
+            player.rapid_fire_start_time = self.now()
+        elif powerup_type == "spread_shot":
+            player.spread_shot_active = True
+            player.spread_shot_start_time = self.now()
+        elif powerup_type == "shield":
+            player.activate_shield()
+        elif powerup_type == "health":
+            player.health = min(player.health + 1, player.max_health) # 体力を1回復（最大体力まで）
+        elif powerup_type == "triple_shot":
+            player.triple_shot_active = True
+        elif powerup_type == "homing_missile":
+            player.homing_missile_active = True
+
+    # 描画 (背景以外の描画命令をrendererに積む)
+    def render(self, renderer):
+        hud = renderer.hud
+        player = self.player
+        score = self.score
+
+        renderer.store(LAYER_SPRITES, self.enemies)
+        renderer.sprites(LAYER_SPRITES, self.all_sprites)
+        quality = renderer.quality
+        renderer.store(LAYER_SPRITES, self.explosions, quality["explosion_frame_step"], quality["max_explosions"])
+        renderer.store(LAYER_PROJECTILES, self.player_projectiles)
+        renderer.store(LAYER_PROJECTILES, self.enemy_projectiles)
+
+        if self.game_state == "playing":
+            renderer.blit(LAYER_HUD, *hud.score(score))
+            # ボスの体力表示は削除済み
 
-    pygame.display.flip()
+            # プレイヤー体力ゲージの描画
+            health = hud.health(player.health, player.max_health)
+            if health is not None:
+                renderer.blit(LAYER_HUD, *health)
+
+            # シールドの描画
+            for ship in self.players:
+                if ship.shield_active:
+                    shield_effect_img = shield_effect_image()
+                    shield_rect = shield_effect_img.get_rect(center=ship.rect.center)
+                    renderer.blit(LAYER_HUD, shield_effect_img, shield_rect.topleft)
+
+        elif self.game_state == "stage_cleared":
+            renderer.blit(LAYER_HUD, *hud.result("STAGE CLEAR!", score, self.is_new_best_score, "Press SPACE for Next Stage"))
+
+        elif self.game_state == "game_cleared":
+            renderer.blit(LAYER_HUD, *hud.result("GAME CLEARED!", score, self.is_new_best_score, "PRESS SPACE TO RETRY"))
+
+        elif self.game_state == "score_counting":
+            renderer.blit(LAYER_HUD, *hud.counting_score(score))
+
+        elif self.game_state == "game_over":
+            renderer.blit(LAYER_HUD, *hud.game_over())
+
+    # 状態のハッシュ (同じシードと入力から同じ結果になるかの確認用)
+    def digest(self):
+        h = hashlib.sha1()
+        h.update(repr((self.clock.ticks, self.game_state, self.current_stage, self.score, self.player.health)).encode())
+        for sprite in self.all_sprites:
+            h.update(repr((type(sprite).__name__, tuple(sprite.rect))).encode())
+        for store, components in ((self.enemies, ("entity", "x", "y")), (self.explosions, ("entity", "center_x", "center_y", "frame"))):
+            alive = store.alive_indices()
+            for name in components:
+                h.update(getattr(store, name)[alive].tobytes())
+        for engine in (self.player_projectiles, self.enemy_projectiles):
+            h.update(engine.x[:engine.count].tobytes())
+            h.update(engine.y[:engine.count].tobytes())
+        return h.hexdigest()
+
+    # 弾プールの統計を表示する
+    def print_pool_stats(self):
+        print("{name}: created={created} free={free} hits={hits} misses={misses}".format(**self.missile_pool.stats()))
+        for name, engine in (("player_projectiles", self.player_projectiles), ("enemy_projectiles", self.enemy_projectiles)):
+            print("{}: count={count} peak={peak} capacity={capacity}".format(name, **engine.stats()))
+        for name, store in (("enemies", self.enemies), ("explosions", self.explosions)):
+            print("{}: count={count} peak={peak} capacity={capacity}".format(name, **store.stats()))
+        print("homing_targets: policy={} queries={} builds={}".format(self.homing_targets.policy, self.homing_targets.queries, self.homing_targets.builds))
+        print("assets: images={images} loads={loads} sheets={sheets} hits={hits} evicted={evicted} blocking={blocking_ms:.1f}ms".format(**assets.stats()))
+        background_cache.print_stats(self.stage_settings)
+
+# 起動時の読み込み
+# 画像と音のファイルのデコードをスレッドプールで並列に行い、画面形式への変換・拡大縮小 (変換の段階) はメインスレッドで行う
+# 変換の段階は、必要なファイルのデコードが揃ったものから順に進める (残りのデコードと重なる)
+# その間は読み込み画面に進み具合を描き、アセットごとにかかった時間を記録する
+# workersが0の時 (ブラウザではスレッドが使えない) は、メインスレッドで1つずつデコードする
+STARTUP_LOAD_WORKERS = 0 if WEB else min(4, os.cpu_count() or 1)
+
+class StartupLoader:
+    def __init__(self, workers=STARTUP_LOAD_WORKERS):
+        self.workers = workers
+        self.sounds = {} # 名前 -> デコード済みのSound (GameAudioに渡す)
+        self.timings = [] # (段階, アセット名, 時間 (ミリ秒))
+        self.start = time.perf_counter()
+        self.elapsed = 0.0 # 読み込み全体にかかった時間 (秒)
+        self.first_frame = None # 最初のフレームを描き終えるまでの時間 (秒)
+        self._font = None
+
+    # 読み込むもの: デコードするファイル (種類, ファイル名, 音の名前) と、変換の段階 (名前, 必要なファイル, 処理)
+    def _jobs(self, stage_settings, sounds):
+        steps = [("sprites", {assets.source(filename) for filename in SPRITE_IMAGES}, preload_images)]
+        for filenames, speed, alpha in stage_background_layers(stage_settings):
+            steps.append(("background " + ",".join(filenames), set(filenames), lambda filenames=filenames, alpha=alpha: background_cache.strip(filenames, alpha)))
+        # 段階の順に (先に変換できるものから) デコードする
+        files = [("image", filename, None) for filename in dict.fromkeys(filename for name, needed, run in steps for filename in sorted(needed))]
+        if sounds:
+            files += [("sound", filename, name) for name, (filename, *rest) in SOUND_SETTINGS.items()]
+        return files, steps
+
+    # スレッドで動く
+    @staticmethod
+    def _decode(kind, filename):
+        start = time.perf_counter()
+        if kind == "image":
+            result = assets.decode(filename)
+        else:
+            result = pygame.mixer.Sound(os.path.join(sound_dir, filename))
+        return result, time.perf_counter() - start
 
-    
+    def run(self, screen, stage_settings=None, sounds=True):
+        for _ in self._load(screen, stage_settings, sounds):
+            pass
 
-pygame.quit()
-sys.exit()
+    # ブラウザ用。1段階ごとにブラウザへ制御を返し、読み込み画面を表示させる (返さないとキャンバスが描き変わらない)
+    async def run_async(self, screen, stage_settings=None, sounds=True):
+        for _ in self._load(screen, stage_settings, sounds):
+            await asyncio.sleep(0)
+
+    # 読み込みを進める。デコード1つ (スレッドがある時は待ち1回) と変換1つごとに、読み込み画面を描いてyieldする
+    def _load(self, screen, stage_settings, sounds):
+        files, steps = self._jobs(stage_settings if stage_settings is not None else STAGE_SETTINGS[1], sounds)
+        total = len(files) + len(steps)
+        done = set()
+        pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="asset-loader") if self.workers > 0 else None
+        pending = {pool.submit(self._decode, kind, filename): (kind, filename, name) for kind, filename, name in files} if pool else {}
+        queue = list(files)
+        while len(done) < len(files) or steps:
+            self.draw(screen, len(self.timings) / total)
+            yield
+            if pool is not None:
+                finished, _ = concurrent.futures.wait(pending, timeout=0.01, return_when=concurrent.futures.FIRST_COMPLETED)
+                results = [(pending.pop(future), future.result()) for future in finished]
+            elif queue:
+                kind, filename, name = queue.pop(0)
+                results = [((kind, filename, name), self._decode(kind, filename))]
+            else:
+                results = []
+            for (kind, filename, name), (result, seconds) in results:
+                if kind == "image":
+                    assets.add_decoded(filename, result)
+                else:
+                    self.sounds[name] = result
+                done.add(filename)
+                self.timings.append(("decode", filename, seconds * 1000))
+            # デコードが揃った段階から変換する
+            for step in [step for step in steps if step[1] <= done]:
+                name, needed, run = step
+                start = time.perf_counter()
+                run()
+                self.timings.append(("convert", name, (time.perf_counter() - start) * 1000))
+                steps.remove(step)
+                self.draw(screen, len(self.timings) / total)
+                yield
+            pygame.event.pump() # 読み込み中もウィンドウが応答なしにならないように
+        if pool is not None:
+            pool.shutdown()
+        self.draw(screen, 1.0)
+        self.elapsed = time.perf_counter() - self.start
+
+    def draw(self, screen, progress):
+        if self._font is None:
+            self._font = pygame.font.Font(None, 36)
+        screen.fill(BLACK)
+        text = self._font.render("LOADING", True, WHITE)
+        screen.blit(text, text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 30)))
+        bar = pygame.Rect(0, 0, SCREEN_WIDTH // 2, 16)
+        bar.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 10)
+        pygame.draw.rect(screen, WHITE, bar, 1)
+        pygame.draw.rect(screen, WHITE, (bar.x + 2, bar.y + 2, int((bar.width - 4) * progress), bar.height - 4))
+        pygame.display.flip()
+
+    def mark_first_frame(self):
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter() - self.start
+
+    def print_stats(self):
+        decode = sum(ms for phase, name, ms in self.timings if phase == "decode")
+        convert = sum(ms for phase, name, ms in self.timings if phase == "convert")
+        first_frame = "{:.1f}ms".format(self.first_frame * 1000) if self.first_frame is not None else "-"
+        print("startup: loaded in {:.1f}ms on {} workers (decode {:.1f}ms, convert {:.1f}ms), first frame {}".format(self.elapsed * 1000, self.workers, decode, convert, first_frame))
+        for phase, name, ms in self.timings:
+            print("  {} {}: {:.1f}ms".format(phase, name, ms))
+
+# pygameの初期化
+# headlessの場合はウィンドウも音声デバイスも使わない (画像の変換用に見えないディスプレイだけ作る)
+# loaderを渡すと、読み込み画面を出しながら並列に読み込む (渡さなければ画像だけをその場で順に読む)
+def init_pygame(headless=False, loader=None):
+    screen = init_display(headless)
+    if loader is None:
+        preload_images()
+    else:
+        loader.run(screen, sounds=not headless)
+    return screen
+
+# ウィンドウ (headlessなら見えないディスプレイ) を作るだけで、アセットは読まない
+def init_display(headless=False):
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pygame.display.init()
+        pygame.font.init()
+    else:
+        pygame.init()
+        pygame.mixer.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption("シューティングゲーム")
+    return screen
+
+# ウィンドウでプレイする時のゲームループの中身
+# シミュレーションは固定ティックで進め、描画はframe()1回につき1回行う (描画が遅れた分はまとめてティックを進める)
+# 待ち方 (clock.tickかasyncio.sleepか) は呼び出し側が決め、経過時間をframe()に渡す
+# replayを渡すとその入力を再生し (seekまでは描画せずに早送り)、終わったらキーボード操作に戻る
+# F3でフレームごとの計測の表示を切り替える (profile_pathを指定すると最初から計測し、終了時に書き出す)
+# 起動時のアセットはload_workers個のスレッドで読む
+# 描画の品質はqualityで決め、"auto"なら1フレームの処理時間がrender_fpsの予算に収まるように自動で調整する
+# screenとloaderを渡すと、読み込みは済んでいるものとしてそのまま使う (run_window_asyncは先に非同期で読み込む)
+class WindowLoop:
+    def __init__(self, seed=None, record_path=None, replay=None, seek=0, full_redraw=False, profile_path=None, load_workers=STARTUP_LOAD_WORKERS, quality="auto", render_fps=FPS, screen=None, loader=None):
+        if screen is None:
+            loader = StartupLoader(load_workers)
+            screen = init_pygame(loader=loader)
+        self.loader = loader
+        self.renderer = Renderer(screen, dirty_tracking=not full_redraw, cull=not full_redraw)
+        self.quality = quality_scaler(quality, 1000 / render_fps)
+        self.quality.apply(self.renderer)
+        if replay is not None:
+            seed = replay.seed
+        self.world = GameWorld(audio=GameAudio(self.loader.sounds), seed=seed)
+        self.profile_path = profile_path
+        self.profiler = FrameProfiler() if profile_path else NullProfiler()
+        self.recorder = ReplayWriter(record_path, self.world.rng.seed) if record_path else None
+        self.replay_inputs = replay.masks() if replay is not None else None
+        if replay is not None:
+            for i, bits in zip(range(seek), self.replay_inputs):
+                self.world.step(FrameInput.from_bits(bits))
+        self.world.profiler = self.profiler
+        self.accumulator = 0.0
+        self.fire = False
+        self.running = True
+        self.profiler.begin_frame()
+
+    # 前のフレームからelapsed_msミリ秒経った時の1フレーム分の処理
+    def frame(self, elapsed_ms):
+        start = time.perf_counter()
+        world = self.world
+        profiler = self.profiler
+        tick_ms = world.clock.tick_ms
+        self.accumulator += elapsed_ms
+        profiler.mark("wait")
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.running = False
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE:
+                    self.fire = True
+                elif event.key == pygame.K_F3:
+                    if isinstance(profiler, NullProfiler):
+                        profiler = self.profiler = world.profiler = FrameProfiler()
+                        profiler.begin_frame()
+                    profiler.overlay_visible = not profiler.overlay_visible
+        profiler.mark("events")
+
+        steps = 0
+        while self.accumulator >= tick_ms and steps < MAX_TICKS_PER_FRAME:
+            bits = next(self.replay_inputs, None) if self.replay_inputs is not None else None
+            if bits is not None:
+                inputs = FrameInput.from_bits(bits)
+            else:
+                self.replay_inputs = None
+                inputs = FrameInput.from_keys(pygame.key.get_pressed(), self.fire)
+                self.fire = False # SPACEは最初のティックにだけ渡す
+            if self.recorder is not None:
+                self.recorder.record(inputs.to_bits())
+            world.step(inputs)
+            self.accumulator -= tick_ms
+            steps += 1
+        if steps == MAX_TICKS_PER_FRAME:
+            self.accumulator = min(self.accumulator, tick_ms) # 追いつけない分は捨てる
+
+        self.renderer.render(world, profiler.overlay())
+        self.loader.mark_first_frame()
+        profiler.mark("render")
+        profiler.end_frame(world, steps, self.quality.level)
+        if self.quality.observe((time.perf_counter() - start) * 1000):
+            self.quality.apply(self.renderer)
+        profiler.begin_frame() # ここから次のframe()までが待ち時間
+
+    def close(self):
+        score_store.close() # 予約した書き込みを終わらせる
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.profile_path:
+            self.profiler.export(self.profile_path)
+        if DEBUG_STATS:
+            self.loader.print_stats()
+            self.world.print_pool_stats()
+            self.world.audio.print_stats()
+            self.renderer.print_stats()
+            self.quality.print_stats()
+            if isinstance(self.profiler, FrameProfiler):
+                self.profiler.print_stats()
+
+# ウィンドウでプレイする (描画はrender_fpsで行う)
+def run_window(seed=None, render_fps=FPS, record_path=None, replay=None, seek=0, full_redraw=False, profile_path=None, load_workers=STARTUP_LOAD_WORKERS, quality="auto"):
+    loop = WindowLoop(seed, record_path, replay, seek, full_redraw, profile_path, load_workers, quality, render_fps)
+    clock = pygame.time.Clock()
+    while loop.running:
+        loop.frame(clock.tick(render_fps))
+    loop.close()
+
+# ブラウザ (pygbag) 用のゲームループ
+# 1フレームごとにasyncio.sleep(0)でブラウザに制御を返し、次に呼ばれるまでの実際の経過時間でティックを進める
+# (ブラウザのフレームのタイミングにそのまま合わせる)。render_fpsを指定すると、デスクトップでもその間隔まで待つ
+# 起動時の読み込みも1段階ごとに制御を返しながら行う (読み込み画面を表示させ、ブラウザを止めないように)
+async def run_window_async(seed=None, render_fps=None, record_path=None, replay=None, seek=0, full_redraw=False, profile_path=None, load_workers=STARTUP_LOAD_WORKERS, quality="auto"):
+    screen = init_display()
+    loader = StartupLoader(load_workers)
+    await loader.run_async(screen)
+    loop = WindowLoop(seed, record_path, replay, seek, full_redraw, profile_path, load_workers, quality, render_fps or FPS, screen, loader)
+    frame_time = 1.0 / render_fps if render_fps else 0
+    last = time.perf_counter()
+    while loop.running:
+        now = time.perf_counter()
+        loop.frame((now - last) * 1000)
+        last = now
+        await asyncio.sleep(max(0, frame_time - (time.perf_counter() - now)))
+        score_store.pump() # ブラウザでは、スコアの書き込みはフレームを表示させた後に行う
+    loop.close()
+
+# シミュレーションと描画を別のプロセスで動かすモード (--split)
+# シミュレーションのプロセスは固定ティックでworld.step()を進め、ティックごとに描画に必要なもの
+# (画像の番号・位置・直前のティックで動いた量、HUDの値、鳴らした音) を共有メモリの枠に書く
+# 描画のプロセス (ウィンドウのある方) は最新の枠を共有メモリのまま読み、前のティックからの経過時間で位置を補間して描く
+# 枠はSPLIT_SLOTS個を順に使う。書き込み中の枠は通し番号を-1にしておき、読む側は読み終えた後に通し番号が変わっていないか確かめる
+# (補間には最新の枠と、その枠を書いている間に次の枠を書き始められる余裕が要るので、2つではなく3つ使う)
+SPLIT_SLOTS = 3
+SPLIT_MAX_ITEMS = 16384 # 1枠に書ける描画の数 (超えた分は描かない)
+SPLIT_MAX_BACKGROUND_LAYERS = 4
+SPLIT_EXTRA_BYTES = 4096 # HUDと音 (pickle) の領域
+SPLIT_SNAP_DISTANCE = 64 # 1ティックでこれより大きく動いたもの (画面の上に戻った敵など) は補間しない
+
+SPLIT_CONTROL = np.dtype([
+    ("running", np.int64), # 0にするとシミュレーションのプロセスが終わる
+    ("inputs", np.int64), # 押されているキー (FrameInputのビットマスク、INPUT_FIREを除く)
+    ("fire_count", np.int64), # SPACEが押された回数 (増えたら次のティックでfireにする)
+    ("quality", np.int64), # 描画の品質の段階 (爆発の描き方に使う)
+    ("latest", np.int64), # 書き終えた最新の枠の通し番号 (まだなければ-1)
+])
+SPLIT_SLOT = np.dtype([
+    ("sequence", np.int64), # 枠の通し番号 (書き込み中は-1)
+    ("tick", np.int64),
+    ("stage", np.int64), # 背景を選ぶため
+    ("published", np.float64), # 書き終えた時刻 (perf_counter、秒)
+    ("background", np.int64, (SPLIT_MAX_BACKGROUND_LAYERS,)), # 背景のレイヤーごとのoffset
+    ("count", np.int64),
+    ("dropped", np.int64), # 入りきらなかった描画の数
+    ("extra_length", np.int64),
+    ("extra", np.uint8, (SPLIT_EXTRA_BYTES,)),
+    ("image", np.int16, (SPLIT_MAX_ITEMS,)), # render_images()の番号
+    ("layer", np.int8, (SPLIT_MAX_ITEMS,)),
+    ("x", np.float32, (SPLIT_MAX_ITEMS,)),
+    ("y", np.float32, (SPLIT_MAX_ITEMS,)),
+    ("dx", np.float32, (SPLIT_MAX_ITEMS,)),
+    ("dy", np.float32, (SPLIT_MAX_ITEMS,)),
+])
+
+# 共有メモリの画像の番号が指す画像 (両方のプロセスで同じ順に作る)
+def render_images():
+    images = [player_image(), assets.blank(player_image().get_size()), enemy_image(), boss_image(), homing_missile_image(), shield_effect_image()]
+    images += [powerup_image(powerup_type) for powerup_type in POWERUP_IMAGES]
+    images += explosion_images()
+    images += [kind.image for kind in (PLAYER_BULLET, ENEMY_BULLET, HOMING_BULLET)]
+    return images
+
+# 共有メモリの領域 (制御用の値と枠)。numpyの配列は共有メモリをそのまま指す
+class SplitBuffer:
+    def __init__(self, name=None):
+        size = SPLIT_CONTROL.itemsize + SPLIT_SLOT.itemsize * SPLIT_SLOTS
+        self.owner = name is None
+        self.memory = multiprocessing.shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.control = np.ndarray((), SPLIT_CONTROL, buffer=self.memory.buf)
+        self.slots = np.ndarray((SPLIT_SLOTS,), SPLIT_SLOT, buffer=self.memory.buf, offset=SPLIT_CONTROL.itemsize)
+        if self.owner:
+            self.control["running"] = 1
+            self.control["latest"] = -1
+            self.slots["sequence"] = -1
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self):
+        # 配列が共有メモリを指したままだと閉じられないので先に手放す
+        self.control = self.slots = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+# HUDの呼び出しを記録する (描画のプロセスで本物のHudに同じ呼び出しをする)
+class HudRecorder:
+    def __getattr__(self, name):
+        return lambda *args: ((name, args), None)
+
+# 鳴らした音を記録する (GameAudioの代わり)。直近のものだけを番号付きで残し、描画のプロセスがまだ鳴らしていないものを鳴らす
+class AudioRecorder:
+    def __init__(self, keep=64):
+        self.events = collections.deque(maxlen=keep) # (番号, メソッド名, 引数)
+        self.count = 0
+
+    def _record(self, method, *args):
+        self.count += 1
+        self.events.append((self.count, method, args))
+
+    def play(self, name):
+        self._record("play", name)
+
+    def play_music(self):
+        self._record("play_music")
+
+    def stop_music(self):
+        self._record("stop_music")
+
+    def print_stats(self):
+        pass
+
+# world.render()の描画命令を配列として記録する (Rendererの代わり)
+# 共有メモリの枠に書く (--split) ほか、サーバー (server.py) がスナップショットを作るのにも使う
+FRAME_COLUMNS = ("image", "layer", "x", "y", "dx", "dy")
+
+class FrameRecorder:
+    def __init__(self, area, buffer=None):
+        self.buffer = buffer # publish()で書く共有メモリ
+        self.area = area
+        self.hud = HudRecorder()
+        self.quality = QUALITY_LEVELS[0]
+        self.image_index = {id(image): i for i, image in enumerate(render_images())}
+        self.sequence = 0
+        self._positions = {} # スプライトごとの前のティックの位置 (動いた量を求める)
+
+    def begin(self):
+        self.items = [] # (画像の番号, レイヤー, x, y, dx, dy) の配列の組
+        self.sprite_items = []
+        self.hud_commands = []
+        self._last_positions, self._positions = self._positions, {}
+
+    def sprites(self, layer, sprites):
+        area = self.area
+        for sprite in sprites:
+            image = sprite.image
+            x, y = position = sprite.rect.topleft
+            if not area.colliderect(position, image.get_size()):
+                continue
+            last = self._last_positions.get(id(sprite), position)
+            self._positions[id(sprite)] = position
+            self.sprite_items.append((self.image_index[id(image)], layer, x, y, x - last[0], y - last[1]))
+
+    def store(self, layer, store, *options):
+        self._flush_sprites()
+        images, which, x, y, dx, dy = store.draw_arrays(self.area, *options)
+        indices = np.array([self.image_index[id(image)] for image in images], dtype=np.int16)
+        self.items.append((indices[which], np.full(len(which), layer), x, y, dx, dy))
+
+    def blit(self, layer, image, position):
+        if layer == LAYER_HUD:
+            if isinstance(image, tuple):
+                self.hud_commands.append(image) # HudRecorderの呼び出し
+            else:
+                self.hud_commands.append(("image", (self.image_index[id(image)], position)))
+            return
+        self._flush_sprites()
+        self.sprite_items.append((self.image_index[id(image)], layer, position[0], position[1], 0, 0))
+
+    def extend(self, layer, blits):
+        for image, position in blits:
+            self.blit(layer, image, position)
+
+    def _flush_sprites(self):
+        if self.sprite_items:
+            self.items.append(tuple(np.array(column) for column in zip(*self.sprite_items)))
+            self.sprite_items = []
+
+    # world.render()の描画命令を、FRAME_COLUMNSの順の配列と、HUDの呼び出しのリストにして返す
+    def record(self, world):
+        self.begin()
+        world.render(self)
+        self._flush_sprites()
+        if not self.items:
+            return [np.zeros(0, dtype=np.int64) for _ in FRAME_COLUMNS], self.hud_commands
+        return [np.concatenate(column) for column in zip(*self.items)], self.hud_commands
+
+    # world.render()の結果を共有メモリの次の枠に書く
+    def publish(self, world, audio):
+        self.quality = QUALITY_LEVELS[int(self.buffer.control["quality"])]
+        columns, hud_commands = self.record(world)
+        slot = self.buffer.slots[self.sequence % SPLIT_SLOTS]
+        slot["sequence"] = -1
+        count = min(len(columns[0]), SPLIT_MAX_ITEMS)
+        for name, column in zip(FRAME_COLUMNS, columns):
+            slot[name][:count] = column[:count]
+        slot["count"] = count
+        slot["dropped"] = len(columns[0]) - count
+        slot["tick"] = world.clock.ticks
+        slot["stage"] = world.current_stage
+        position = world.background.position()
+        slot["background"][:len(position)] = position
+        extra = pickle.dumps((hud_commands, list(audio.events)))
+        slot["extra_length"] = len(extra)
+        slot["extra"][:len(extra)] = np.frombuffer(extra, dtype=np.uint8)
+        slot["published"] = time.perf_counter()
+        slot["sequence"] = self.sequence
+        self.buffer.control["latest"] = self.sequence
+        self.sequence += 1
+
+# シミュレーションのプロセスの中身
+def split_simulation(buffer_name, seed=None, record_path=None):
+    init_pygame(headless=True)
+    buffer = SplitBuffer(buffer_name)
+    control = buffer.control
+    audio = AudioRecorder()
+    world = GameWorld(audio=audio, seed=seed)
+    recorder = FrameRecorder(pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT), buffer)
+    replay_writer = ReplayWriter(record_path, world.rng.seed) if record_path else None
+    tick_seconds = world.clock.tick_ms / 1000
+    fire_seen = 0
+    next_tick = time.perf_counter()
+    while control["running"]:
+        now = time.perf_counter()
+        if now < next_tick:
+            time.sleep(next_tick - now)
+            continue
+        steps = 0
+        while next_tick <= now and steps < MAX_TICKS_PER_FRAME:
+            fire_count = int(control["fire_count"])
+            inputs = FrameInput.from_bits(int(control["inputs"]) | (INPUT_FIRE if fire_count != fire_seen else 0))
+            fire_seen = fire_count
+            if replay_writer is not None:
+                replay_writer.record(inputs.to_bits())
+            world.step(inputs)
+            next_tick += tick_seconds
+            steps += 1
+        if steps == MAX_TICKS_PER_FRAME:
+            next_tick = max(next_tick, now) # 追いつけない分は捨てる
+        recorder.publish(world, audio)
+    if replay_writer is not None:
+        replay_writer.close()
+    score_store.close()
+    buffer.close()
+
+# 描画のプロセスで、共有メモリの枠をworldの代わりにRendererへ渡す
+# (Rendererはworld.render()とworld.backgroundだけを使う)
+class SplitView:
+    def __init__(self, buffer, stage_settings=None):
+        self.buffer = buffer
+        self.stage_settings = stage_settings if stage_settings is not None else STAGE_SETTINGS
+        self.images = render_images()
+        self.image_array = np.empty(len(self.images), dtype=object) # 番号の配列からまとめて画像を引くため
+        self.image_array[:] = self.images
+        self.stage = None
+        self.background = None
+        self.tick_seconds = 1 / FPS
+        self.sequence = -1 # 最後に描いた枠
+        self.audio_count = 0 # 最後に鳴らした音の番号
+        self.retries = 0 # 読んでいる間に枠が書き換えられて読み直した回数
+        self.dropped = 0
+
+    # 最新の枠を読んで次のrender()の準備をする (まだ枠がなければFalse)
+    def read(self, audio):
+        for attempt in range(SPLIT_SLOTS):
+            sequence = int(self.buffer.control["latest"])
+            if sequence < 0:
+                return False
+            slot = self.buffer.slots[sequence % SPLIT_SLOTS]
+            # 書き込み中でないことを確かめてから写し、写し終えた後も書き換えられていなければその写しを使う
+            # (写している間に追い越されると中身が壊れているので、写しを確かめる前には何も解釈しない)
+            if int(slot["sequence"]) == sequence:
+                copy = self._copy_slot(slot)
+                if int(slot["sequence"]) == sequence:
+                    break
+            self.retries += 1
+        else:
+            return self.sequence >= 0 # 読めなければ前の枠をもう一度描く
+        self.layers, hud_commands, audio_events, background = self._parse(copy)
+        self.hud_commands = hud_commands
+        if sequence != self.sequence:
+            self.dropped = copy[-1]
+        self.sequence = sequence
+        for number, method, args in audio_events:
+            if number > self.audio_count:
+                getattr(audio, method)(*args)
+                self.audio_count = number
+        self._set_background(*background)
+        return True
+
+    # 枠の中身を共有メモリから写す
+    @staticmethod
+    def _copy_slot(slot):
+        n = int(slot["count"])
+        columns = [slot[name][:n].copy() for name in FRAME_COLUMNS]
+        extra = slot["extra"][:int(slot["extra_length"])].tobytes()
+        return columns, extra, float(slot["published"]), int(slot["stage"]), slot["background"].tolist(), int(slot["dropped"])
+
+    def _parse(self, copy):
+        (image, layer, x, y, dx, dy), extra, published, stage, offsets, dropped = copy
+        # 前のティックからの経過時間で、直前のティックの位置と今の位置の間を補間する
+        back = 1 - min(max((time.perf_counter() - published) / self.tick_seconds, 0), 1)
+        moving = (np.abs(dx) <= SPLIT_SNAP_DISTANCE) & (np.abs(dy) <= SPLIT_SNAP_DISTANCE)
+        x = np.rint(x - dx * (back * moving)).astype(np.int32)
+        y = np.rint(y - dy * (back * moving)).astype(np.int32)
+        images = self.image_array[image]
+        layers = []
+        for number in range(LAYER_COUNT):
+            idx = np.flatnonzero(layer == number)
+            layers.append(list(zip(images[idx].tolist(), zip(x[idx].tolist(), y[idx].tolist()))))
+        hud_commands, audio_events = pickle.loads(extra)
+        return layers, hud_commands, audio_events, (stage, offsets, back)
+
+    def _set_background(self, stage, offsets, back):
+        if stage != self.stage:
+            layers = stage_background_layers(self.stage_settings[stage])
+            self.background = Background(layers)
+            background_cache.evict(layers)
+            self.stage = stage
+        for layer, offset in zip(self.background.layers, offsets):
+            layer.offset = int(round(offset - layer.speed * back)) % layer.height
+
+    def render(self, renderer):
+        for layer, commands in enumerate(self.layers):
+            renderer.extend(layer, commands)
+        hud = renderer.hud
+        for name, args in self.hud_commands:
+            if name == "image":
+                image, position = args
+                renderer.blit(LAYER_HUD, self.images[image], position)
+                continue
+            panel = getattr(hud, name)(*args)
+            if panel is not None:
+                renderer.blit(LAYER_HUD, *panel)
+
+# --splitのゲームループ (描画のプロセス側)。シミュレーションは別のプロセスで実時間に合わせて進む
+class SplitLoop:
+    def __init__(self, seed=None, record_path=None, full_redraw=False, load_workers=STARTUP_LOAD_WORKERS, quality="auto", render_fps=FPS):
+        self.loader = StartupLoader(load_workers)
+        screen = init_pygame(loader=self.loader)
+        self.renderer = Renderer(screen, dirty_tracking=not full_redraw, cull=not full_redraw)
+        self.quality = quality_scaler(quality, 1000 / render_fps)
+        self.quality.apply(self.renderer)
+        self.audio = GameAudio(self.loader.sounds)
+        self.buffer = SplitBuffer()
+        self.view = SplitView(self.buffer)
+        # pygameを初期化したプロセスをforkしないよう、spawnで起動する
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=split_simulation, args=(self.buffer.name, seed, record_path), name="simulation", daemon=True)
+        self.process.start()
+        self.fire_count = 0
+        self.running = True
+
+    def frame(self):
+        start = time.perf_counter()
+        control = self.buffer.control
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.running = False
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
+                self.fire_count += 1
+        control["inputs"] = FrameInput.from_keys(pygame.key.get_pressed(), False).to_bits()
+        control["fire_count"] = self.fire_count
+        control["quality"] = self.quality.level
+        if not self.process.is_alive():
+            self.running = False
+            return
+        if self.view.read(self.audio):
+            self.renderer.render(self.view)
+            self.loader.mark_first_frame()
+        if self.quality.observe((time.perf_counter() - start) * 1000):
+            self.quality.apply(self.renderer)
+
+    def close(self):
+        self.buffer.control["running"] = 0
+        self.process.join(5)
+        if DEBUG_STATS:
+            self.loader.print_stats()
+            self.renderer.print_stats()
+            self.quality.print_stats()
+            print("split: frames={} retries={} dropped={}".format(self.view.sequence + 1, self.view.retries, self.view.dropped))
+        self.view = None
+        self.buffer.close()
+
+def run_split(seed=None, render_fps=FPS, record_path=None, full_redraw=False, load_workers=STARTUP_LOAD_WORKERS, quality="auto"):
+    loop = SplitLoop(seed, record_path, full_redraw, load_workers, quality, render_fps)
+    clock = pygame.time.Clock()
+    while loop.running:
+        loop.frame()
+        clock.tick(render_fps)
+    loop.close()
+
+# ウィンドウなしで、フレームレートの制限なしにシミュレーションする
+# renderを指定すると見えない画面に毎フレーム描画し、描画時間を表示する
+def run_headless(frames, autofire=False, seed=None, record_path=None, render=False, full_redraw=False, profile_path=None, load_workers=STARTUP_LOAD_WORKERS, quality="auto"):
+    loader = StartupLoader(load_workers)
+    screen = init_pygame(headless=True, loader=loader)
+    renderer = Renderer(screen, dirty_tracking=not full_redraw, cull=not full_redraw) if render else None
+    scaler = quality_scaler(quality)
+    if renderer is not None:
+        scaler.apply(renderer)
+    world = GameWorld(persist_best_score=False, seed=seed, draw_background=render)
+    profiler = world.profiler = FrameProfiler(frames) if profile_path else NullProfiler()
+    recorder = ReplayWriter(record_path, world.rng.seed) if record_path else None
+    inputs = FrameInput(fire=autofire)
+    start = time.perf_counter()
+    for i in range(frames):
+        frame_start = time.perf_counter()
+        profiler.begin_frame()
+        if recorder is not None:
+            recorder.record(inputs.to_bits())
+        world.step(inputs)
+        if renderer is not None:
+            renderer.render(world)
+            profiler.mark("render")
+            if scaler.observe((time.perf_counter() - frame_start) * 1000):
+                scaler.apply(renderer)
+        profiler.end_frame(world, quality=scaler.level)
+        loader.mark_first_frame()
+    elapsed = time.perf_counter() - start
+    if recorder is not None:
+        recorder.close()
+    if profile_path:
+        profiler.export(profile_path)
+        profiler.print_stats()
+    print("{} frames in {:.2f}s ({:.0f} frames/s), seed {} stage {} state {} score {}".format(frames, elapsed, frames / elapsed if elapsed > 0 else 0, world.rng.seed, world.current_stage, world.game_state, world.score))
+    print("digest", world.digest())
+    if renderer is not None:
+        renderer.print_stats()
+        scaler.print_stats()
+    if DEBUG_STATS:
+        loader.print_stats()
+        world.print_pool_stats()
+
+# リプレイをウィンドウなしで最高速で再生する (seekを指定するとそのティックで止める)
+# 描画も背景の帯も作らないので、速さは1ティックのシミュレーションの時間で決まる
+# (1コアの開発機で、ステージ1-3を撃ち続けるリプレイが実時間の約80-100倍、敵の少ない場面が多いリプレイで約150倍)
+def run_replay_turbo(replay, seek=None):
+    init_pygame(headless=True)
+    world = GameWorld(persist_best_score=False, seed=replay.seed, draw_background=False)
+    ticks = replay.ticks if seek is None else min(seek, replay.ticks)
+    start = time.perf_counter()
+    for i, bits in zip(range(ticks), replay.masks()):
+        world.step(FrameInput.from_bits(bits))
+    elapsed = time.perf_counter() - start
+    realtime = ticks / FPS
+    print("replayed {} ticks in {:.2f}s ({:.0f}x realtime), stage {} state {} score {}".format(ticks, elapsed, realtime / elapsed if elapsed > 0 else 0, world.current_stage, world.game_state, world.score))
+    print("digest", world.digest())
+    return world
+
+def main():
+    parser = argparse.ArgumentParser(description="シューティングゲーム")
+    parser.add_argument("--headless", action="store_true", help="ウィンドウと音なしでシミュレーションだけを実行する")
+    parser.add_argument("--frames", type=int, default=3600, help="--headless時に進めるフレーム数")
+    parser.add_argument("--autofire", action="store_true", help="--headless時に毎フレームSPACEを押す")
+    parser.add_argument("--seed", type=int, default=None, help="乱数のシード (省略時はランダム)")
+    parser.add_argument("--render-fps", type=int, default=FPS, help="描画のフレームレート (シミュレーションは常にFPSで進む)")
+    parser.add_argument("--render", action="store_true", help="--headless時に毎フレーム描画して描画時間を表示する")
+    parser.add_argument("--full-redraw", action="store_true", help="毎フレーム画面全体を描き直す (画面外のスプライトも描く。描画時間の比較用)")
+    parser.add_argument("--profile", metavar="FILE", help="フレームごとのフェーズ別の時間とエンティティ数を記録し、終了時にCSV (.jsonならJSON) に書き出す")
+    replay_group = parser.add_mutually_exclusive_group()
+    replay_group.add_argument("--record", metavar="FILE", help="シードと入力をリプレイファイルに記録する")
+    replay_group.add_argument("--replay", metavar="FILE", help="リプレイファイルを再生する")
+    parser.add_argument("--turbo", action="store_true", help="--replay時にウィンドウなしで最高速で再生する (シミュレーションの速さで決まり、実時間の約80-150倍)")
+    parser.add_argument("--seek", type=int, default=None, help="--replay時にこのティックまで早送りする (--turboではここで止める)")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="ブラウザ版と同じasyncioのゲームループで動かす")
+    parser.add_argument("--split", action="store_true", help="シミュレーションを別のプロセスで動かし、共有メモリ経由で描画する (--replayとは併用できない)")
+    parser.add_argument("--quality", default="auto", choices=["auto"] + [level["name"] for level in QUALITY_LEVELS], help="描画の品質 (autoならフレームの処理時間に合わせて自動で上げ下げする)")
+    parser.add_argument("--load-workers", type=int, default=STARTUP_LOAD_WORKERS, help="起動時にアセットを並列に読むスレッド数 (0ならメインスレッドで順に読む)")
+    args = parser.parse_args()
+    run = run_window
+    if args.use_async:
+        run = lambda *a, **kw: asyncio.run(run_window_async(*a, **kw))
+
+    if args.replay:
+        replay = Replay.load(args.replay)
+        if args.turbo:
+            run_replay_turbo(replay, args.seek)
+        else:
+            run(render_fps=args.render_fps, replay=replay, seek=args.seek or 0, full_redraw=args.full_redraw, profile_path=args.profile, load_workers=args.load_workers, quality=args.quality)
+    elif args.split:
+        run_split(args.seed, args.render_fps, args.record, args.full_redraw, args.load_workers, args.quality)
+    elif args.headless:
+        run_headless(args.frames, args.autofire, args.seed, args.record, args.render, args.full_redraw, args.profile, args.load_workers, args.quality)
+    else:
+        run(args.seed, args.render_fps, args.record, full_redraw=args.full_redraw, profile_path=args.profile, load_workers=args.load_workers, quality=args.quality)
+    pygame.quit()
+
+if __name__ == "__main__":
+    if WEB:
+        # pygbagはこのasyncio.run()をブラウザのイベントループの上で動かす (コマンドライン引数はない)
+        asyncio.run(run_window_async())
+    else:
+        main()
+        sys.exit()
@@ -0,0 +1,136 @@
+
+import bisect
+import queue
+import struct
+import threading
+
+# リプレイファイル
+# シードと、ティックごとの入力 (ビットマスク) だけを記録する
+#
+# 形式 (リトルエンディアン):
+#   ヘッダ: b"ANRP" / バージョン(u8) / シード(u64) / ティック数(u32)
+#   本体: 入力が変わるごとに1レコード
+#         [直前のレコードの入力とのXOR(u8)] [その入力が続いたティック数(可変長整数)]
+MAGIC = b"ANRP"
+VERSION = 1
+HEADER = struct.Struct("<4sBQI")
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+# リプレイの記録
+# record()はランレングスを数えるだけで、ファイルへの書き込みは別スレッドで行う
+class ReplayWriter:
+    def __init__(self, path, seed, flush_size=4096):
+        self.path = path
+        self.seed = seed
+        self.ticks = 0
+        self.flush_size = flush_size
+        self._current = None # 今続いている入力
+        self._run = 0 # 今の入力が続いているティック数
+        self._last_written = 0 # 直前のレコードの入力
+        self._queue = queue.SimpleQueue()
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, seed, 0))
+        self._thread = threading.Thread(target=self._write_loop, name="replay-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, mask):
+        self.ticks += 1
+        if mask == self._current:
+            self._run += 1
+            return
+        if self._current is not None:
+            self._end_run()
+        self._current = mask
+        self._run = 1
+
+    def _end_run(self):
+        self._queue.put((self._current ^ self._last_written, self._run))
+        self._last_written = self._current
+
+    def _write_loop(self):
+        buffer = bytearray()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            delta, run = item
+            buffer.append(delta)
+            _write_varint(buffer, run)
+            if len(buffer) >= self.flush_size:
+                self._file.write(buffer)
+                buffer.clear()
+        self._file.write(buffer)
+
+    def close(self):
+        if self._current is not None:
+            self._end_run()
+            self._current = None
+        self._queue.put(None)
+        self._thread.join()
+        # 最後にティック数をヘッダに書き戻す
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, self.seed, self.ticks))
+        self._file.close()
+
+# 読み込んだリプレイ
+class Replay:
+    def __init__(self, seed, run_starts, run_masks):
+        self.seed = seed
+        self.run_starts = run_starts # 各レコードの開始ティック
+        self.run_masks = run_masks # 各レコードの入力
+        self.ticks = run_starts[-1] if run_starts else 0 # 最後は終端 (ティック数)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, seed, ticks = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a replay file".format(path))
+        # ヘッダのティック数は書き込み途中で終了した場合0のままなので、本体から数え直す
+        run_starts = []
+        run_masks = []
+        mask = 0
+        tick = 0
+        pos = HEADER.size
+        while pos < len(data):
+            mask ^= data[pos]
+            run, pos = _read_varint(data, pos + 1)
+            run_starts.append(tick)
+            run_masks.append(mask)
+            tick += run
+        run_starts.append(tick)
+        return cls(seed, run_starts, run_masks)
+
+    def mask_at(self, tick):
+        # tick番目 (0始まり) の入力
+        if not 0 <= tick < self.ticks:
+            raise IndexError(tick)
+        return self.run_masks[bisect.bisect_right(self.run_starts, tick) - 1]
+
+    def masks(self, start=0):
+        # start番目以降の入力を1ティックずつ返す
+        if start >= self.ticks:
+            return
+        index = bisect.bisect_right(self.run_starts, start) - 1
+        tick = start
+        for mask, end in zip(self.run_masks[index:], self.run_starts[index + 1:]):
+            while tick < end:
+                yield mask
+                tick += 1
@@ -0,0 +1,178 @@
+
+import argparse
+import datetime
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# スコアの保存
+# ベストスコア (best_score.json) と、プレイの記録 (scores.db、SQLite) を持つ
+# record()はメモリ上のベストスコアを更新して書き込みを予約するだけで、ディスクへの書き込みは別スレッドで行う
+# (threaded=Falseの時 (スレッドのないブラウザ) は、ゲームループがフレームを表示した後にpump()で書く)
+# best_score.jsonは一時ファイルに書いてから置き換えるので、途中で落ちても壊れない
+#
+# 例: python scores.py                       (全体の上位10件)
+#     python scores.py --stage 3 --top 20     (ステージ3の上位20件)
+#     python scores.py --day 2026-10-18       (その日の上位10件)
+BEST_SCORE_FILE = "best_score.json"
+DATABASE_FILE = "scores.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    played_at REAL NOT NULL, -- 記録した時刻 (UNIX時間)
+    day TEXT NOT NULL, -- 記録した日 (ローカル時間のYYYY-MM-DD)
+    stage INTEGER NOT NULL, -- クリアした (ゲームオーバーならやられた) ステージ
+    score INTEGER NOT NULL,
+    cleared INTEGER NOT NULL -- ステージをクリアしたか
+);
+-- 上位N件を索引の順に読むだけで取れるように、絞り込む列の後にスコアを並べる
+CREATE INDEX IF NOT EXISTS runs_score ON runs (score DESC);
+CREATE INDEX IF NOT EXISTS runs_stage_score ON runs (stage, score DESC);
+CREATE INDEX IF NOT EXISTS runs_day_score ON runs (day, score DESC);
+"""
+
+class ScoreStore:
+    def __init__(self, data_dir, threaded=True):
+        self.data_dir = data_dir
+        self.threaded = threaded
+        self._best = None # 読み込んだベストスコア (最初に使う時に読む)
+        self._best_written = None # best_score.jsonに書いたベストスコア
+        self._queue = queue.SimpleQueue()
+        self._pending = [] # threaded=Falseの時に、pump()を待っている記録
+        self._thread = None # 最初のrecord()で起動する
+        self._db = None # 書き込み用の接続 (書き込むスレッドで開く)
+        self.writes = 0 # 書き込んだ記録の数
+
+    @property
+    def best_score_path(self):
+        return os.path.join(self.data_dir, BEST_SCORE_FILE)
+
+    @property
+    def database_path(self):
+        return os.path.join(self.data_dir, DATABASE_FILE)
+
+    # ベストスコア (ファイルを読むのは最初の1回だけ)
+    def best_score(self):
+        if self._best is None:
+            self._best = 0
+            if os.path.exists(self.best_score_path):
+                with open(self.best_score_path) as f:
+                    self._best = json.load(f)
+            self._best_written = self._best
+        return self._best
+
+    # ステージをクリアした時 (cleared=True) とゲームオーバーの時に呼ぶ
+    def record(self, score, stage, cleared):
+        if score > self.best_score():
+            self._best = score
+        item = (time.time(), stage, score, cleared, self._best)
+        if not self.threaded:
+            self._pending.append(item)
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_loop, name="score-writer", daemon=True)
+            self._thread.start()
+        self._queue.put(item)
+
+    def _write_loop(self):
+        while True:
+            items = [self._queue.get()]
+            # 溜まっている分はまとめて1回で書く
+            while not self._queue.empty():
+                items.append(self._queue.get())
+            stop = None in items
+            items = [item for item in items if item is not None]
+            if items:
+                self._write(items)
+            if stop:
+                break
+        self._disconnect() # 接続は開いたスレッドで閉じる
+
+    def _write(self, items):
+        os.makedirs(self.data_dir, exist_ok=True)
+        db = self._connect()
+        with db:
+            db.executemany(
+                "INSERT INTO runs (played_at, day, stage, score, cleared) VALUES (?, ?, ?, ?, ?)",
+                [(played_at, datetime.date.fromtimestamp(played_at).isoformat(), stage, score, int(cleared)) for played_at, stage, score, cleared, best in items],
+            )
+        self.writes += len(items)
+        best = items[-1][4]
+        if best != self._best_written:
+            self._write_best_score(best)
+            self._best_written = best
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.database_path)
+            self._db.execute("PRAGMA journal_mode=WAL") # 書き込み中も別の接続から読めるように
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _disconnect(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _write_best_score(self, score):
+        # 一時ファイルに書いてから置き換える (置き換えは一瞬で行われるので、読む側は古いか新しいかのどちらかを見る)
+        temp_path = self.best_score_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(score, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.best_score_path)
+
+    # 上位n件 (stage・dayで絞り込める)。メインループの外 (タイトル画面やツール) で使う
+    def top(self, n=10, stage=None, day=None):
+        if not os.path.exists(self.database_path):
+            return []
+        conditions = []
+        params = []
+        if stage is not None:
+            conditions.append("stage = ?")
+            params.append(stage)
+        if day is not None:
+            conditions.append("day = ?")
+            params.append(day)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        with sqlite3.connect(self.database_path) as db:
+            rows = db.execute("SELECT played_at, stage, score, cleared FROM runs {} ORDER BY score DESC LIMIT ?".format(where), params + [n]).fetchall()
+        return [{"played_at": played_at, "stage": stage, "score": score, "cleared": bool(cleared)} for played_at, stage, score, cleared in rows]
+
+    # threaded=Falseの時に予約した書き込みを行う (ティックの途中では呼ばない)
+    def pump(self):
+        if self._pending:
+            items, self._pending = self._pending, []
+            self._write(items)
+
+    # 予約した書き込みを全部終わらせる
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        else:
+            self.pump()
+            self._disconnect()
+
+def main():
+    parser = argparse.ArgumentParser(description="プレイの記録の上位を表示する")
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(__file__), "assets", "data"), help="記録のあるディレクトリ")
+    parser.add_argument("--top", type=int, default=10, help="表示する件数")
+    parser.add_argument("--stage", type=int, default=None, help="このステージの記録だけを表示する")
+    parser.add_argument("--day", default=None, help="この日 (YYYY-MM-DD) の記録だけを表示する")
+    args = parser.parse_args()
+
+    store = ScoreStore(args.data_dir)
+    print("best score: {}".format(store.best_score()))
+    for rank, row in enumerate(store.top(args.top, args.stage, args.day), 1):
+        played_at = datetime.datetime.fromtimestamp(row["played_at"]).strftime("%Y-%m-%d %H:%M")
+        print("{:>3}. {:>8}  stage {}{}  {}".format(rank, row["score"], row["stage"], "" if row["cleared"] else " (game over)", played_at))
+
+if __name__ == "__main__":
+    main()
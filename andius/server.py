@@ -0,0 +1,368 @@
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import signal
+import struct
+import sys
+import time
+import traceback
+import zlib
+
+import numpy as np
+
+import main as game
+
+# ゲームサーバー
+# 1つのプロセスで多数のルームをasyncioで動かす。シミュレーションはサーバーだけが行い、クライアントは入力だけを送る
+# サーバーはティックごとに各ルームのワールドを進め、描画に必要な状態 (画像の番号と位置、HUDの値) をスナップショットにして送る
+# スナップショットはそのクライアントに前に送ったもの (基準) との差分をzlibで圧縮したもの。基準がなければ全体を送る
+# (通信はTCPで、順番通りに届くので基準は常に直前に送ったもの。基準のティックをヘッダーに入れてあるので、
+#  UDPで送る場合はクライアントが受け取りを知らせたティックを基準にすればよい)
+#
+# ルームのモード
+#   coop: 1つのワールドに参加者ごとの機体を出し、それぞれの入力で動かす (全機やられたらゲームオーバー)
+#   versus: 参加者ごとに同じシードのワールドを動かし、スコアを競う
+#
+# 例: python server.py --port 7777
+#     python loadtest.py --rooms 1,8,32  (ボットをつないで負荷を測る)
+MODES = ("coop", "versus")
+MAX_PLAYERS = 4 # 1ルームの最大人数
+MAX_WRITE_BUFFER = 256 * 1024 # 送信待ちがこれより多いクライアントにはスナップショットを送らない (次は全体を送る)
+
+# メッセージ: 長さ (u32、種類を含む)、種類 (u8)、本体
+MESSAGE_HEADER = struct.Struct("<IB")
+HELLO = 1 # クライアント -> サーバー: JSON {"room", "mode", "name"}
+WELCOME = 2 # サーバー -> クライアント: JSON {"room", "mode", "seed", "player", "ship"} (shipは自分の機体の番号)
+INPUT = 3 # クライアント -> サーバー: 入力のビットマスク (u8、INPUT_FIREは押した瞬間だけ立てる)
+SNAPSHOT = 4 # サーバー -> クライアント: SNAPSHOT_HEADER + zlib(差分)
+STATS = 5 # クライアント -> サーバー: 空 / サーバー -> クライアント: JSON (サーバーの統計)
+ERROR = 6 # サーバー -> クライアント: JSON {"error"}
+
+# スナップショット: ティック、基準のティック (NO_BASELINEなら全体)、描画の数、復元後の状態のCRC32
+SNAPSHOT_HEADER = struct.Struct("<IIII")
+NO_BASELINE = 0xFFFFFFFF
+
+def message(kind, body=b""):
+    return MESSAGE_HEADER.pack(len(body) + 1, kind) + body
+
+def json_message(kind, data):
+    return message(kind, json.dumps(data, separators=(",", ":")).encode())
+
+async def read_message(reader):
+    header = await reader.readexactly(MESSAGE_HEADER.size)
+    length, kind = MESSAGE_HEADER.unpack(header)
+    return kind, await reader.readexactly(length - 1)
+
+# スナップショットの状態
+# 描画1つにつき (画像の番号 | レイヤー << 8, x, y) をint16で持ち、列ごとに並べる (3 x 描画の数)
+# 列ごとに並べて基準との差 (int16の範囲で折り返す) を取ると、等速で動くものは同じ値が並び、止まっているものは0が並ぶので良く縮む
+# 状態以外の値 (meta) はJSONで、基準のmetaをzlibの辞書にして縮める (変わっていない部分はほぼ0バイトになる)
+def snapshot_state(columns):
+    image, layer, x, y = columns[:4]
+    state = np.empty((3, len(image)), dtype=np.int16)
+    state[0] = image.astype(np.int16) | (layer.astype(np.int16) << 8)
+    state[1] = np.clip(np.rint(x), -32768, 32767)
+    state[2] = np.clip(np.rint(y), -32768, 32767)
+    return state
+
+def _padded(base, count):
+    padded = np.zeros((3, count), dtype=np.int16)
+    n = min(count, base.shape[1])
+    padded[:, :n] = base[:, :n]
+    return padded
+
+# baselineは直前に送った (ティック, 状態, meta)。Noneなら全体を送る
+def encode_snapshot(tick, state, meta, baseline=None, level=1):
+    if baseline is None:
+        baseline_tick, delta, compressor = NO_BASELINE, state, zlib.compressobj(level)
+    else:
+        baseline_tick, base, base_meta = baseline
+        delta = state - _padded(base, state.shape[1])
+        compressor = zlib.compressobj(level, zdict=base_meta)
+    crc = zlib.crc32(meta, zlib.crc32(state.tobytes()))
+    payload = compressor.compress(delta.tobytes() + meta) + compressor.flush()
+    return message(SNAPSHOT, SNAPSHOT_HEADER.pack(tick, baseline_tick, state.shape[1], crc) + payload)
+
+# SNAPSHOTの本体を復元して (ティック, 状態, meta) を返す。baselineは直前に復元した (ティック, 状態, meta)
+def decode_snapshot(body, baseline=None):
+    tick, baseline_tick, count, crc = SNAPSHOT_HEADER.unpack_from(body)
+    if baseline_tick == NO_BASELINE:
+        decompressor = zlib.decompressobj()
+    elif baseline is None or baseline[0] != baseline_tick:
+        raise ValueError("snapshot {} is based on tick {}, which this client does not have".format(tick, baseline_tick))
+    else:
+        decompressor = zlib.decompressobj(zdict=baseline[2])
+    data = decompressor.decompress(body[SNAPSHOT_HEADER.size:]) + decompressor.flush()
+    state = np.frombuffer(data, dtype=np.int16, count=3 * count).reshape(3, count)
+    meta = data[state.nbytes:]
+    if baseline_tick != NO_BASELINE:
+        state = state + _padded(baseline[1], count)
+    if zlib.crc32(meta, zlib.crc32(state.tobytes())) != crc:
+        raise ValueError("snapshot {} failed the checksum".format(tick))
+    return tick, state, meta
+
+# 接続しているクライアント
+class Client:
+    def __init__(self, reader, writer, name):
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self.room = None
+        self.world = None # versusで、このクライアントのワールド
+        self.ship = 0 # 自分の機体の番号 (coopではルームのワールドの中の番号)
+        self.inputs = 0 # 押されているキー
+        self.fire = False # 次のティックでSPACEを押したことにする
+        self.baseline = None # 直前に送った (ティック, 状態, meta)
+
+    def take_inputs(self):
+        inputs = self.inputs | (game.INPUT_FIRE if self.fire else 0)
+        self.fire = False
+        return game.FrameInput.from_bits(inputs)
+
+class Room:
+    def __init__(self, name, mode, seed):
+        self.name = name
+        self.mode = mode
+        self.seed = seed
+        self.clients = []
+        self.world = self._create_world() if mode == "coop" else None # coopで全員の機体がいるワールド
+
+    def _create_world(self):
+        return game.GameWorld(persist_best_score=False, seed=self.seed)
+
+    def add(self, client):
+        self.clients.append(client)
+        client.room = self
+        if self.mode == "versus":
+            client.world = self._create_world()
+        elif len(self.clients) > 1:
+            client.ship = self.world.add_player() # ワールドは機体0を持って作られるので、最初の参加者はそれを使う
+
+    def remove(self, client):
+        self.clients.remove(client)
+        if self.mode == "coop" and self.clients:
+            self.world.remove_player(client.ship)
+        client.room = None
+        client.world = None
+
+    def step(self):
+        if self.mode == "coop":
+            self.world.step({client.ship: client.take_inputs() for client in self.clients}) # それぞれの入力で自分の機体を動かす
+        else:
+            for client in self.clients:
+                client.world.step(client.take_inputs())
+
+    def worlds(self):
+        if self.mode == "coop":
+            return [(self.world, self.clients)]
+        return [(client.world, [client]) for client in self.clients]
+
+    # 参加者ごとのスコアと機体の状態 (coopではスコアは全員で共通)
+    def scores(self):
+        return [{"name": client.name, "score": world.score, "stage": world.current_stage, "state": world.game_state,
+                 "ship": client.ship, "health": world.ships[client.ship].health}
+                for client, world in ((client, client.world or self.world) for client in self.clients)]
+
+class GameServer:
+    def __init__(self, host="127.0.0.1", port=7777, seed=None, max_players=MAX_PLAYERS):
+        self.host = host
+        self.port = port
+        self.seed = seed # 指定すると全ルームがこのシード (省略時はルームごとにランダム)
+        self.max_players = max_players
+        self.rooms = {}
+        self.recorder = game.FrameRecorder(game.pygame.Rect(0, 0, game.SCREEN_WIDTH, game.SCREEN_HEIGHT))
+        self.tick_seconds = 1 / game.FPS
+
+        # 統計
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.ticks = 0
+        self.late_ticks = 0 # 予定の時刻に間に合わなかったティック
+        self.tick_times = collections.deque(maxlen=600) # 直近のティックの処理時間 (秒)
+        self.clients = 0
+        self.bytes_sent = 0
+        self.snapshots = 0
+        self.full_snapshots = 0
+        self.dropped_snapshots = 0 # 送信が詰まっていて送らなかったスナップショット
+        self.failed_rooms = 0 # 例外で閉じたルーム
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        print("listening on {}:{}".format(self.host, self.port), flush=True)
+        # SDLがSIGINT・SIGTERMを横取りする (終了イベントにするだけ) ので、自分で受けて止める
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.cancel)
+        async with server:
+            ticker = asyncio.ensure_future(self.run())
+            ticker.add_done_callback(lambda task: stop.cancel()) # ティックのループが止まったらサーバーも止める
+            try:
+                await stop
+            except asyncio.CancelledError:
+                pass
+            ticker.cancel()
+        if ticker.done() and not ticker.cancelled() and ticker.exception() is not None:
+            raise ticker.exception()
+
+    # 固定ティックで全ルームを進める (間に合わない時はティックを遅らせる)
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            start = time.perf_counter()
+            self.tick()
+            self.tick_times.append(time.perf_counter() - start)
+            next_tick += self.tick_seconds
+            delay = next_tick - loop.time()
+            if delay < 0:
+                self.late_ticks += 1
+                if delay < -self.tick_seconds * game.MAX_TICKS_PER_FRAME:
+                    next_tick = loop.time() # 追いつけない分は捨てる
+            await asyncio.sleep(max(0, delay))
+
+    def tick(self):
+        self.ticks += 1
+        for room in list(self.rooms.values()):
+            try:
+                room.step()
+                self.send_snapshots(room)
+            except Exception:
+                # 1つのルームで起きた例外で他のルームを止めないよう、そのルームだけを閉じる
+                print("room {} failed and was closed".format(room.name), file=sys.stderr)
+                traceback.print_exc()
+                self.close_room(room)
+
+    def close_room(self, room):
+        self.failed_rooms += 1
+        del self.rooms[room.name]
+        for client in room.clients:
+            client.writer.write(json_message(ERROR, {"error": "room failed"}))
+            client.writer.close() # 切断されたクライアントはhandle_clientがleave()する
+
+    def send_snapshots(self, room):
+        scores = room.scores()
+        for world, clients in room.worlds():
+            columns, hud_commands = self.recorder.record(world)
+            state = snapshot_state(columns)
+            meta = {"stage": world.current_stage, "background": [float(offset) for offset in world.background.position()], "hud": hud_commands, "players": scores}
+            meta = json.dumps(meta, separators=(",", ":")).encode()
+            tick = world.clock.ticks
+            encoded = {} # coopでは同じ基準のクライアントに同じメッセージを送る
+            for client in clients:
+                if client.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                    client.baseline = None
+                    self.dropped_snapshots += 1
+                    continue
+                key = client.baseline[0] if client.baseline is not None else None
+                data = encoded.get(key)
+                if data is None:
+                    data = encoded[key] = encode_snapshot(tick, state, meta, client.baseline)
+                if key is None:
+                    self.full_snapshots += 1
+                client.writer.write(data)
+                client.baseline = (tick, state, meta)
+                self.bytes_sent += len(data)
+                self.snapshots += 1
+
+    async def handle_client(self, reader, writer):
+        client = None
+        try:
+            kind, body = await read_message(reader)
+            if kind == STATS:
+                writer.write(json_message(STATS, self.stats()))
+                await self._serve_stats(reader, writer)
+                return
+            if kind != HELLO:
+                writer.write(json_message(ERROR, {"error": "expected HELLO"}))
+                return
+            try:
+                hello = json.loads(body)
+            except ValueError:
+                hello = None
+            if not isinstance(hello, dict):
+                writer.write(json_message(ERROR, {"error": "HELLO must be a JSON object"}))
+                return
+            client = Client(reader, writer, str(hello.get("name", "player")))
+            room = self.join(client, str(hello.get("room", "lobby")), hello.get("mode", "coop"))
+            if room is None:
+                writer.write(json_message(ERROR, {"error": "room is full or the mode does not match"}))
+                client = None
+                return
+            writer.write(json_message(WELCOME, {"room": room.name, "mode": room.mode, "seed": room.seed, "player": len(room.clients) - 1, "ship": client.ship}))
+            while True:
+                kind, body = await read_message(reader)
+                if kind == INPUT and body:
+                    client.inputs = body[0] & ~game.INPUT_FIRE
+                    client.fire = client.fire or bool(body[0] & game.INPUT_FIRE)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            if client is not None:
+                self.leave(client)
+            writer.close()
+
+    # STATSで接続したクライアントには、STATSを受け取るたびに統計を返す
+    async def _serve_stats(self, reader, writer):
+        while True:
+            kind, body = await read_message(reader)
+            if kind == STATS:
+                writer.write(json_message(STATS, self.stats()))
+
+    def join(self, client, name, mode):
+        room = self.rooms.get(name)
+        if room is None:
+            if mode not in MODES:
+                return None
+            seed = self.seed if self.seed is not None else random.randrange(2 ** 31)
+            room = self.rooms[name] = Room(name, mode, seed)
+        if room.mode != mode or len(room.clients) >= self.max_players:
+            return None
+        room.add(client)
+        self.clients += 1
+        return room
+
+    def leave(self, client):
+        room = client.room
+        room.remove(client)
+        self.clients -= 1
+        if not room.clients and self.rooms.get(room.name) is room: # close_room()で閉じたルームは除いてある
+            del self.rooms[room.name] # 誰もいなくなったルームは捨てる
+
+    def stats(self):
+        times = np.array(self.tick_times) * 1000 if self.tick_times else np.zeros(1)
+        return {
+            "rooms": len(self.rooms),
+            "clients": self.clients,
+            "ticks": self.ticks,
+            "late_ticks": self.late_ticks,
+            "tick_ms_p50": float(np.percentile(times, 50)),
+            "tick_ms_p95": float(np.percentile(times, 95)),
+            "wall_seconds": time.perf_counter() - self.started,
+            "cpu_seconds": time.process_time() - self.cpu_started,
+            "bytes_sent": self.bytes_sent,
+            "snapshots": self.snapshots,
+            "full_snapshots": self.full_snapshots,
+            "dropped_snapshots": self.dropped_snapshots,
+            "failed_rooms": self.failed_rooms,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="ヘッドレスでルームを動かし、スナップショットを配信するゲームサーバー")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=7777, help="待ち受けるポート (0なら空いているポート)")
+    parser.add_argument("--seed", type=int, default=None, help="全ルームで使うシード (省略時はルームごとにランダム)")
+    parser.add_argument("--max-players", type=int, default=MAX_PLAYERS, help="1ルームの最大人数")
+    args = parser.parse_args()
+
+    game.init_pygame(headless=True)
+    server = GameServer(args.host, args.port, args.seed, args.max_players)
+    asyncio.run(server.serve())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())